@@ -0,0 +1,139 @@
+# Streams downloaded files into a tar or zip archive, in a deterministic order,
+# while the downloads themselves happen in parallel.
+
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+# Downloaded files larger than this are spooled to a temporary file on disk
+# instead of being held in memory until their turn to be written comes.
+DEFAULT_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+class _TarSink(object):
+  def __init__(self, fileobj, mode):
+    self._tar = tarfile.open(fileobj=fileobj, mode=mode)
+
+  def write(self, name, mtime, data, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    self._tar.addfile(info, data)
+
+  def close(self):
+    self._tar.close()
+
+
+class _ZipSink(object):
+  def __init__(self, fileobj):
+    # Media files are already compressed, storing them is much cheaper.
+    self._zip = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_STORED)
+
+  def write(self, name, mtime, data, size):
+    info = zipfile.ZipInfo(name, time.gmtime(mtime)[:6])
+    info.file_size = size
+    with self._zip.open(info, 'w') as dest:
+      shutil.copyfileobj(data, dest)
+
+  def close(self):
+    self._zip.close()
+
+
+def _open_sink(path):
+  if path == '-':
+    return _TarSink(sys.stdout.buffer, 'w|'), sys.stdout.buffer
+  fileobj = open(path, 'wb')
+  lower = path.lower()
+  if lower.endswith('.zip'):
+    return _ZipSink(fileobj), fileobj
+  if lower.endswith('.tar.gz') or lower.endswith('.tgz'):
+    return _TarSink(fileobj, 'w|gz'), fileobj
+  return _TarSink(fileobj, 'w|'), fileobj
+
+
+class OrderedArchiveWriter(object):
+  """Writes archive entries in reservation order, bounding buffered data.
+
+  Producers first `reserve` a slot, in the order in which entries must appear
+  in the archive, then download in parallel and hand their data with `add`.
+  Entries are written as soon as all preceding entries have been written.
+  `reserve` blocks when `max_pending` entries are reserved but not yet written,
+  so at most `max_pending` downloaded files are held at any time, each of them
+  in memory only up to `spool_size` bytes.
+
+  Args:
+    path: str, the archive file to create, or '-' to stream a tar archive to
+        stdout. The format is picked from the extension: '.zip', '.tar.gz' or
+        '.tgz', and uncompressed tar otherwise.
+    max_pending: int, maximum number of reserved but unwritten entries.
+    spool_size: int, size above which buffers are spooled to disk.
+  """
+
+  def __init__(self, path, max_pending, spool_size=DEFAULT_SPOOL_SIZE):
+    self._to_stdout = (path == '-')
+    self._sink, self._fileobj = _open_sink(path)
+    self._max_pending = max(1, max_pending)
+    self._spool_size = spool_size
+    self._pending = {}
+    self._next_reserved = 0
+    self._next_to_write = 0
+    self._cond = threading.Condition()
+
+  def new_buffer(self):
+    """Returns a file object into which an entry's data can be downloaded."""
+    return tempfile.SpooledTemporaryFile(max_size=self._spool_size)
+
+  def reserve(self):
+    """Reserve the next archive slot, waiting if too many are pending.
+
+    Returns:
+      The index to pass to `add`.
+    """
+    with self._cond:
+      while self._next_reserved - self._next_to_write >= self._max_pending:
+        self._cond.wait()
+      index = self._next_reserved
+      self._next_reserved += 1
+      return index
+
+  def add(self, index, name, mtime, data):
+    """Provide the data of a reserved slot.
+
+    Args:
+      index: int, the index returned by `reserve`.
+      name: str, the name of the entry in the archive.
+      mtime: int, the entry's modification time, in seconds since epoch.
+      data: file object returned by `new_buffer`, or None if the entry must be
+          skipped (e.g. because its download failed).
+    """
+    with self._cond:
+      self._pending[index] = (name, mtime, data)
+      while self._next_to_write in self._pending:
+        name, mtime, data = self._pending.pop(self._next_to_write)
+        if data is not None:
+          try:
+            size = data.tell()
+            data.seek(0)
+            self._sink.write(name, mtime, data, size)
+          finally:
+            data.close()
+        self._next_to_write += 1
+        self._cond.notify_all()
+
+  def close(self):
+    self._sink.close()
+    if self._to_stdout:
+      self._fileobj.flush()
+    else:
+      self._fileobj.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
@@ -0,0 +1,178 @@
+# Runs a file of smugcli commands in a single process, sharing the SmugMug
+# session and caches, and running independent commands concurrently.
+
+from . import jobs
+from . import smugmug as smugmug_lib
+from . import smugmug_fs
+
+import io
+import os
+import re
+import shlex
+import sys
+
+# Commands which can't run unattended in a batch.
+EXCLUDED_COMMANDS = {'batch', 'daemon', 'login', 'shell'}
+
+# A manifest entry: "SOURCE -> TARGET", syncing SOURCE to TARGET.
+MANIFEST_RE = re.compile(r'^(.*?)\s+(?:->|→)\s+(.*)$')
+
+BARRIER = 'wait'
+
+
+class Error(Exception):
+  """Base class for all exception of this module."""
+
+
+class InvalidBatchError(Error):
+  """Error raised when a batch file can't be parsed."""
+
+
+class _Entry(object):
+  def __init__(self, line_number, argv, parsed):
+    self.line_number = line_number
+    self.argv = argv
+    self.parsed = parsed
+    self.target = _sync_target(argv[0], parsed)
+    self.job = None
+
+
+def _sync_target(command, parsed):
+  """Returns the remote path a sync command writes to, or None."""
+  if command != 'sync':
+    return None
+  # Mirrors the argument juggling done by SmugMugFS.sync.
+  if len(parsed.source) >= 2 and parsed.target == [os.sep]:
+    target = parsed.source[-1]
+  else:
+    target = parsed.target[0]
+  return os.sep + target.strip(os.sep)
+
+
+def _overlap(path1, path2):
+  path1 = path1.rstrip(os.sep) + os.sep
+  path2 = path2.rstrip(os.sep) + os.sep
+  return path1.startswith(path2) or path2.startswith(path1)
+
+
+def _parse_line(line):
+  match = MANIFEST_RE.match(line)
+  if match:
+    # Nobody can answer confirmations in a batch, the manifest is explicit.
+    return ['sync', '-f', match.group(1).strip(), match.group(2).strip()]
+  return shlex.split(line)
+
+
+def parse(lines, parser, name='batch'):
+  """Parses batch lines into groups of entries.
+
+  Entries of a group may run concurrently, while groups, separated by a
+  "wait" line, run one after the other.
+
+  Raises:
+    InvalidBatchError: if a line isn't a valid command.
+  """
+  groups = [[]]
+  for line_number, line in enumerate(lines, 1):
+    line = line.strip()
+    if not line or line.startswith('#'):
+      continue
+    if line == BARRIER:
+      groups.append([])
+      continue
+    argv = _parse_line(line)
+    error = None
+    if argv[0] in EXCLUDED_COMMANDS:
+      error = '"%s" can\'t run in a batch' % argv[0]
+    else:
+      stderr = sys.stderr
+      sys.stderr = io.StringIO()
+      try:
+        parsed = parser.parse_args(argv)
+        if not hasattr(parsed, 'func'):
+          error = 'missing command'
+      except SystemExit:
+        error = sys.stderr.getvalue().strip().splitlines()[-1]
+      finally:
+        sys.stderr = stderr
+    if error:
+      raise InvalidBatchError('%s:%d: %s' % (name, line_number, error))
+    groups[-1].append(_Entry(line_number, argv, parsed))
+  return [group for group in groups if group]
+
+
+def _run_entry(fs, parsed):
+  try:
+    parsed.func(fs, parsed)
+  except smugmug_fs.Error as e:
+    print(e)
+  except smugmug_lib.NotLoggedInError:
+    return
+
+
+def run(fs, path, parser, max_running):
+  """Runs the commands of the batch file `path`.
+
+  Each command runs as a job on its own fork of `fs`, at most `max_running` at
+  a time. Sync commands wait for the earlier ones writing to an overlapping
+  remote path. The output of each command is printed in file order, as soon
+  as the preceding commands are done.
+  """
+  try:
+    with open(path) as f:
+      groups = parse(f, parser, path)
+  except (IOError, InvalidBatchError) as e:
+    print(e)
+    return
+
+  stdout = sys.stdout
+  if not isinstance(stdout, jobs.StdoutRouter):
+    # Capture the output of each command separately.
+    sys.stdout = jobs.StdoutRouter(stdout)
+  try:
+    # Commands running ahead of the one being printed may print any amount
+    # of output before their turn comes, which must all be kept.
+    manager = jobs.JobManager(max_running, max_lines=None)
+    entries = []
+    previous_group = []
+    for group in groups:
+      started = []
+      for entry in group:
+        after = [e.job for e in previous_group]
+        after.extend(e.job for e in started
+                     if entry.target and e.target and
+                     _overlap(entry.target, e.target))
+        entry.job = manager.start(
+          ' '.join(shlex.quote(a) for a in entry.argv),
+          lambda fs, parsed=entry.parsed: _run_entry(fs, parsed),
+          fs.fork(), after)
+        started.append(entry)
+      previous_group = group
+      entries.extend(group)
+
+    failed = 0
+    for entry in entries:
+      print('[%d] %s' % (entry.line_number, entry.job.command))
+      _follow(entry.job, fs, manager, entries)
+      if entry.job.state != 'done':
+        failed += 1
+    print('Batch complete: %d command%s, %d failed.' % (
+      len(entries), '' if len(entries) == 1 else 's', failed))
+  finally:
+    sys.stdout = stdout
+
+
+def _follow(job, fs, manager, entries):
+  index = 0
+  while True:
+    if fs.aborting:
+      # Interrupted, stop all the commands.
+      for entry in entries:
+        manager.kill(entry.job)
+    finished = job.finished
+    lines, index = job.read_output(index)
+    for line in lines:
+      print(line)
+    if finished:
+      return
+    job.wait(1)
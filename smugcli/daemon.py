@@ -0,0 +1,282 @@
+# Daemon keeping a warm SmugMug session, and the thin client forwarding
+# commands to it over a Unix socket.
+#
+# Messages are JSON objects, one per line. The client sends the request
+# {"argv": [...], "cwd": "..."}, then {"input": "..."} answers and {"abort": 1}
+# when interrupted. The daemon sends {"out": "..."} and {"err": "..."} chunks,
+# {"read": 1} when the command reads stdin, and finally {"exit": status}.
+
+import json
+import os
+import socket
+import sys
+import threading
+
+from six.moves import queue
+
+# Commands that are always run by the invoking process: interactive ones, and
+# the ones managing the daemon or its credentials.
+LOCAL_COMMANDS = {'daemon', 'login', 'logout', 'shell'}
+
+
+def socket_path():
+  return os.environ.get('SMUGCLI_SOCKET',
+                        os.path.expanduser('~/.smugcli.sock'))
+
+
+class _Connection(object):
+  def __init__(self, sock):
+    self._sock = sock
+    self._reader = sock.makefile('rb')
+    self._mutex = threading.Lock()
+
+  def send(self, message):
+    data = (json.dumps(message) + '\n').encode('utf-8')
+    with self._mutex:
+      self._sock.sendall(data)
+
+  def receive(self):
+    line = self._reader.readline()
+    return json.loads(line.decode('utf-8')) if line else None
+
+  def close(self):
+    self._reader.close()
+    self._sock.close()
+
+
+class _OutputStream(object):
+  """File-like object sending what is written to the client."""
+
+  def __init__(self, client, key):
+    self._client = client
+    self._key = key
+
+  def write(self, string):
+    if isinstance(string, bytes):
+      string = string.decode('utf-8')
+    self._client.send_output(self._key, string)
+    return len(string)
+
+  def flush(self):
+    pass
+
+  def isatty(self):
+    return False
+
+
+class _InputStream(object):
+  """File-like object reading lines from the client's stdin."""
+
+  def __init__(self, client):
+    self._client = client
+
+  def readline(self, size=-1):
+    return self._client.read_input()
+
+
+class _Client(object):
+  """The state of a command run on behalf of a client."""
+
+  def __init__(self, connection, fs):
+    self._connection = connection
+    self.fs = fs
+    self._inputs = queue.Queue()
+    self._disconnected = False
+    self.stdout = _OutputStream(self, 'out')
+    self.stderr = _OutputStream(self, 'err')
+    self.stdin = _InputStream(self)
+    thread = threading.Thread(target=self._read_messages)
+    thread.daemon = True
+    thread.start()
+
+  def send_output(self, key, string):
+    if self._disconnected:
+      return
+    try:
+      self._connection.send({key: string})
+    except OSError:
+      self._disconnect()
+
+  def read_input(self):
+    self.send_output('read', 1)
+    return self._inputs.get()
+
+  def finish(self, status):
+    self.send_output('exit', status)
+
+  def _read_messages(self):
+    while True:
+      try:
+        message = self._connection.receive()
+      except (OSError, ValueError):
+        message = None
+      if message is None:
+        self._disconnect()
+        return
+      if 'input' in message:
+        self._inputs.put(message['input'])
+      elif 'abort' in message:
+        self.fs.abort()
+
+  def _disconnect(self):
+    # Nobody is left to see the results, stop the command.
+    self._disconnected = True
+    self.fs.abort()
+    self._inputs.put('')
+
+
+def _handle(connection, fs, dispatch):
+  """Runs one client request. Returns False if the daemon must stop."""
+  request = connection.receive()
+  if request is None:
+    return True
+  if request.get('stop'):
+    connection.send({'exit': 0})
+    return False
+
+  client = _Client(connection, fs.fork())
+  cwd = os.getcwd()
+  streams = sys.stdin, sys.stdout, sys.stderr
+  status = 0
+  try:
+    # Requests are run one at a time, which lets them use the client's local
+    # working directory and standard streams.
+    os.chdir(request['cwd'])
+    sys.stdin, sys.stdout, sys.stderr = (
+      client.stdin, client.stdout, client.stderr)
+    dispatch(client.fs, request['argv'])
+  except SystemExit as e:
+    status = e.code if isinstance(e.code, int) else 1
+  except Exception as e:
+    print('%s: %s' % (type(e).__name__, e), file=client.stderr)
+    status = 1
+  finally:
+    sys.stdin, sys.stdout, sys.stderr = streams
+    os.chdir(cwd)
+  client.finish(status)
+  return True
+
+
+def serve(fs, path, dispatch):
+  """Runs commands sent by clients until stopped or `fs` is aborted.
+
+  Args:
+    fs: SmugMugFS whose session is shared by all commands. Each command runs
+        with its own fork of it.
+    path: str, the Unix socket to listen on.
+    dispatch: function taking a SmugMugFS and a command's argv, and running it.
+  """
+  if not hasattr(socket, 'AF_UNIX'):
+    print('The daemon is not supported on this platform.')
+    return
+  if os.path.exists(path):
+    connection = _connect(path)
+    if connection:
+      connection.close()
+      print('A daemon is already listening on %s.' % path)
+      return
+    os.remove(path)  # Left over by a daemon that died.
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # Create the socket accessible to the user only: anyone connecting to it
+  # runs commands with the user's credentials.
+  umask = os.umask(0o177)
+  try:
+    server.bind(path)
+  except BaseException:
+    server.close()
+    raise
+  finally:
+    os.umask(umask)
+  try:
+    server.listen(16)
+    # Wake up regularly to notice when the daemon is aborted.
+    server.settimeout(1)
+    print('Listening on %s.' % path)
+    running = True
+    while running and not fs.aborting:
+      try:
+        sock, _ = server.accept()
+      except socket.timeout:
+        continue
+      sock.settimeout(None)
+      connection = _Connection(sock)
+      try:
+        running = _handle(connection, fs, dispatch)
+      except OSError:
+        pass  # The client went away.
+      finally:
+        connection.close()
+  finally:
+    server.close()
+    os.remove(path)
+
+
+def _connect(path):
+  if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+    return None
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except OSError:
+    sock.close()
+    return None
+  return _Connection(sock)
+
+
+def forward(args, command, path=None, stdin=None, stdout=None, stderr=None):
+  """Runs a command in the daemon, if one is running.
+
+  Args:
+    args: list of str, the command line arguments.
+    command: str, the command of `args`, not forwarded if in LOCAL_COMMANDS.
+    path: str, the daemon's socket. Defaults to `socket_path()`.
+    stdin, stdout, stderr: streams to use instead of the sys ones.
+
+  Returns:
+    The command's exit status, or None if it wasn't forwarded.
+  """
+  if command in LOCAL_COMMANDS:
+    return None
+  connection = _connect(path or socket_path())
+  if connection is None:
+    return None
+  stdin = stdin or sys.stdin
+  stdout = stdout or sys.stdout
+  stderr = stderr or sys.stderr
+  try:
+    connection.send({'argv': args, 'cwd': os.getcwd()})
+    while True:
+      try:
+        message = connection.receive()
+      except KeyboardInterrupt:
+        connection.send({'abort': 1})
+        continue
+      if message is None:
+        stderr.write('The smugcli daemon exited unexpectedly.\n')
+        return 1
+      if 'out' in message:
+        stdout.write(message['out'])
+        stdout.flush()
+      elif 'err' in message:
+        stderr.write(message['err'])
+        stderr.flush()
+      elif 'read' in message:
+        connection.send({'input': stdin.readline()})
+      elif 'exit' in message:
+        return message['exit']
+  finally:
+    connection.close()
+
+
+def stop(path):
+  """Asks the daemon listening on `path` to stop."""
+  connection = _connect(path)
+  if connection is None:
+    print('No daemon is listening on %s.' % path)
+    return
+  try:
+    connection.send({'stop': 1})
+    connection.receive()
+  finally:
+    connection.close()
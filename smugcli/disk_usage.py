@@ -0,0 +1,67 @@
+# Compact accumulators used to aggregate the space used by SmugMug nodes.
+
+import array
+
+FIELDS = ('size', 'images', 'videos', 'albums')
+
+
+class UsageTable(object):
+  """Table of usage counters, one row per folder or group.
+
+  Counters are stored column-wise in typed arrays rather than in per-row
+  objects, so that aggregating accounts with many folders keeps a small memory
+  footprint. Rows can optionally have a parent row, in which case `roll_up`
+  adds each row's counters to all of its ancestors.
+  """
+
+  def __init__(self):
+    self._rows = {}
+    self._keys = []
+    self._parents = array.array('l')
+    self._depths = array.array('l')
+    self._columns = [array.array('q') for _ in FIELDS]
+
+  def __len__(self):
+    return len(self._keys)
+
+  def row(self, key, parent=None):
+    """Returns the row index of `key`, adding a row for it if needed.
+
+    Args:
+      key: hashable, the key identifying the row.
+      parent: int, index of the parent row, if any. Parent rows must be added
+          before their children.
+    """
+    index = self._rows.get(key)
+    if index is None:
+      index = len(self._keys)
+      self._rows[key] = index
+      self._keys.append(key)
+      self._parents.append(-1 if parent is None else parent)
+      self._depths.append(0 if parent is None else self._depths[parent] + 1)
+      for column in self._columns:
+        column.append(0)
+    return index
+
+  def add_file(self, row, size, is_video):
+    self._columns[0][row] += size
+    self._columns[2 if is_video else 1][row] += 1
+
+  def add_album(self, row):
+    self._columns[3][row] += 1
+
+  def roll_up(self):
+    """Adds the counters of every row to its parent rows."""
+    # Children always come after their parents, so a single backward pass
+    # accumulates whole subtrees.
+    for index in range(len(self._keys) - 1, -1, -1):
+      parent = self._parents[index]
+      if parent >= 0:
+        for column in self._columns:
+          column[parent] += column[index]
+
+  def rows(self):
+    """Yields (key, depth, size, images, videos, albums) for every row."""
+    for index, key in enumerate(self._keys):
+      yield (key, self._depths[index]) + tuple(
+        column[index] for column in self._columns)
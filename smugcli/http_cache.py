@@ -0,0 +1,156 @@
+# On-disk cache of HTTP replies, revalidated with conditional requests.
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Default maximum size of the cache, in bytes.
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+
+class Entry(collections.namedtuple(
+    'Entry', ['etag', 'last_modified', 'body'])):
+  """A cached reply: its validators and body."""
+
+  def conditional_headers(self):
+    """Returns the headers revalidating this entry."""
+    headers = {}
+    if self.etag:
+      headers['If-None-Match'] = self.etag
+    if self.last_modified:
+      headers['If-Modified-Since'] = self.last_modified
+    return headers
+
+
+class HttpCache(object):
+  """Size-bounded cache of HTTP replies, stored as files in `directory`.
+
+  Only replies with an ETag or Last-Modified header are stored, so they can
+  be revalidated: an unchanged reply then costs a 304 response without body.
+  The cache may be shared by several processes (e.g. the daemon and one-off
+  commands): entries are looked up on disk, and the size is bounded by
+  scanning the directory. When the cache exceeds `max_bytes`, the least
+  recently used entries are evicted. Recency is kept in the files'
+  modification time, so it survives across runs.
+
+  The directory is scanned whenever the entries written since the last scan
+  could take the cache over `max_bytes`, and at least every
+  `max_bytes / SCAN_FRACTION` bytes written, so that the entries written by
+  other processes are accounted for too. Eviction then frees space down to
+  `LOW_WATER_MARK` of `max_bytes`, so that a full cache isn't scanned again
+  on every write.
+
+  Args:
+    directory: str, where to store the cache, created if needed.
+    max_bytes: int, the maximum size of the cache.
+  """
+
+  SCAN_FRACTION = 10
+  LOW_WATER_MARK = 0.9
+
+  def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+    self._directory = directory
+    self._max_bytes = max_bytes
+    self._mutex = threading.Lock()
+    # Size of the cache at the last scan, None if not scanned yet.
+    self._scanned_bytes = None
+    # Bytes written since the last scan.
+    self._written_bytes = 0
+
+  def _path(self, key):
+    return os.path.join(
+      self._directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+  def _scan(self):
+    """Returns [(mtime, name, size)] of the entries, oldest first."""
+    entries = []
+    try:
+      for entry in os.scandir(self._directory):
+        # Skip the files being written.
+        if entry.name.endswith('.tmp'):
+          continue
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue  # Removed by another process meanwhile.
+        entries.append((stat.st_mtime, entry.name, stat.st_size))
+    except FileNotFoundError:
+      pass
+    return sorted(entries)
+
+  def get(self, key):
+    """Returns the Entry cached for `key`, or None."""
+    path = self._path(key)
+    try:
+      with open(path) as f:
+        data = json.load(f)
+      os.utime(path)
+    except FileNotFoundError:
+      return None
+    except (IOError, ValueError):
+      self._remove(os.path.basename(path))
+      return None
+    return Entry(data.get('etag'), data.get('last_modified'), data['body'])
+
+  def put(self, key, etag, last_modified, body):
+    """Caches the reply `body` for `key`, with its validators."""
+    if not etag and not last_modified:
+      return
+    # The key is only stored hashed, in the file name, as it may be sensitive.
+    data = json.dumps({'etag': etag,
+                       'last_modified': last_modified, 'body': body})
+    size = len(data.encode('utf-8'))
+    if size > self._max_bytes:
+      return
+    os.makedirs(self._directory, mode=0o700, exist_ok=True)
+    # Write atomically, as other processes may use the same cache.
+    fd, temp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w') as f:
+        f.write(data)
+      os.replace(temp_path, self._path(key))
+    except BaseException:
+      os.remove(temp_path)
+      raise
+    with self._mutex:
+      self._written_bytes += size
+      if (self._scanned_bytes is None or
+          self._scanned_bytes + self._written_bytes > self._max_bytes or
+          self._written_bytes * self.SCAN_FRACTION > self._max_bytes):
+        self._evict()
+
+  def _evict(self):
+    entries = self._scan()
+    total_bytes = sum(size for _, _, size in entries)
+    if total_bytes <= self._max_bytes:
+      target_bytes = self._max_bytes
+    else:
+      target_bytes = self._max_bytes * self.LOW_WATER_MARK
+    for _, name, size in entries:
+      if total_bytes <= target_bytes:
+        break
+      self._remove(name)
+      total_bytes -= size
+    self._scanned_bytes = total_bytes
+    self._written_bytes = 0
+
+  def clear(self):
+    """Removes all the entries."""
+    with self._mutex:
+      for _, name, _ in self._scan():
+        self._remove(name)
+      self._scanned_bytes = 0
+      self._written_bytes = 0
+
+  def size(self):
+    """Returns the size of the cache, in bytes."""
+    return sum(size for _, _, size in self._scan())
+
+  def _remove(self, name):
+    try:
+      os.remove(os.path.join(self._directory, name))
+    except OSError:
+      pass
@@ -0,0 +1,283 @@
+# Background jobs of the interactive shell. Commands run in a background thread
+# sharing the shell's SmugMug session, and their output is captured per job
+# instead of being written to the terminal.
+
+import collections
+import sys
+import threading
+import time
+import traceback
+
+# Number of output lines kept per job.
+DEFAULT_MAX_OUTPUT_LINES = 1000
+
+_local = threading.local()
+
+
+def current():
+  """Returns the job the calling thread works for, or None."""
+  return getattr(_local, 'job', None)
+
+
+def set_current(job):
+  _local.job = job
+
+
+def bind(func):
+  """Returns `func` wrapped to run on behalf of the caller's current job.
+
+  Threads started to help a job (e.g. thread pool workers) use this so that
+  their output is routed to that job too.
+  """
+  job = current()
+  def wrapper(*args, **kwargs):
+    set_current(job)
+    return func(*args, **kwargs)
+  return wrapper
+
+
+class StdoutRouter(object):
+  """Replacement for sys.stdout routing writes according to the current job.
+
+  Writes from threads working for a job go to that job's output, the others
+  to the real stdout. Objects taking over stdout (see `push_stdout`) only do so
+  for the job they were installed from.
+  """
+
+  def __init__(self, stdout):
+    self._stdout = stdout
+    self._overrides = {}
+    self._mutex = threading.Lock()
+
+  @property
+  def stdout(self):
+    return self._stdout
+
+  def target(self):
+    job = current()
+    with self._mutex:
+      stack = self._overrides.get(job)
+      if stack:
+        return stack[-1]
+    return job if job is not None else self._stdout
+
+  def push(self, stream):
+    previous = self.target()
+    with self._mutex:
+      self._overrides.setdefault(current(), []).append(stream)
+    return previous
+
+  def pop(self):
+    job = current()
+    with self._mutex:
+      stack = self._overrides[job]
+      stack.pop()
+      if not stack:
+        del self._overrides[job]
+
+  def write(self, string):
+    return self.target().write(string)
+
+  def flush(self):
+    self.target().flush()
+
+  def __getattr__(self, name):
+    return getattr(self._stdout, name)
+
+
+def push_stdout(stream):
+  """Redirects stdout to `stream`, for the current job only if in the shell.
+
+  Returns:
+    The stream previously used, to which `stream` should forward its output.
+  """
+  if isinstance(sys.stdout, StdoutRouter):
+    return sys.stdout.push(stream)
+  previous = sys.stdout
+  sys.stdout = stream
+  return previous
+
+
+def restore_stdout(previous):
+  """Undoes `push_stdout`, given the stream it returned."""
+  if isinstance(sys.stdout, StdoutRouter):
+    sys.stdout.pop()
+  else:
+    sys.stdout = previous
+
+
+class Job(object):
+  """A command running in the background.
+
+  The job doubles as the output stream of its command, keeping the last
+  `max_lines` lines printed, or all of them if `max_lines` is None.
+  """
+
+  def __init__(self, job_id, command, fs, max_lines):
+    self.id = job_id
+    self.command = command
+    self.fs = fs
+    self.state = 'queued'
+    self.start_time = None
+    self.end_time = None
+    self.task_manager = None
+    self.killed = False
+    self.reported = False
+    self._lines = collections.deque(maxlen=max_lines)
+    self._line_count = 0
+    self._partial = ''
+    self._cond = threading.Condition()
+
+  @property
+  def finished(self):
+    return self.state in ('done', 'killed', 'failed')
+
+  def elapsed(self):
+    if self.start_time is None:
+      return 0
+    return (self.end_time or time.time()) - self.start_time
+
+  def write(self, string):
+    if isinstance(string, bytes):
+      string = string.decode('utf-8')
+    with self._cond:
+      lines = (self._partial + string).replace('\r\n', '\n').split('\n')
+      self._partial = lines.pop()
+      for line in lines:
+        self._lines.append(line)
+        self._line_count += 1
+      if lines:
+        self._cond.notify_all()
+
+  def flush(self):
+    pass
+
+  def read_output(self, start):
+    """Returns (lines, next) with the lines printed since line `start`.
+
+    Lines dropped because of the output limit are skipped.
+    """
+    with self._cond:
+      first = self._line_count - len(self._lines)
+      lines = list(self._lines)[max(0, start - first):]
+      return lines, self._line_count
+
+  def progress(self):
+    """Returns the status lines of the tasks currently in progress."""
+    manager = self.task_manager
+    return manager.get_status_lines() if manager else []
+
+  def wait(self, timeout):
+    """Waits until new output is available or the job finished."""
+    with self._cond:
+      if not self.finished:
+        self._cond.wait(timeout)
+
+  def join(self):
+    """Waits until the job finished."""
+    with self._cond:
+      while not self.finished:
+        # Wait with a timeout to allow for ctrl-C interrupts.
+        self._cond.wait(1)
+
+  def _set_state(self, state):
+    with self._cond:
+      self.state = state
+      if self.finished:
+        if self._partial:
+          self._lines.append(self._partial)
+          self._line_count += 1
+          self._partial = ''
+        self.end_time = time.time()
+      self._cond.notify_all()
+
+
+class JobManager(object):
+  """Starts and keeps track of background jobs.
+
+  At most `max_running` jobs run at the same time, the others are queued.
+
+  Args:
+    max_running: int, maximum number of jobs running concurrently.
+    max_lines: int, number of output lines kept per job, None to keep them
+        all.
+  """
+
+  def __init__(self, max_running, max_lines=DEFAULT_MAX_OUTPUT_LINES):
+    self._slots = threading.Semaphore(max(1, max_running))
+    self._max_lines = max_lines
+    self._jobs = collections.OrderedDict()
+    self._next_id = 1
+    self._mutex = threading.Lock()
+
+  def start(self, command, func, fs, after=()):
+    """Runs `func(fs)` in a new background job.
+
+    Args:
+      command: str, the command line, for display.
+      func: function taking the SmugMugFS to run the command with.
+      fs: SmugMugFS dedicated to the job, so that it can be aborted on its own.
+      after: list of Jobs which must finish before this one starts.
+
+    Returns:
+      The started Job.
+    """
+    with self._mutex:
+      job = Job(self._next_id, command, fs, self._max_lines)
+      self._next_id += 1
+      self._jobs[job.id] = job
+    thread = threading.Thread(target=self._run, args=(job, func, after))
+    thread.daemon = True
+    thread.start()
+    return job
+
+  def jobs(self):
+    with self._mutex:
+      return list(self._jobs.values())
+
+  def get(self, job_id=None):
+    """Returns the job with the given id, or the latest one, or None."""
+    with self._mutex:
+      if job_id is None:
+        return next(reversed(self._jobs.values()), None)
+      return self._jobs.get(job_id)
+
+  def kill(self, job):
+    job.killed = True
+    job.fs.abort()
+
+  def reap(self):
+    """Returns the jobs which finished since the last call.
+
+    Finished jobs are kept until removed, so that their output can be read.
+    """
+    with self._mutex:
+      finished = [job for job in self._jobs.values()
+                  if job.finished and not job.reported]
+      for job in finished:
+        job.reported = True
+      return finished
+
+  def remove(self, job):
+    with self._mutex:
+      self._jobs.pop(job.id, None)
+
+  def _run(self, job, func, after):
+    set_current(job)
+    for other in after:
+      other.join()
+    with self._slots:
+      if job.killed:
+        job._set_state('killed')
+        return
+      job.start_time = time.time()
+      job._set_state('running')
+      state = 'done'
+      try:
+        func(job.fs)
+      except SystemExit:
+        pass
+      except Exception:
+        job.write(traceback.format_exc())
+        state = 'failed'
+      job._set_state('killed' if job.killed else state)
@@ -0,0 +1,330 @@
+# Counters, histograms and gauges describing what smugcli does, written
+# periodically in Prometheus textfile format and as a JSON summary.
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Default interval, in seconds, between two writes of the metrics files.
+DEFAULT_INTERVAL = 60
+
+
+def _label_key(label_names, labels):
+  if set(labels) != set(label_names):
+    raise ValueError('Expected labels %s, got %s' % (
+      sorted(label_names), sorted(labels)))
+  return tuple(str(labels[name]) for name in label_names)
+
+
+def _escape(value):
+  return (value.replace('\\', '\\\\').replace('\n', '\\n')
+          .replace('"', '\\"'))
+
+
+def _format_labels(pairs):
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                           for name, value in pairs)
+
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  if isinstance(value, float) and value.is_integer():
+    return repr(int(value))
+  return repr(value)
+
+
+class _Metric(object):
+  TYPE = None
+
+  def __init__(self, name, help, label_names=()):
+    self.name = name
+    self.help = help
+    self.label_names = tuple(label_names)
+    self._values = {}
+    self._mutex = threading.Lock()
+
+  def samples(self):
+    """Returns [(name suffix, [(label, value)], value)]."""
+    with self._mutex:
+      items = sorted(self._values.items())
+    samples = []
+    for key, value in items:
+      samples.extend(self._samples(list(zip(self.label_names, key)), value))
+    return samples
+
+  def _samples(self, labels, value):
+    return [('', labels, value)]
+
+  def summary(self):
+    """Returns the metric's values, as a JSON serializable list."""
+    with self._mutex:
+      items = sorted(self._values.items())
+    return [dict(self._summary(value), labels=dict(zip(self.label_names, key)))
+            for key, value in items]
+
+  def _summary(self, value):
+    return {'value': value}
+
+
+class Counter(_Metric):
+  """A value which only goes up, e.g. a number of files."""
+  TYPE = 'counter'
+
+  def inc(self, value=1, **labels):
+    key = _label_key(self.label_names, labels)
+    with self._mutex:
+      self._values[key] = self._values.get(key, 0) + value
+
+  def get(self, **labels):
+    with self._mutex:
+      return self._values.get(_label_key(self.label_names, labels), 0)
+
+
+class Gauge(_Metric):
+  """A value which goes up and down, possibly read from a function."""
+  TYPE = 'gauge'
+
+  def set(self, value, **labels):
+    key = _label_key(self.label_names, labels)
+    with self._mutex:
+      self._values[key] = value
+
+  def set_function(self, func, **labels):
+    """Reads the value from `func()` each time the metrics are written."""
+    self.set(func, **labels)
+
+  def remove(self, **labels):
+    key = _label_key(self.label_names, labels)
+    with self._mutex:
+      self._values.pop(key, None)
+
+  def _samples(self, labels, value):
+    return [('', labels, value() if callable(value) else value)]
+
+  def _summary(self, value):
+    return {'value': value() if callable(value) else value}
+
+
+class Histogram(_Metric):
+  """Distribution of observed values, e.g. durations, in buckets."""
+  TYPE = 'histogram'
+
+  def __init__(self, name, help, label_names=(), buckets=()):
+    super(Histogram, self).__init__(name, help, label_names)
+    self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+  def observe(self, value, **labels):
+    key = _label_key(self.label_names, labels)
+    with self._mutex:
+      counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+      counts = list(counts)
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+          break
+      self._values[key] = (counts, total + value)
+
+  def _cumulative(self, counts):
+    cumulative = []
+    running = 0
+    for count in counts:
+      running += count
+      cumulative.append(running)
+    return cumulative
+
+  def _samples(self, labels, value):
+    counts, total = value
+    cumulative = self._cumulative(counts)
+    samples = [('_bucket', labels + [('le', _format_value(float(bound)))],
+                count)
+               for bound, count in zip(self.buckets, cumulative)]
+    samples.append(('_sum', labels, total))
+    samples.append(('_count', labels, cumulative[-1]))
+    return samples
+
+  def _summary(self, value):
+    counts, total = value
+    cumulative = self._cumulative(counts)
+    return {'count': cumulative[-1],
+            'sum': total,
+            'buckets': {_format_value(float(bound)): count
+                        for bound, count in zip(self.buckets, cumulative)}}
+
+
+class Registry(object):
+  """Set of metrics, rendered together."""
+
+  def __init__(self):
+    self._metrics = {}
+    self._mutex = threading.Lock()
+
+  def _get_or_create(self, cls, name, *args, **kwargs):
+    with self._mutex:
+      metric = self._metrics.get(name)
+      if metric is None:
+        metric = self._metrics[name] = cls(name, *args, **kwargs)
+      elif not isinstance(metric, cls):
+        raise ValueError('Metric %s already registered as a %s' % (
+          name, metric.TYPE))
+      return metric
+
+  def counter(self, name, help, label_names=()):
+    return self._get_or_create(Counter, name, help, label_names)
+
+  def gauge(self, name, help, label_names=()):
+    return self._get_or_create(Gauge, name, help, label_names)
+
+  def histogram(self, name, help, label_names=(), buckets=()):
+    return self._get_or_create(Histogram, name, help, label_names,
+                               buckets=buckets)
+
+  def _sorted_metrics(self):
+    with self._mutex:
+      return [self._metrics[name] for name in sorted(self._metrics)]
+
+  def render(self):
+    """Returns the metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in self._sorted_metrics():
+      lines.append('# HELP %s %s' % (metric.name, metric.help))
+      lines.append('# TYPE %s %s' % (metric.name, metric.TYPE))
+      for suffix, labels, value in metric.samples():
+        lines.append('%s%s%s %s' % (metric.name, suffix,
+                                    _format_labels(labels),
+                                    _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+  def summary(self):
+    """Returns the metrics as a JSON serializable dict."""
+    return {metric.name: {'type': metric.TYPE,
+                          'help': metric.help,
+                          'values': metric.summary()}
+            for metric in self._sorted_metrics()}
+
+
+# The metrics updated by smugcli.
+REGISTRY = Registry()
+
+SYNC_FILES = REGISTRY.counter(
+  'smugcli_sync_files_total',
+  'Local files processed by sync, by action: scanned, hashed, skipped, '
+  'uploaded or reuploaded.',
+  ['action'])
+SYNC_BYTES = REGISTRY.counter(
+  'smugcli_sync_bytes_total',
+  'Bytes read from local files and sent to SmugMug by sync.',
+  ['direction'])
+UPLOAD_SIZE = REGISTRY.histogram(
+  'smugcli_upload_size_bytes',
+  'Size of the files uploaded by sync.',
+  buckets=[2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 24, 2 ** 26, 2 ** 28,
+           2 ** 30])
+API_CALLS = REGISTRY.counter(
+  'smugcli_api_calls_total',
+  'Calls made to SmugMug, by method, endpoint and status.',
+  ['method', 'endpoint', 'status'])
+API_CALL_DURATION = REGISTRY.histogram(
+  'smugcli_api_call_duration_seconds',
+  'Duration of the calls made to SmugMug, including retries.',
+  ['method', 'endpoint'],
+  buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300])
+API_RETRIES = REGISTRY.counter(
+  'smugcli_api_retries_total',
+  'Retries of calls made to SmugMug, by method and endpoint.',
+  ['method', 'endpoint'])
+API_BYTES = REGISTRY.counter(
+  'smugcli_api_bytes_total',
+  'Bytes of request and response bodies exchanged with SmugMug.',
+  ['direction'])
+THREAD_POOL_QUEUE_DEPTH = REGISTRY.gauge(
+  'smugcli_thread_pool_queue_depth',
+  'Tasks waiting in each thread pool.',
+  ['pool'])
+LAST_UPDATE = REGISTRY.gauge(
+  'smugcli_metrics_last_update_timestamp_seconds',
+  'When the metrics were last written.')
+
+
+class SpanExporter(object):
+  """Tracing exporter counting the API calls in the metrics."""
+
+  def export(self, span):
+    status = span.status if span.status is not None else (
+      span.error or 'unknown')
+    API_CALLS.inc(method=span.method, endpoint=span.endpoint, status=status)
+    API_CALL_DURATION.observe(span.total or 0, method=span.method,
+                              endpoint=span.endpoint)
+    if span.retries:
+      API_RETRIES.inc(span.retries, method=span.method,
+                      endpoint=span.endpoint)
+    API_BYTES.inc(span.bytes_out, direction='sent')
+    API_BYTES.inc(span.bytes_in, direction='received')
+
+
+def _write_atomically(path, content):
+  # node_exporter must never read a partially written file.
+  directory = os.path.dirname(os.path.abspath(path))
+  fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'w') as f:
+      f.write(content)
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+  except BaseException:
+    os.remove(temp_path)
+    raise
+
+
+class MetricsWriter(object):
+  """Writes the metrics every `interval` seconds, and when stopped.
+
+  Args:
+    registry: Registry, the metrics to write.
+    textfile: str, optional path of the Prometheus textfile to write, which
+        should end in ".prom" for node_exporter to pick it up.
+    json_file: str, optional path of the JSON summary to write.
+    interval: float, seconds between two writes.
+  """
+
+  def __init__(self, registry, textfile=None, json_file=None,
+               interval=DEFAULT_INTERVAL):
+    self._registry = registry
+    self._textfile = textfile
+    self._json_file = json_file
+    self._interval = interval
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def write(self):
+    LAST_UPDATE.set(time.time())
+    if self._textfile:
+      _write_atomically(self._textfile, self._registry.render())
+    if self._json_file:
+      _write_atomically(self._json_file, json.dumps(
+        self._registry.summary(), sort_keys=True, indent=2))
+
+  def _run(self):
+    while not self._stopped.wait(self._interval):
+      self.write()
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stopped.set()
+    if self._thread:
+      self._thread.join()
+    self.write()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.stop()
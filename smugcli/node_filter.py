@@ -0,0 +1,120 @@
+# Predicates on SmugMug node metadata, used by the `find` command.
+
+import fnmatch
+import re
+
+SIZE_RE = re.compile(r'^([+-]?)([0-9]+)([kKmMgGtT]?)$')
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+DATE_RE = re.compile(r'^[0-9]{4}(-[0-9]{2}(-[0-9]{2})?)?$')
+
+NODE_TYPES = ['folder', 'album', 'file', 'image', 'video']
+CONTAINER_TYPES = {'Folder': 'folder', 'Album': 'album',
+                   'System Album': 'album'}
+
+
+class Error(Exception):
+  """Base class for all exception of this module."""
+
+
+class InvalidPredicateError(Error):
+  """Error raised when a predicate argument cannot be parsed."""
+
+
+def node_type(node):
+  """Returns the type of `node`, as one of `NODE_TYPES`."""
+  if 'FileName' in node:
+    return 'video' if node.json.get('IsVideo') else 'image'
+  return CONTAINER_TYPES.get(node.json.get('Type'), 'folder')
+
+
+def parse_size(value):
+  """Parses a find-style size predicate: [+|-]N[K|M|G|T].
+
+  Returns:
+    A function taking a size in bytes and returning whether it matches.
+  """
+  match = SIZE_RE.match(value)
+  if not match:
+    raise InvalidPredicateError('Invalid size "%s".' % value)
+  sign, number, unit = match.groups()
+  size = int(number) * SIZE_UNITS[unit.lower()]
+  if sign == '+':
+    return lambda s: s > size
+  if sign == '-':
+    return lambda s: s < size
+  return lambda s: s == size
+
+
+class NodeFilter(object):
+  """Matches nodes against a set of metadata predicates.
+
+  All specified predicates must match. Beside `matches`, the filter tells
+  through `should_descend` which subtrees can't possibly contain matches, so
+  that they don't need to be listed at all.
+
+  Args:
+    name: str, glob pattern the node name must match.
+    regex: str, regular expression the node name must fully match.
+    type: str, one of `NODE_TYPES`.
+    size: str, size predicate, see `parse_size`. Only files can match.
+    newer: str, date (YYYY[-MM[-DD]]) on or after which nodes were uploaded.
+    older: str, date (YYYY[-MM[-DD]]) before which nodes were uploaded.
+    md5: str, MD5 hex digest of the original file. Only files can match.
+    max_depth: int, maximum depth of matches below the starting nodes.
+  """
+
+  def __init__(self, name=None, regex=None, type=None, size=None, newer=None,
+               older=None, md5=None, max_depth=None):
+    for date in (newer, older):
+      if date is not None and not DATE_RE.match(date):
+        raise InvalidPredicateError(
+          'Invalid date "%s", expected YYYY[-MM[-DD]].' % date)
+    self._name = re.compile(fnmatch.translate(name)) if name else None
+    self._regex = re.compile(regex) if regex else None
+    self._type = type
+    self._size = parse_size(size) if size else None
+    self._newer = newer
+    self._older = older
+    self._md5 = md5.lower() if md5 else None
+    self._max_depth = max_depth
+    self._files_only = bool(size or md5 or type in ('file', 'image', 'video'))
+
+  def matches(self, node):
+    """Returns whether `node` matches all predicates."""
+    kind = node_type(node)
+    if self._type and not (self._type == kind or
+                           (self._type == 'file' and
+                            kind in ('image', 'video'))):
+      return False
+    if self._files_only and kind not in ('image', 'video'):
+      return False
+    if self._name and not self._name.match(node.name):
+      return False
+    if self._regex and not self._regex.fullmatch(node.name):
+      return False
+    if self._size and not self._size(node.json.get('ArchivedSize') or 0):
+      return False
+    if self._md5 and (node.json.get('ArchivedMD5') or '').lower() != self._md5:
+      return False
+    if self._newer or self._older:
+      date = node.json.get('Date') or node.json.get('DateAdded') or ''
+      if self._newer and date[:len(self._newer)] < self._newer:
+        return False
+      if self._older and date[:len(self._older)] >= self._older:
+        return False
+    return True
+
+  def should_descend(self, node, depth):
+    """Returns whether the children of `node` can contain matches.
+
+    Args:
+      node: Node, a folder or album.
+      depth: int, depth of `node` below the starting node.
+    """
+    if self._max_depth is not None and depth >= self._max_depth:
+      return False
+    # Albums only contain files.
+    if node_type(node) == 'album' and self._type in ('folder', 'album'):
+      return False
+    return True
+
@@ -0,0 +1,167 @@
+# Profiling of whole commands, worker threads included, producing a pstats
+# file and a collapsed-stack file for flame graphs.
+
+import collections
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import threading
+
+DETERMINISTIC = 'deterministic'
+SAMPLING = 'sampling'
+MODES = (DETERMINISTIC, SAMPLING)
+
+# Default interval between two samples, in seconds.
+DEFAULT_INTERVAL = 0.01
+
+
+def _frame_key(code):
+  """Returns the pstats key of a code object."""
+  return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _frame_label(key):
+  filename, line, name = key
+  return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+
+class Sampler(object):
+  """Periodically samples the stacks of all threads.
+
+  Sampling costs one walk of the thread stacks per interval, whatever the
+  threads do, which is cheap enough to leave enabled on long runs.
+  """
+
+  def __init__(self, interval=DEFAULT_INTERVAL):
+    self._interval = interval
+    self._stacks = collections.Counter()
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def _sample(self):
+    own_id = threading.get_ident()
+    for thread_id, frame in sys._current_frames().items():
+      if thread_id == own_id:
+        continue
+      stack = []
+      while frame is not None:
+        stack.append(_frame_key(frame.f_code))
+        frame = frame.f_back
+      stack.reverse()
+      self._stacks[tuple(stack)] += 1
+
+  def _run(self):
+    while not self._stopped.wait(self._interval):
+      self._sample()
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stopped.set()
+    if self._thread:
+      self._thread.join()
+
+  def collapsed_lines(self):
+    """Returns the stacks in collapsed format, "root;...;leaf count"."""
+    return ['%s %d' % (';'.join(_frame_label(key) for key in stack), count)
+            for stack, count in sorted(self._stacks.items())]
+
+  def stats(self):
+    """Returns the samples as a pstats dict, times being estimated."""
+    stats = {}
+    def entry(key):
+      if key not in stats:
+        # (primitive calls, calls, own time, cumulative time, callers)
+        stats[key] = [0, 0, 0.0, 0.0, {}]
+      return stats[key]
+    for stack, count in self._stacks.items():
+      duration = count * self._interval
+      for key in set(stack):
+        function = entry(key)
+        function[0] += count
+        function[1] += count
+        function[3] += duration
+      entry(stack[-1])[2] += duration
+      for caller, callee in set(zip(stack, stack[1:])):
+        callers = entry(callee)[4]
+        nc, cc, tt, ct = callers.get(caller, (0, 0, 0.0, 0.0))
+        callers[caller] = (nc + count, cc + count, tt, ct + duration)
+    return {key: tuple(value) for key, value in stats.items()}
+
+
+class Profiler(object):
+  """Profiles all the threads of the process.
+
+  In DETERMINISTIC mode, every function call is recorded by cProfile. Before
+  Python 3.12, cProfile only sees the thread enabling it, so each thread
+  started while profiling gets its own profiler and their stats are merged.
+  A profiler may only be stopped by its own thread, so those of the threads
+  still running when writing the profile (e.g. daemon threads) are left out.
+  Call stacks are sampled too, for the collapsed-stack file. In SAMPLING mode,
+  only stacks are sampled, and the pstats file is derived from the samples.
+
+  Args:
+    mode: str, one of MODES.
+    interval: float, seconds between two stack samples.
+  """
+
+  def __init__(self, mode=DETERMINISTIC, interval=DEFAULT_INTERVAL):
+    self._mode = mode
+    self._sampler = Sampler(interval)
+    # (thread, profile) pairs, the main thread's first.
+    self._profiles = []
+    self._mutex = threading.Lock()
+
+  def _profile_thread(self, frame, event, arg):
+    # Called once in each new thread, the thread's profiler then takes over.
+    profile = cProfile.Profile()
+    with self._mutex:
+      self._profiles.append((threading.current_thread(), profile))
+    profile.enable()
+
+  def start(self):
+    # Started first, so that the sampler thread itself isn't profiled.
+    self._sampler.start()
+    if self._mode == DETERMINISTIC:
+      if sys.version_info < (3, 12):
+        threading.setprofile(self._profile_thread)
+      profile = cProfile.Profile()
+      self._profiles.append((threading.current_thread(), profile))
+      profile.enable()
+
+  def stop(self):
+    self._sampler.stop()
+    if self._mode == DETERMINISTIC:
+      self._profiles[0][1].disable()
+      if sys.version_info < (3, 12):
+        threading.setprofile(None)
+
+  def write(self, prefix):
+    """Writes the profile to PREFIX.pstats and PREFIX.collapsed.
+
+    Returns:
+      The paths of the files written.
+    """
+    pstats_path = prefix + '.pstats'
+    collapsed_path = prefix + '.collapsed'
+    if self._mode == DETERMINISTIC:
+      with self._mutex:
+        profiles = list(self._profiles)
+      # Collecting the stats disables the profiler from the calling thread,
+      # which only is safe once the profiled thread is done with it.
+      stats = pstats.Stats(profiles[0][1])
+      for thread, profile in profiles[1:]:
+        if not thread.is_alive():
+          stats.add(profile)
+      stats.dump_stats(pstats_path)
+    else:
+      with open(pstats_path, 'wb') as f:
+        marshal.dump(self._sampler.stats(), f)
+    with open(collapsed_path, 'w') as f:
+      for line in self._sampler.collapsed_lines():
+        f.write(line + '\n')
+    return pstats_path, collapsed_path
@@ -0,0 +1,36 @@
+# Typed results of the SmugMugFS operations, for using smugcli as a library.
+# The command line interface prints these, see the `iter_*` methods of
+# SmugMugFS.
+
+import collections
+
+# A group of nodes listed by `ls`. `directory` is the folder or album whose
+# children are listed, or None for nodes matched by the listed path itself.
+Listing = collections.namedtuple('Listing', ['directory', 'nodes'])
+
+# Outcome of removing a node, `status` being one of the values below.
+Removal = collections.namedtuple('Removal', ['path', 'node', 'status'])
+
+REMOVED = 'removed'
+NOT_EMPTY = 'not empty'
+DECLINED = 'declined'
+
+# Outcome of downloading a node to the local file `path`.
+Transfer = collections.namedtuple(
+  'Transfer', ['node', 'url', 'path', 'size', 'status'])
+
+DOWNLOADED = 'downloaded'
+ALREADY_EXISTS = 'already exists'
+NOT_A_FILE = 'not a file'
+
+# Action taken by sync. `remote_path` is the album (for FOUND_ALBUM) or file
+# the action applies to, `node` the album node and `size` the number of bytes
+# uploaded, if any.
+SyncAction = collections.namedtuple(
+  'SyncAction', ['action', 'local_path', 'remote_path', 'node', 'size'])
+
+FOUND_ALBUM = 'found album'
+UNCHANGED = 'unchanged'
+CHANGED = 'changed'
+UPLOADED = 'uploaded'
+REUPLOADED = 're-uploaded'
@@ -1,16 +1,25 @@
 #!/usr/bin/python
 # Command line tool for SmugMug. Uses SmugMug API V2.
 
+from . import batch
+from . import daemon
+from . import http_cache as http_cache_lib
+from . import metrics
+from . import node_filter
 from . import persistent_dict
+from . import profiling
 from . import smugmug as smugmug_lib
 from . import smugmug_fs
-from . import smugmug_shell
+from . import state_dump
+from . import tracing
 from . import version
 
 import argparse
 import atexit
 import collections
+import contextlib
 import inspect
+import io
 import json
 import os
 import signal
@@ -19,6 +28,7 @@ import sys
 
 
 CONFIG_FILE = os.path.expanduser('~/.smugcli')
+CACHE_DIR = os.path.expanduser('~/.smugcli.d')
 
 if six.PY3:
   def arg_str_type(string):
@@ -28,7 +38,8 @@ else:
     return six.text_type(string, 'utf8')
 
 
-def run(args, config=None, requests_sent=None):
+def run(args, config=None, requests_sent=None, prewarm=False,
+        cache_dir=None):
   try:
     config = config or persistent_dict.PersistentDict(CONFIG_FILE)
   except persistent_dict.InvalidFileError:
@@ -36,7 +47,16 @@ def run(args, config=None, requests_sent=None):
           'Please fix or delete the file.' % CONFIG_FILE)
     return
 
-  smugmug = smugmug_lib.SmugMug(config, requests_sent)
+  http_cache = None
+  max_cache_bytes = config.get('http_cache_size',
+                               http_cache_lib.DEFAULT_MAX_BYTES)
+  if cache_dir and max_cache_bytes > 0:
+    http_cache = http_cache_lib.HttpCache(
+      os.path.join(cache_dir, 'http_cache'), max_cache_bytes)
+  smugmug = smugmug_lib.SmugMug(config, requests_sent, http_cache)
+  if prewarm:
+    # Connect while the arguments are parsed and the command gets ready.
+    smugmug.prewarm()
   fs = smugmug_fs.SmugMugFS(smugmug)
 
   def signal_handler(signum, frame):
@@ -50,20 +70,96 @@ def run(args, config=None, requests_sent=None):
   signal.signal(signal.SIGINT, signal_handler)
   signal.signal(signal.SIGABRT, signal_handler)
   signal.signal(signal.SIGTERM, signal_handler)
+  # `kill -USR1 <pid>` dumps what the worker threads are doing.
+  state_dump.install(config.get('state_dump_file'))
 
+  dispatch(fs, make_parser(config), args)
+
+
+def add_global_arguments(parser, config):
+  """Adds the options preceding the command to `parser`."""
+  parser.add_argument('-V', '--version',
+                      action='store_true',
+                      help='Show version and exit.')
+  parser.add_argument('--trace',
+                      metavar='FILE',
+                      help='Append a JSON line describing each request '
+                           'sent to SmugMug (timings, sizes, status...) '
+                           'to FILE.')
+  parser.add_argument('--trace_summary',
+                      action='store_true',
+                      help='Print a summary of the requests sent to '
+                           'SmugMug, per endpoint, once done.')
+  parser.add_argument('--profile',
+                      action='store_true',
+                      help='Profile the command, worker threads '
+                           'included, writing a pstats file and a '
+                           'collapsed-stack file for flame graphs.')
+  parser.add_argument('--profile_mode',
+                      choices=profiling.MODES,
+                      default=profiling.DETERMINISTIC,
+                      help='"deterministic" records every function '
+                           'call, "sampling" periodically samples the '
+                           'threads\' stacks, which is cheap enough for '
+                           'production runs.')
+  parser.add_argument('--profile_output',
+                      metavar='PREFIX',
+                      default='smugcli-profile',
+                      help='Write the profile to PREFIX.pstats and '
+                           'PREFIX.collapsed.')
+  parser.add_argument('--metrics_textfile',
+                      metavar='FILE',
+                      help='Periodically write metrics (files synced, '
+                           'bytes sent, API calls...) to FILE, in '
+                           'Prometheus textfile format. For the '
+                           'node_exporter textfile collector, FILE must '
+                           'end in ".prom".')
+  parser.add_argument('--metrics_json',
+                      metavar='FILE',
+                      help='Periodically write the metrics to FILE, as '
+                           'a JSON summary.')
+  parser.add_argument('--metrics_interval',
+                      type=float,
+                      metavar='SECONDS',
+                      default=config.get('metrics_interval',
+                                         metrics.DEFAULT_INTERVAL),
+                      help='How often the metrics files are written. '
+                           'They are also written once done.')
+
+
+def command_name(args):
+  """Returns the command of a command line, or None if there is none.
+
+  The global options are parsed, so that the values of those taking one
+  (e.g. "--trace FILE") aren't mistaken for the command.
+  """
+  parser = argparse.ArgumentParser(add_help=False)
+  add_global_arguments(parser, {})
+  try:
+    with contextlib.redirect_stderr(io.StringIO()):
+      _, remaining = parser.parse_known_args(args)
+  except SystemExit:
+    return None
+  return next((arg for arg in remaining if not arg.startswith('-')), None)
+
+
+def make_parser(config):
+  """Returns the parser of all commands.
+
+  Each command's `func` default takes the SmugMugFS to run with and the parsed
+  arguments. `config` provides the defaults of some arguments.
+  """
   main_parser = argparse.ArgumentParser(
     description='SmugMug commandline interface.')
   subparsers = main_parser.add_subparsers(title='sub commands')
 
-  # ---------------
-  main_parser.add_argument('-V', '--version',
-                           action='store_true',
-                           help='Show version and exit.')
+  add_global_arguments(main_parser, config)
 
   # ---------------
   login_parser = subparsers.add_parser(
     'login', help='Login to the SmugMug service')
-  login_parser.set_defaults(func=lambda a: fs.smugmug.login((a.key, a.secret)))
+  login_parser.set_defaults(
+    func=lambda fs, a: fs.smugmug.login((a.key, a.secret)))
   login_parser.add_argument('-k', '--key',
                             type=arg_str_type,
                             required=True,
@@ -75,12 +171,12 @@ def run(args, config=None, requests_sent=None):
   # ---------------
   logout_parser = subparsers.add_parser(
     'logout', help='Logout of the SmugMug service')
-  logout_parser.set_defaults(func=lambda a: fs.smugmug.logout())
+  logout_parser.set_defaults(func=lambda fs, a: fs.smugmug.logout())
 
   # ---------------
   get_parser = subparsers.add_parser(
     'get', help='Do a GET request to SmugMug using the API V2 URL.')
-  get_parser.set_defaults(func=lambda a: fs.get(a.url))
+  get_parser.set_defaults(func=lambda fs, a: fs.get(a.url))
   get_parser.add_argument('url',
                           type=arg_str_type,
                           help=('A SmugMug V2 API URL to get the JSON response '
@@ -92,7 +188,8 @@ def run(args, config=None, requests_sent=None):
     'ls',
     help='List the content of a folder or album.',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-  ls_parser.set_defaults(func=lambda a: fs.ls(a.user, a.path, a.directory, a.re_match, a.recurse, a.long, a.bare))
+  ls_parser.set_defaults(func=lambda fs, a: fs.ls(a.user, a.path, a.directory, a.re_match, a.recurse, a.long, a.bare,
+                                              a.search))
   ls_parser.add_argument('path',
                          type=arg_str_type,
                          nargs='?',
@@ -127,17 +224,125 @@ def run(args, config=None, requests_sent=None):
   ls_parser.add_argument('-R', '--recurse',
                          help=('List recursively.'),
                          action='store_true')
+  ls_parser.add_argument('-s', '--search',
+                         type=arg_str_type,
+                         metavar='TEXT',
+                         help=('List the images under the path matching TEXT '
+                               '(in file names, titles, captions or '
+                               'keywords), using SmugMug\'s search instead of '
+                               'listing folders.'))
   ls_parser.add_argument('-u', '--user',
                          type=arg_str_type,
                          default='',
                          help=('User whose SmugMug account is to be accessed. '
                                'Uses the logged-in user by default.'))
   # ---------------
+  du_parser = subparsers.add_parser(
+    'du',
+    help='Summarize the space used by folders and albums.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  du_parser.set_defaults(
+    func=lambda fs, a: fs.du(a.user, a.path, a.group_by,
+                         0 if a.summarize else a.max_depth))
+  du_parser.add_argument('path',
+                         type=arg_str_type,
+                         nargs='*',
+                         default=[''],
+                         help='Paths (or glob patterns) to summarize.')
+  du_parser.add_argument('-g', '--group_by',
+                         type=arg_str_type,
+                         default='folder',
+                         choices=['folder', 'album', 'year', 'format'],
+                         help=('Aggregate the usage per folder (including '
+                               'sub-folders), per album, per upload year or '
+                               'per file format.'))
+  du_parser.add_argument('-d', '--max_depth',
+                         type=int,
+                         default=None,
+                         metavar='N',
+                         help=('When grouping by folder, only print folders '
+                               'at most N levels below the listed paths.'))
+  du_parser.add_argument('-s', '--summarize',
+                         action='store_true',
+                         help='Only print a total for each listed path.')
+  du_parser.add_argument('-u', '--user',
+                         type=arg_str_type,
+                         default='',
+                         help=('User whose SmugMug account is to be accessed. '
+                               'Uses the logged-in user by default.'))
+  # ---------------
+  find_parser = subparsers.add_parser(
+    'find',
+    help='Search folders, albums and files by name and metadata.',
+    description=('Recursively search the given paths for nodes matching all '
+                 'of the specified predicates.'))
+  find_parser.set_defaults(
+    func=lambda fs, a: fs.find(a.user, a.path, a.long, a.text,
+                           name=a.name, regex=a.regex, type=a.type,
+                           size=a.size, newer=a.newer, older=a.older,
+                           md5=a.md5, max_depth=a.max_depth))
+  find_parser.add_argument('path',
+                           type=arg_str_type,
+                           nargs='*',
+                           default=[''],
+                           help='Paths (or glob patterns) to search in.')
+  find_parser.add_argument('-n', '--name',
+                           type=arg_str_type,
+                           metavar='PATTERN',
+                           help='Glob pattern the node name must match.')
+  find_parser.add_argument('-m', '--regex',
+                           type=arg_str_type,
+                           metavar='REGEX',
+                           help=('Regular expression the node name must '
+                                 'fully match.'))
+  find_parser.add_argument('--text',
+                           type=arg_str_type,
+                           metavar='TEXT',
+                           help=('Use SmugMug\'s search to find images matching '
+                                 'TEXT (in file names, titles, captions or '
+                                 'keywords) instead of crawling the folders. '
+                                 'Other predicates filter the results.'))
+  find_parser.add_argument('-t', '--type',
+                           type=arg_str_type,
+                           choices=node_filter.NODE_TYPES,
+                           help='Type of nodes to find.')
+  find_parser.add_argument('-s', '--size',
+                           type=arg_str_type,
+                           metavar='[+-]N[KMGT]',
+                           help=('File size: more than (+), less than (-) or '
+                                 'exactly N bytes, kilo, mega, giga or '
+                                 'terabytes.'))
+  find_parser.add_argument('--newer',
+                           type=arg_str_type,
+                           metavar='YYYY[-MM[-DD]]',
+                           help='Only find nodes uploaded on or after DATE.')
+  find_parser.add_argument('--older',
+                           type=arg_str_type,
+                           metavar='YYYY[-MM[-DD]]',
+                           help='Only find nodes uploaded before DATE.')
+  find_parser.add_argument('--md5',
+                           type=arg_str_type,
+                           metavar='HEX',
+                           help='MD5 of the original file.')
+  find_parser.add_argument('-d', '--max_depth',
+                           type=int,
+                           metavar='N',
+                           help=('Descend at most N levels below the searched '
+                                 'paths.'))
+  find_parser.add_argument('-l', '--long',
+                           action='store_true',
+                           help='Show the full JSON description of matches.')
+  find_parser.add_argument('-u', '--user',
+                           type=arg_str_type,
+                           default='',
+                           help=('User whose SmugMug account is to be accessed. '
+                                 'Uses the logged-in user by default.'))
+  # ---------------
   cd_parser = subparsers.add_parser(
     'cd',
     help='Change current working directory.',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-  cd_parser.set_defaults(func=lambda a: fs.cd(a.path))
+  cd_parser.set_defaults(func=lambda fs, a: fs.cd(a.path))
   cd_parser.add_argument('path',
                          type=arg_str_type,
                          nargs='?',
@@ -148,7 +353,7 @@ def run(args, config=None, requests_sent=None):
     'pwd',
     help='Print current working directory.',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-  pwd_parser.set_defaults(func=lambda a: fs.pwd())
+  pwd_parser.set_defaults(func=lambda fs, a: fs.pwd())
   # ---------------
   for cmd, node_type in (('mkdir', 'Folder'), ('mkalbum', 'Album')):
     mkdir_parser = subparsers.add_parser(
@@ -156,7 +361,7 @@ def run(args, config=None, requests_sent=None):
       help='Create a %s.' % node_type.lower(),
       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     mkdir_parser.set_defaults(
-      func=lambda a, t=node_type: fs.make_node(a.user, a.path, a.parents, t,
+      func=lambda fs, a, t=node_type: fs.make_node(a.user, a.path, a.parents, t,
                                                a.privacy.title()))
     mkdir_parser.add_argument('path',
                               type=arg_str_type,
@@ -179,7 +384,7 @@ def run(args, config=None, requests_sent=None):
   # ---------------
   rmdir_parser = subparsers.add_parser(
     'rmdir', help='Remove one or more folders/albums.')
-  rmdir_parser.set_defaults(func=lambda a: fs.rmdir(a.user, a.parents, a.recurse, a.force, a.dirs))
+  rmdir_parser.set_defaults(func=lambda fs, a: fs.rmdir(a.user, a.parents, a.recurse, a.force, a.dirs))
   rmdir_parser.add_argument('-p', '--parents',
                             action='store_true',
                             help=('Remove parent directory as well if they are '
@@ -203,7 +408,7 @@ def run(args, config=None, requests_sent=None):
   rm_parser = subparsers.add_parser(
     'rm', help='Remove files from SmugMug.')
   rm_parser.set_defaults(
-    func=lambda a: fs.rm(a.user, a.force, a.recursive, a.path))
+    func=lambda fs, a: fs.rm(a.user, a.force, a.recursive, a.path))
   rm_parser.add_argument('-u', '--user',
                          type=arg_str_type,
                          default='',
@@ -221,7 +426,7 @@ def run(args, config=None, requests_sent=None):
   # ---------------
   upload_parser = subparsers.add_parser(
     'upload', help='Upload files to SmugMug.')
-  upload_parser.set_defaults(func=lambda a: fs.upload(a.user, a.src, a.album))
+  upload_parser.set_defaults(func=lambda fs, a: fs.upload(a.user, a.src, a.album))
   upload_parser.add_argument('src',
                              type=arg_str_type,
                              nargs='+',
@@ -238,7 +443,9 @@ def run(args, config=None, requests_sent=None):
   # ---------------
   download_parser = subparsers.add_parser(
     'download', help='Download one or more files from SmugMug into current directory.')
-  download_parser.set_defaults(func=lambda a: fs.download(a.user, a.force, a.path))
+  download_parser.set_defaults(func=lambda fs, a: fs.download(a.user, a.force, a.path,
+                                                          a.to_archive,
+                                                          a.download_threads))
   download_parser.add_argument('path',
                                type=arg_str_type,
                                nargs='+',
@@ -246,6 +453,20 @@ def run(args, config=None, requests_sent=None):
   download_parser.add_argument('-f', '--force',
                                action='store_true',
                                help=('Overwrite local files.'))
+  download_parser.add_argument('--to-archive',
+                               type=arg_str_type,
+                               dest='to_archive',
+                               metavar='FILE',
+                               help=('Stream the downloaded files into a tar archive '
+                                     '(or zip, for FILE ending with .zip) instead of '
+                                     'writing them to the current directory. Use "-" to '
+                                     'stream a tar archive to stdout.'))
+  download_parser.add_argument('-dt', '--download_threads',
+                               type=int,
+                               default=config.get('download_threads', 4),
+                               metavar='N',
+                               help=('Number of files downloaded in parallel when '
+                                     'using --to-archive.'))
   download_parser.add_argument('-u', '--user',
                                type=arg_str_type,
                                default='',
@@ -255,7 +476,9 @@ def run(args, config=None, requests_sent=None):
   # ---------------
   newdn_parser = subparsers.add_parser(
     'newdn', help='Download one or more files from SmugMug into current directory.')
-  newdn_parser.set_defaults(func=lambda a: fs.newdn(a.user, a.force, a.recurse, a.path))
+  newdn_parser.set_defaults(func=lambda fs, a: fs.newdn(a.user, a.force, a.recurse,
+                                                    a.path, a.to_archive,
+                                                    a.download_threads))
   newdn_parser.add_argument('path',
                             type=arg_str_type,
                             nargs='+',
@@ -266,6 +489,20 @@ def run(args, config=None, requests_sent=None):
   newdn_parser.add_argument('-r', '--recurse',
                             action='store_true',
                             help=('Descend recursively into folders and albums.'))
+  newdn_parser.add_argument('--to-archive',
+                            type=arg_str_type,
+                            dest='to_archive',
+                            metavar='FILE',
+                            help=('Stream the downloaded files into a tar archive '
+                                  '(or zip, for FILE ending with .zip) instead of '
+                                  'writing them to the current directory. Use "-" to '
+                                  'stream a tar archive to stdout.'))
+  newdn_parser.add_argument('-dt', '--download_threads',
+                            type=int,
+                            default=config.get('download_threads', 4),
+                            metavar='N',
+                            help=('Number of files downloaded in parallel when '
+                                  'using --to-archive.'))
   newdn_parser.add_argument('-u', '--user',
                             type=arg_str_type,
                             default='',
@@ -277,7 +514,7 @@ def run(args, config=None, requests_sent=None):
     'sync',
     help='Synchronize all local albums with SmugMug.',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-  sync_parser.set_defaults(func=lambda a: fs.sync(a.user, a.source, a.target,
+  sync_parser.set_defaults(func=lambda fs, a: fs.sync(a.user, a.source, a.target,
                                                   a.deprecated_target,
                                                   a.force,
                                                   a.privacy.title(),
@@ -348,7 +585,7 @@ def run(args, config=None, requests_sent=None):
   ignore_parser = subparsers.add_parser(
     'ignore', help='Mark paths to be ignored during sync.')
   ignore_parser.set_defaults(
-    func=lambda a: fs.ignore_or_include(a.paths, True))
+    func=lambda fs, a: fs.ignore_or_include(a.paths, True))
   ignore_parser.add_argument('paths',
                              type=arg_str_type,
                              nargs='+',
@@ -361,19 +598,72 @@ def run(args, config=None, requests_sent=None):
                  'included by default, this commands is used to negate the '
                  'effect of the "ignore" command.'))
   include_parser.set_defaults(
-    func=lambda a: fs.ignore_or_include(a.paths, False))
+    func=lambda fs, a: fs.ignore_or_include(a.paths, False))
   include_parser.add_argument('paths',
                               type=arg_str_type,
                               nargs='+',
                               help=('List of paths to include during sync.'))
   # ---------------
-  smugmug_shell.SmugMugShell.set_parser(main_parser)
+  batch_parser = subparsers.add_parser(
+    'batch',
+    help='Run the commands listed in a file.',
+    description=('Run the commands listed in a file, one per line, in a '
+                 'single process sharing the SmugMug session and caches. '
+                 'Lines of the form "SOURCE -> TARGET" sync SOURCE to TARGET. '
+                 'Commands run concurrently, except for syncs to overlapping '
+                 'targets, and a "wait" line waits for all the commands above '
+                 'it. The output of each command is printed in file order. '
+                 'Commands run without prompting: confirmations are declined, '
+                 'use --force where needed.'))
+  batch_parser.set_defaults(
+    func=lambda fs, a: batch.run(fs, a.file, main_parser, a.jobs))
+  batch_parser.add_argument('file',
+                            type=arg_str_type,
+                            help='File listing the commands to run.')
+  batch_parser.add_argument('-j', '--jobs',
+                            type=int,
+                            default=config.get('batch_jobs', 4),
+                            metavar='N',
+                            help=('Maximum number of commands running at the '
+                                  'same time.'))
+  # ---------------
   shell_parser = subparsers.add_parser(
     'shell', help=('Start smugcli in interactive shell mode.'))
-  shell_parser.set_defaults(
-    func=lambda a: smugmug_shell.SmugMugShell(fs).cmdloop())
+  shell_parser.set_defaults(func=lambda fs, a: run_shell(fs, main_parser))
+  # ---------------
+  daemon_parser = subparsers.add_parser(
+    'daemon',
+    help='Serve commands from a background process.',
+    description=('Keep a SmugMug session, its connections and caches warm '
+                 'in this process and run the commands of other smugcli '
+                 'invocations in it. While the daemon runs, smugcli forwards '
+                 'its commands to it, except for %s. Restart the daemon after '
+                 'logging in or out.' % ', '.join(sorted(daemon.LOCAL_COMMANDS))))
+  daemon_parser.set_defaults(
+    func=lambda fs, a: (daemon.stop(a.socket) if a.stop else
+                        daemon.serve(fs, a.socket,
+                                     lambda fs, args: dispatch(
+                                       fs, main_parser, args))))
+  daemon_parser.add_argument('--socket',
+                             type=arg_str_type,
+                             default=daemon.socket_path(),
+                             help=('Unix socket to listen on. Defaults to '
+                                   '$SMUGCLI_SOCKET, or %(default)s.'))
+  daemon_parser.add_argument('--stop',
+                             action='store_true',
+                             help='Stop the running daemon.')
   # ---------------
+  return main_parser
 
+
+def run_shell(fs, main_parser):
+  from . import smugmug_shell
+  smugmug_shell.SmugMugShell.set_parser(main_parser)
+  smugmug_shell.SmugMugShell(fs).cmdloop()
+
+
+def dispatch(fs, main_parser, args):
+  """Parses `args` and runs the requested command with `fs`."""
   parsed = main_parser.parse_args(args)
 
   if parsed.version:
@@ -384,16 +674,46 @@ def run(args, config=None, requests_sent=None):
     main_parser.print_help()
     return
 
-  try:
-    parsed.func(parsed)
-  except smugmug_fs.Error as e:
-    print(e)
-  except smugmug_lib.NotLoggedInError:
-    return
+  with contextlib.ExitStack() as stack:
+    if parsed.profile:
+      profiler = profiling.Profiler(
+        parsed.profile_mode,
+        fs.smugmug.config.get('profile_interval',
+                              profiling.DEFAULT_INTERVAL))
+      def write_profile():
+        profiler.stop()
+        print('Profile written to "%s" and "%s".' % profiler.write(
+          parsed.profile_output))
+      profiler.start()
+      stack.callback(write_profile)
+    tracer = fs.smugmug.tracer
+    if parsed.trace:
+      exporter = tracing.JsonlExporter(parsed.trace)
+      stack.callback(exporter.close)
+      stack.enter_context(tracer.exporting(exporter))
+    if parsed.trace_summary:
+      summary = tracing.SummaryExporter()
+      stack.callback(lambda: print('\n'.join(summary.table())))
+      stack.enter_context(tracer.exporting(summary))
+    if parsed.metrics_textfile or parsed.metrics_json:
+      stack.enter_context(metrics.MetricsWriter(
+        metrics.REGISTRY, parsed.metrics_textfile, parsed.metrics_json,
+        parsed.metrics_interval))
+      stack.enter_context(tracer.exporting(metrics.SpanExporter()))
+    try:
+      parsed.func(fs, parsed)
+    except smugmug_fs.Error as e:
+      print(e)
+    except smugmug_lib.NotLoggedInError:
+      return
 
 
 def main():
-  run(sys.argv[1:])
+  args = sys.argv[1:]
+  status = daemon.forward(args, command_name(args))
+  if status is not None:
+    sys.exit(status)
+  run(args, prewarm=True, cache_dir=CACHE_DIR)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,5 @@
 # Main interface to the SmugMug web service.
 
-from . import smugmug_oauth
-
 import base64
 import collections
 import hashlib
@@ -14,12 +12,38 @@ import re
 import requests
 import threading
 import time
+import urllib.parse
+
+from . import tracing
+from . import transport as transport_lib
 
 API_ROOT = 'https://api.smugmug.com'
 API_UPLOAD = 'https://upload.smugmug.com/'
 API_REQUEST = 'https://api.smugmug.com/api/developer/apply'
 
 PAGE_START_RE = re.compile(r'(\?.*start=)[0-9]+')
+EXPIRES_RE = re.compile(r'[?&]Expires=([0-9]+)')
+# Names for which SmugMug's generated URL name can be predicted reliably.
+URL_NAME_SAFE_RE = re.compile(r'^[A-Za-z0-9]+([ -][A-Za-z0-9]+)*$')
+
+# How long a resolved download URL is trusted when SmugMug doesn't tell us.
+DEFAULT_DOWNLOAD_URL_TTL = 3600
+
+# Number of connections opened ahead of time to each of the API and upload
+# hosts, see SmugMug.prewarm.
+DEFAULT_PREWARM_CONNECTIONS = 2
+
+def url_name(name):
+  """Returns the URL form SmugMug generates for a folder or album name.
+
+  Returns None if the name contains characters whose URL form is ambiguous
+  (punctuation, non-ASCII characters, repeated separators...).
+  """
+  if not URL_NAME_SAFE_RE.match(name):
+    return None
+  url = name.replace(' ', '-')
+  return url[0].upper() + url[1:]
+
 
 class Error(Exception):
   """Base class for all exception of this module."""
@@ -104,6 +128,109 @@ class ChildCacheGarbageCollector(object):
           del self._nodes[node_to_clear]
 
 
+class DownloadUrlCache(object):
+  """Cache of resolved download URLs, keyed by the image's download URI.
+
+  Resolving the download URL of an image or video costs one extra request per
+  file. When downloading whole albums, these URLs are instead obtained from the
+  album listing (through expansions) and stored here along with their expiry
+  time, so that they can be reused until they expire.
+  """
+
+  def __init__(self, default_ttl=DEFAULT_DOWNLOAD_URL_TTL):
+    self._default_ttl = default_ttl
+    self._entries = {}
+    self._mutex = threading.Lock()
+
+  def get(self, uri):
+    """Returns the (url, size) tuple cached for `uri`, or None if missing."""
+    with self._mutex:
+      entry = self._entries.get(uri)
+      if entry is None:
+        return None
+      url, size, expires = entry
+      if time.time() >= expires:
+        del self._entries[uri]
+        return None
+      return url, size
+
+  def put(self, uri, url, size):
+    """Cache the download `url` and `size` resolved for `uri`.
+
+    The expiry time is read from the URL's `Expires` parameter when the URL is
+    signed, otherwise the default time-to-live is used.
+    """
+    match = EXPIRES_RE.search(url)
+    expires = (int(match.group(1)) if match
+               else time.time() + self._default_ttl)
+    with self._mutex:
+      self._entries[uri] = (url, size, expires)
+
+
+def _endpoint(path):
+  """Returns the endpoint of an API path, e.g. "node!children"."""
+  parts = path.split('?')[0].strip('/').split('/')
+  endpoint = parts[2] if len(parts) > 2 else parts[-1]
+  if '!' in parts[-1] and '!' not in endpoint:
+    endpoint += '!' + parts[-1].split('!')[-1]
+  return endpoint.lower()
+
+
+class SingleFlight(object):
+  """Coalesces concurrent identical calls into a single one.
+
+  Worker threads often need the same listing or node at the same moment. The
+  first caller of a given key makes the call, and the ones arriving while it is
+  in flight wait for it and share its result, or exception. Calls are counted
+  per endpoint, along with how many of them were coalesced.
+  """
+
+  class _Call(object):
+    def __init__(self):
+      self.done = threading.Event()
+      self.result = None
+      self.error = None
+
+  def __init__(self):
+    self._calls = {}
+    self._counts = collections.defaultdict(collections.Counter)
+    self._mutex = threading.Lock()
+
+  def do(self, key, endpoint, func):
+    """Returns func(), unless a call for `key` is in flight already."""
+    with self._mutex:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = self._Call()
+      counts = self._counts[endpoint]
+      counts['calls'] += 1
+      if not leader:
+        counts['coalesced'] += 1
+    if not leader:
+      call.done.wait()
+      if call.error:
+        raise call.error
+      return call.result
+    try:
+      call.result = func()
+      return call.result
+    except BaseException as e:
+      call.error = e
+      raise
+    finally:
+      with self._mutex:
+        del self._calls[key]
+      call.done.set()
+
+  def stats(self):
+    """Returns {endpoint: {'calls': int, 'coalesced': int}}."""
+    with self._mutex:
+      return {endpoint: {'calls': counts['calls'],
+                         'coalesced': counts['coalesced']}
+              for endpoint, counts in self._counts.items()}
+
+
 class NodeList(object):
   def __init__(self, smugmug, json, parent):
     self._smugmug = smugmug
@@ -117,8 +244,10 @@ class NodeList(object):
     num_pages = int(math.ceil(float(self._total_size) / self._page_size)
                     if self._page_size else 0)
     self._pages = [None] * num_pages
+    self._expansions = [None] * num_pages
     if num_pages:
       self._pages[0] = response[locator]
+      self._expansions[0] = json.get('Expansions', {})
     self._uri = PAGE_START_RE.sub(r'\1%d', response['Uri'])
 
   def __len__(self):
@@ -135,17 +264,21 @@ class NodeList(object):
       response = json['Response']
       locator = response['Locator']
       self._pages[page_index] = response[locator]
+      self._expansions[page_index] = json.get('Expansions', {})
     return Node(self._smugmug,
                 self._pages[page_index][item - page_index * self._page_size],
-                self._parent)
+                self._parent,
+                self._expansions[page_index])
 
 
 class Node(object):
-  def __init__(self, smugmug, json, parent=None):
+  def __init__(self, smugmug, json, parent=None, expansions=None):
     self._smugmug = smugmug
     self._json = json
     self._parent = parent
+    self._expansions = expansions or {}
     self._child_nodes_by_name = None
+    self._children_time = 0
     self._lock = threading.Lock()
 
   @property
@@ -219,7 +352,32 @@ class Node(object):
   def __hash__(self):
     return id(self)
 
-  def get_children(self, params=None):
+  def get_download_info(self):
+    """Returns the (url, size) tuple to use to download this image or video.
+
+    Images carry their download URL in the `ArchivedUri` attribute. Videos
+    need their `LargestVideo` endpoint, which is taken from the listing's
+    expansions when available and only fetched as a last resort.
+    """
+    video = self._json.get('IsVideo')
+    if not video and self._json.get('ArchivedUri'):
+      return self._json['ArchivedUri'], self._json.get('ArchivedSize')
+
+    locator = 'LargestVideo' if video else 'ImageDownload'
+    uri = self.uri(locator)
+    cache = self._smugmug.download_url_cache
+    info = cache.get(uri)
+    if info is None:
+      expansion = self._expansions.get(uri)
+      if expansion is None:
+        expansion = self._smugmug.get_json(uri)['Response']
+      endpoint = expansion[locator]
+      size = endpoint.get('Size') if video else self._json.get('ArchivedSize')
+      cache.put(uri, endpoint['Url'], size)
+      info = (endpoint['Url'], size)
+    return info
+
+  def get_children(self, params=None, expand=None):
     if 'Type' not in self._json:
       raise UnexpectedResponseError('Node does not have a "Type" attribute.')
 
@@ -228,6 +386,8 @@ class Node(object):
       'start': params.get('start', 1),
       'count': params.get('count', self._smugmug.config.get('page_size', 1000)),
       'SortDirection': 'Ascending', 'SortMethod': 'Name'}
+    if expand:
+      params['_expand'] = ','.join(expand)
 
     if self._json['Type'] == 'Album':
       return self.get('Album').get('AlbumImages', params=params)
@@ -235,7 +395,13 @@ class Node(object):
       return self.get('ChildNodes', params=params)
 
   def _get_child_nodes_by_name(self):
+    ttl = self._smugmug.tree_cache_ttl
+    if (self._child_nodes_by_name is not None and ttl is not None and
+        time.time() - self._children_time > ttl):
+      self._child_nodes_by_name = None
+
     if self._child_nodes_by_name is None:
+      self._children_time = time.time()
       self._child_nodes_by_name = collections.defaultdict(list)
       for child in self.get_children():
         self._child_nodes_by_name[child.name].append(child)
@@ -277,6 +443,7 @@ class Node(object):
 
     node = Node(self._smugmug, node_json, parent=self)
     node._child_nodes_by_name = {}
+    node._children_time = time.time()
     self._smugmug.garbage_collector.visited(node)
     self._get_child_nodes_by_name()[name] = [node]
 
@@ -288,6 +455,16 @@ class Node(object):
           response.status_code, response.json()['Message']))
     return node
 
+  def get_child_names(self):
+    """Returns the sorted names of this node's children, using the cache."""
+    with self._lock:
+      return sorted(self._get_child_nodes_by_name())
+
+  def get_children_named(self, name):
+    """Returns the list of children called `name`, using the children cache."""
+    with self._lock:
+      return list(self._get_child_nodes_by_name().get(name, []))
+
   def get_child(self, name):
     with self._lock:
       match = self._get_child_nodes_by_name().get(name)
@@ -329,11 +506,12 @@ def Wrapper(smugmug, json, parent=None):
 
 
 class StreamingUpload(object):
-  def __init__(self, data, progress_fn):
+  def __init__(self, data, progress_fn, watch=None):
     self._data = io.BytesIO(data)
     self._len = len(data)
     self._progress_fn = progress_fn
     self._progress = 0
+    self._watch = watch
 
   def __len__(self):
     return self._len
@@ -341,6 +519,11 @@ class StreamingUpload(object):
   def read(self, n=-1):
     chunk = self._data.read(n)
     self._progress += len(chunk)
+    if self._watch:
+      self._watch.progress(len(chunk))
+      if self._progress == self._len:
+        # Sent, SmugMug may now take a while to process the file.
+        self._watch.pause()
     if self._progress_fn:
       aborting = self._progress_fn(100 * self._progress / self._len)
       if aborting:
@@ -355,19 +538,59 @@ class StreamingUpload(object):
 
 
 class SmugMug(object):
-  def __init__(self, config, requests_sent=None):
+  def __init__(self, config, requests_sent=None, http_cache=None):
     self._config = config
     self._smugmug_oauth = None
     self._oauth = None
     self._user_root_node = None
-    self._session = requests.Session()
-    self._requests_sent = requests_sent
+    self._transport = transport_lib.Transport(config)
+    self._single_flight = SingleFlight()
+    self._http_cache = http_cache
+    self._tracer = tracing.Tracer()
+    if requests_sent is not None:
+      self._tracer.add_exporter(tracing.RequestLog(requests_sent))
     self._garbage_collector = ChildCacheGarbageCollector(8)
+    self._download_url_cache = DownloadUrlCache(
+      config.get('download_url_ttl', DEFAULT_DOWNLOAD_URL_TTL))
+    self._tree_cache_ttl = None
+    self._tree_generation = 0
 
   @property
   def config(self):
     return self._config
 
+  @property
+  def transport(self):
+    return self._transport
+
+  @property
+  def tracer(self):
+    return self._tracer
+
+  @property
+  def single_flight(self):
+    return self._single_flight
+
+  @property
+  def download_url_cache(self):
+    return self._download_url_cache
+
+  @property
+  def tree_cache_ttl(self):
+    return self._tree_cache_ttl
+
+  def set_tree_cache_ttl(self, ttl):
+    """Set how long, in seconds, node children caches are trusted.
+
+    Single commands never need to refresh their view of the tree, but
+    long-lived sessions like the interactive shell must eventually notice
+    changes made elsewhere.
+
+    Args:
+      ttl: float, or None for caches to never expire.
+    """
+    self._tree_cache_ttl = ttl
+
   @property
   def garbage_collector(self):
     return self._garbage_collector
@@ -376,6 +599,7 @@ class SmugMug(object):
   def service(self):
     if not self._smugmug_oauth:
       if 'api_key' in self.config:
+        from . import smugmug_oauth
         self._smugmug_oauth = smugmug_oauth.SmugMugOAuth(self.config['api_key'])
       else:
         print('No API key provided.')
@@ -394,6 +618,19 @@ class SmugMug(object):
         raise NotLoggedInError
     return self._oauth
 
+  def prewarm(self):
+    """Opens connections to the API and upload hosts in the background.
+
+    The DNS, TCP and TLS setup then overlaps with what the command does before
+    its first request. Does nothing if not logged in.
+    """
+    count = self._config.get('prewarm_connections',
+                             DEFAULT_PREWARM_CONNECTIONS)
+    if count <= 0 or 'access_token' not in self._config:
+      return
+    self._transport.prewarm(transport_lib.METADATA, API_ROOT, count)
+    self._transport.prewarm(transport_lib.UPLOAD, API_UPLOAD, count)
+
   def login(self, api_key):
     self.config['api_key'] = api_key
     self.config['access_token'] = self.service.request_access_token()
@@ -408,7 +645,9 @@ class SmugMug(object):
     if 'authuser_uri' in self.config:
       del self.config['authuser_uri']
     self._service = None
-    self._session = None
+    self._transport.close()
+    if self._http_cache:
+      self._http_cache.clear()
 
   def get_auth_user(self):
     if not 'authuser' in self.config:
@@ -434,15 +673,145 @@ class SmugMug(object):
     else:
       return self.get(self.get_user_uri(user))
 
+  def lookup_path(self, root_node, user, names):
+    """Resolves a path of folder and album names in a couple of requests.
+
+    Instead of listing the children of every ancestor, the whole path is looked
+    up at once using the user's `!urlpathlookup` endpoint, and the ancestors
+    are then fetched with the node's `!parents` endpoint. Since SmugMug looks
+    paths up by URL name, the names of the resolved nodes are checked against
+    the requested ones, and None is returned on any mismatch so that the
+    caller falls back to walking the path. Siblings sharing a same name can't
+    be detected this way though: the one whose URL name matches is returned,
+    whereas the walk raises RemoteDataError.
+
+    Args:
+      root_node: Node, the root node of `user`.
+      user: str, the user owning the path.
+      names: list of str, the node names to resolve, from the root down.
+
+    Returns:
+      The list of resolved Nodes, starting with `root_node`, or None if the
+      path could not be resolved this way.
+    """
+    url_names = [url_name(name) for name in names]
+    if not names or None in url_names:
+      return None
+
+    try:
+      reply = self.get_json('/api/v2/user/%s!urlpathlookup' % user,
+                            params={'urlpath': '/' + '/'.join(url_names),
+                                    '_expand': 'Node'})
+      response = reply['Response']
+      endpoint = response[response['Locator']]
+      node_uri = endpoint['Uris']['Node']['Uri']
+      node_json = reply.get('Expansions', {}).get(node_uri, {}).get('Node')
+      if node_json is None:
+        node_json = self.get_json(node_uri)['Response']['Node']
+
+      parents = []
+      if len(names) > 1:
+        parents = [p for p in self.get_parent_nodes_json(node_json)
+                   if not p.get('IsRoot')]
+    except (requests.exceptions.HTTPError, KeyError, TypeError):
+      return None
+
+    chain_json = parents + [node_json]
+    nodes = [root_node]
+    for json in chain_json:
+      nodes.append(Node(self, json, nodes[-1]))
+    # Compare the names the way the walk matches them, see Node.get_child.
+    if [node.name for node in nodes[1:]] != list(names):
+      return None
+    return nodes
+
+  def get_parent_nodes_json(self, node_json):
+    """Returns the JSON of the ancestors of a node, from the root down."""
+    reply = self.get_json(node_json['Uris']['ParentNodes']['Uri'])
+    parents = reply['Response'].get('Node', [])
+    # The reply may be shared with concurrent callers, don't modify it.
+    if parents and not parents[0].get('IsRoot'):
+      return parents[::-1]
+    return list(parents)
+
+  def search_images(self, root_node, scope, text):
+    """Yields the images matching `text`, using SmugMug's search endpoint.
+
+    The ancestors of each image are resolved (once per album) so that the
+    `path` of the yielded nodes is correct.
+
+    Args:
+      root_node: Node, the root node of the user owning `scope`.
+      scope: str, URI of the user, folder or album to search in.
+      text: str, the text to search for, in file names, titles, captions and
+          keywords.
+    """
+    albums = {}
+    results = self.get('/api/v2/image!search', params={
+      'Scope': scope,
+      'Text': text,
+      'start': 1,
+      'count': self.config.get('page_size', 1000)})
+    if isinstance(results, Node):
+      results = [results]
+    for image in results:
+      album_uri = image.uri('ImageAlbum')
+      if album_uri not in albums:
+        reply = self.get_json(album_uri, params={'_expand': 'Node'})
+        album_json = reply['Response']['Album']
+        node_uri = album_json['Uris']['Node']['Uri']
+        node_json = reply.get('Expansions', {}).get(node_uri, {}).get('Node')
+        if node_json is None:
+          node_json = self.get_json(node_uri)['Response']['Node']
+        # Chain from the root the way lookup_path does, whether or not the
+        # reply includes it.
+        parent = root_node
+        for json in [p for p in self.get_parent_nodes_json(node_json)
+                     if not p.get('IsRoot')] + [node_json]:
+          parent = Node(self, json, parent)
+        albums[album_uri] = parent
+      yield Node(self, image.json, albums[album_uri])
+
   def get_json(self, path, **kwargs):
-    req = requests.Request('GET', API_ROOT + path,
-                           headers={'Accept': 'application/json'},
-                           auth=self.oauth,
-                           **kwargs).prepare()
-    resp = self._session.send(req)
-    if self._requests_sent is not None:
-      self._requests_sent.append((req, resp))
+    """GETs the JSON reply of `path`.
+
+    Concurrent identical requests are coalesced: only one goes on the wire
+    and all callers share its parsed reply, which must not be modified.
+    """
+    key = (path, json.dumps(kwargs, sort_keys=True, default=str))
+    return self._single_flight.do(
+      key, _endpoint(path), lambda: self._get_json(path, **kwargs))
+
+  def _get_json(self, path, **kwargs):
+    headers = {'Accept': 'application/json'}
+    cache_key = None
+    cached = None
+    if self._http_cache:
+      # Replies depend on who asks. The token is hashed, so that it isn't
+      # written in the clear anywhere else than in the config.
+      url = requests.Request('GET', API_ROOT + path, **kwargs).prepare().url
+      token = self.config.get('access_token', [''])[0]
+      cache_key = '%s %s' % (
+        hashlib.sha256(token.encode('utf-8')).hexdigest(), url)
+      cached = self._http_cache.get(cache_key)
+      if cached:
+        headers.update(cached.conditional_headers())
+    request = requests.Request('GET', API_ROOT + path,
+                               headers=headers,
+                               auth=self.oauth,
+                               **kwargs)
+    req = request.prepare()
+    with self._tracer.span('GET', tracing.endpoint_template(path)) as span:
+      # A hedge is signed again, with a nonce of its own.
+      resp = self._transport.send(transport_lib.METADATA, req,
+                                  hedge=request.prepare)
+      span.set_response(req, resp)
+    if cached and resp.status_code == 304:
+      return json.loads(cached.body)
     resp.raise_for_status()
+    if cache_key:
+      self._http_cache.put(cache_key, resp.headers.get('ETag'),
+                           resp.headers.get('Last-Modified'), resp.text)
     return resp.json()
 
   def get(self, path, parent=None, **kwargs):
@@ -450,12 +819,29 @@ class SmugMug(object):
     return Wrapper(self, reply, parent)
 
   def download(self, url, filename, progress_fn=None):
-    req = requests.Request('GET', url, auth=self.oauth).prepare()
-    resp = self._session.send(req, stream=True)
     with open(filename, 'wb') as f:
-      for chunk in resp.iter_content(chunk_size=10485760): 
-        f.write(chunk)
-    resp.close()
+      self.download_to(url, f)
+
+  def download_to(self, url, fileobj):
+    start = fileobj.tell()
+    def attempt(watch):
+      # Start over, dropping what a failed attempt wrote.
+      fileobj.seek(start)
+      fileobj.truncate()
+      req = requests.Request('GET', url, auth=self.oauth).prepare()
+      resp = self._transport.send(transport_lib.DOWNLOAD, req, stream=True)
+      span.set_response(req, resp, read_body=False)
+      try:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=65536):
+          watch.progress(len(chunk))
+          span.add('bytes_in', len(chunk))
+          fileobj.write(chunk)
+      finally:
+        resp.close()
+    # Download URLs are signed, one per file, group them by host.
+    with self._tracer.span('GET', urllib.parse.urlsplit(url).netloc) as span:
+      self._transport.transfer(attempt)
   
   def post(self, path, data=None, json=None, **kwargs):
     req = requests.Request('POST',
@@ -465,32 +851,43 @@ class SmugMug(object):
                            headers={'Accept': 'application/json'},
                            auth=self.oauth,
                            **kwargs).prepare()
-    resp = self._session.send(req)
-    if self._requests_sent is not None:
-      self._requests_sent.append((req, resp))
+    with self._tracer.span(req.method,
+                           tracing.endpoint_template(path)) as span:
+      resp = self._transport.send(transport_lib.METADATA, req)
+      span.set_response(req, resp)
     return resp
 
+  @property
+  def tree_generation(self):
+    """Number of changes made to the remote tree, e.g. nodes deleted."""
+    return self._tree_generation
+
   def patch(self, path, data=None, json=None, **kwargs):
+    # May rename or move a node.
+    self._tree_generation += 1
     req = requests.Request('PATCH',
                            API_ROOT + path,
                            data=data, json=json,
                            headers={'Accept': 'application/json'},
                            auth=self.oauth,
                            **kwargs).prepare()
-    resp = self._session.send(req)
-    if self._requests_sent is not None:
-      self._requests_sent.append((req, resp))
+    with self._tracer.span(req.method,
+                           tracing.endpoint_template(path)) as span:
+      resp = self._transport.send(transport_lib.METADATA, req)
+      span.set_response(req, resp)
     return resp
 
   def delete(self, path, data=None, json=None, **kwargs):
+    self._tree_generation += 1
     req = requests.Request('DELETE',
                            API_ROOT + path,
                            auth=self.oauth,
                            headers={'Accept': 'application/json'},
                            **kwargs).prepare()
-    resp = self._session.send(req)
-    if self._requests_sent is not None:
-      self._requests_sent.append((req, resp))
+    with self._tracer.span(req.method,
+                           tracing.endpoint_template(path)) as span:
+      resp = self._transport.send(transport_lib.METADATA, req)
+      span.set_response(req, resp)
     return resp
 
   def upload(self, uri, filename, data, progress_fn=None,
@@ -502,22 +899,27 @@ class SmugMug(object):
                'X-Smug-ResponseType': 'JSON',
                'X-Smug-Version': 'v2'}
     headers.update(additional_headers or {})
-    req = requests.Request('POST',
-                           API_UPLOAD,
-                           data=StreamingUpload(data, progress_fn),
-                           headers=headers,
-                           auth=self.oauth).prepare()
-    resp = self._session.send(req)
-    if self._requests_sent is not None:
-      self._requests_sent.append((req, resp))
-    return resp
+    def attempt(watch):
+      req = requests.Request('POST',
+                             API_UPLOAD,
+                             data=StreamingUpload(data, progress_fn, watch),
+                             headers=headers,
+                             auth=self.oauth).prepare()
+      resp = self._transport.send(transport_lib.UPLOAD, req)
+      span.set_response(req, resp)
+      return resp
+    with self._tracer.span('POST', API_UPLOAD) as span:
+      # Once fully sent, SmugMug may have created the image even if its reply
+      # was lost, retrying would then create a duplicate.
+      return self._transport.transfer(
+        attempt, can_retry=lambda watch: watch.bytes < len(data))
 
 
 class FakeSmugMug(SmugMug):
-  def __init__(self, config=None):
+  def __init__(self, config=None, http_cache=None):
     config = config or {}
     config['page_size'] = 10
-    super(FakeSmugMug, self).__init__(config or {})
+    super(FakeSmugMug, self).__init__(config or {}, http_cache=http_cache)
 
   @property
   def service(self):
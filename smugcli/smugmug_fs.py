@@ -1,39 +1,66 @@
+from . import archive_writer
+from . import disk_usage
+from . import jobs
+from . import metrics
+from . import node_filter
 from . import persistent_dict
-from . import task_manager  # Must be included before hachoir so stdout override works.
+from . import results
+from . import smugmug as smugmug_lib
+from . import task_manager
 from . import thread_pool
 from . import thread_safe_print
+from . import transport as transport_lib
+from . import tree_crawler
 
 import six
+import calendar
 import collections
+import contextlib
 import datetime
 import glob
 import re
 import fnmatch
-
-if six.PY2:
-  from hachoir_metadata import extractMetadata
-  from hachoir_parser import guessParser
-  from hachoir_core.stream import StringInputStream
-  from hachoir_core import config as hachoir_config
-else:
-  from hachoir.metadata import extractMetadata
-  from hachoir.parser import guessParser
-  from hachoir.stream import StringInputStream
-  from hachoir.core import config as hachoir_config
+import threading
 
 from six.moves import input
+from six.moves import queue
 import itertools
 import json
 import hashlib
 import os
 import requests
+import sys
 from six.moves import urllib
 
-hachoir_config.quiet = True
-
 DEFAULT_MEDIA_EXT = ['gif', 'jpeg', 'jpg', 'mov', 'mp4', 'png', 'heic']
 VIDEO_EXT = ['mov', 'mp4']
 
+# Expansions requested when listing albums for download, so that the download
+# URL of videos comes with the listing instead of needing one request per file.
+DOWNLOAD_EXPANSIONS = ['LargestVideo']
+
+
+def _get_media_time(file_content):
+  """Returns the last modification time found in a media file's metadata."""
+  # hachoir is slow to import and only needed to compare videos, so it is only
+  # imported when first needed.
+  if six.PY2:
+    from hachoir_metadata import extractMetadata
+    from hachoir_parser import guessParser
+    from hachoir_core.stream import StringInputStream
+    from hachoir_core import config as hachoir_config
+  else:
+    from hachoir.metadata import extractMetadata
+    from hachoir.parser import guessParser
+    from hachoir.stream import StringInputStream
+    from hachoir.core import config as hachoir_config
+  hachoir_config.quiet = True
+
+  parser = guessParser(StringInputStream(file_content))
+  metadata = extractMetadata(parser)
+  return max(metadata.getValues('last_modification') +
+             metadata.getValues('creation_date'))
+
 
 class Error(Exception):
   """Base class for all exception of this module."""
@@ -56,6 +83,12 @@ class SmugMugFS(object):
     self._smugmug = smugmug
     self._aborting = False
     self._cwd = os.sep
+    # Resolved nodes of the current directory, from the root down, valid as
+    # long as the remote tree is at generation `_cwd_generation`.
+    self._cwd_nodes = None
+    self._cwd_generation = None
+    # Receives the SyncActions taken by `sync`, from any thread.
+    self._on_sync_action = self._print_sync_action
 
     # Pre-compute some common variables.
     self._media_ext = [
@@ -70,37 +103,122 @@ class SmugMugFS(object):
   def cwd(self):
     return self._cwd
 
+  @property
+  def aborting(self):
+    return self._aborting
+
   def abort(self):
     self._aborting = True
 
+  def fork(self):
+    """Returns a SmugMugFS sharing this one's session and current directory.
+
+    The returned object can be aborted independently, which lets the shell
+    kill a background job without affecting the other commands.
+    """
+    fs = SmugMugFS(self._smugmug)
+    fs._cwd = self._cwd
+    fs._cwd_nodes = self._cwd_nodes
+    fs._cwd_generation = self._cwd_generation
+    return fs
+
   def get_root_node(self, user):
     return self._smugmug.get_root_node(user)
 
   def glob(self, user, path, directory, re_match=False):
-    # Globbing algorithm
-    # split path into pathlist
-    # worklist = [rootnode]
-    # for pathitem in pathlist:
-    #   worklist2 = []
-    #   for workitem in worklist:
-    #     worklist2.extend(children of workitem that match pathitem)
-    #   worklist = worklist2
-    current_node = self.get_root_node(user)
-    pathlist = []
-    if user == self._smugmug.get_auth_user() and (len(path) == 0 or path[0] != os.sep):
-      pathlist.extend(list(filter(bool, self._cwd.split(os.sep))))
-    pathlist.extend(list(filter(bool, path.split(os.sep))))
+    return list(self.iter_glob(user, path, re_match))
+
+  def iter_glob(self, user, path, re_match=False):
+    """Yields the nodes matching a glob (or regex) path, as they are found.
+
+    The path is expanded one component at a time: the nodes matched so far are
+    all listed in parallel in a thread pool, and the matches of the last
+    component are yielded in order as soon as they are available. Components
+    without wildcards are looked up directly in the children cache.
+    """
+    pathlist = self._path_parts(user, path)
     worklist = [self.get_root_node(user)]
-    for pathitem in pathlist:
-      worklist2 = []
-      for workitem in worklist:
-        regex = re.compile(pathitem if re_match else fnmatch.translate(pathitem))
-        worklist2.extend([node for node in workitem.get_children() if regex.fullmatch(node.name)])
-      worklist = worklist2
-    return worklist
-  
-  def resolve_multinodes(self, user, path, directory, re_match=False):
-    matched_nodes, unmatched_dirs = self.path_to_node(user, path)
+    if not pathlist:
+      for node in worklist:
+        yield node
+      return
+
+    num_threads = self._smugmug.config.get('folder_threads', 4)
+    with thread_pool.ThreadPool(num_threads) as pool:
+      for depth, pathitem in enumerate(pathlist):
+        if pathitem == '.':
+          continue
+        if pathitem == '..':
+          worklist = [node.parent or node for node in worklist]
+          continue
+
+        last = (depth == len(pathlist) - 1)
+        expanded = self._iter_expand_parallel(
+          pool, worklist, self._glob_matcher(pathitem, re_match))
+        if last:
+          for nodes in expanded:
+            for node in nodes:
+              yield node
+          return
+        worklist = list(itertools.chain.from_iterable(expanded))
+
+    for node in worklist:
+      yield node
+
+  def _glob_matcher(self, pathitem, re_match):
+    if re_match:
+      literal = (re.escape(pathitem) == pathitem)
+    else:
+      literal = not any(c in pathitem for c in '*?[')
+
+    if literal:
+      return lambda node: node.get_children_named(pathitem)
+
+    regex = re.compile(pathitem if re_match else fnmatch.translate(pathitem))
+    return lambda node: [child for child in node.get_children()
+                         if regex.fullmatch(child.name)]
+
+  def _iter_expand_parallel(self, pool, worklist, matcher):
+    """Applies `matcher` to all container nodes of `worklist` in `pool`.
+
+    Yields the matcher results in worklist order, each one as soon as it and
+    all the previous ones are available.
+    """
+    results = {}
+    errors = []
+    ready = threading.Condition()
+
+    def expand(index, node):
+      try:
+        result = matcher(node) if 'Type' in node else []
+      except Exception as e:
+        errors.append(e)
+        result = []
+      with ready:
+        results[index] = result
+        ready.notify_all()
+
+    next_index = 0
+    for index, node in enumerate(worklist):
+      pool.add(expand, index, node)
+      while next_index in results:
+        yield results.pop(next_index)
+        next_index += 1
+
+    while next_index < len(worklist):
+      with ready:
+        while next_index not in results:
+          ready.wait(1)
+      if errors:
+        raise errors[0]
+      yield results.pop(next_index)
+      next_index += 1
+    if errors:
+      raise errors[0]
+
+  def resolve_multinodes(self, user, path, directory, re_match=False,
+                         expand=None, resolved=None):
+    matched_nodes, unmatched_dirs = resolved or self.path_to_node(user, path)
     if unmatched_dirs:
       if len(unmatched_dirs) > 1:
         print('"%s" not found in "%s".' % (
@@ -108,24 +226,132 @@ class SmugMugFS(object):
         return []
 
       regex = re.compile(unmatched_dirs[0] if re_match else fnmatch.translate(unmatched_dirs[0]))
-      ret = [node for node in matched_nodes[-1].get_children() if regex.fullmatch(node.name)]
+      ret = [node for node in matched_nodes[-1].get_children(expand=expand)
+             if regex.fullmatch(node.name)]
       if len(ret) == 0:
         print('"%s" not found in "%s".' % (
           unmatched_dirs[0], matched_nodes[-1].path))
       return ret
 
     node = matched_nodes[-1]
-    return [node] if 'FileName' in node or directory else node.get_children()
+    if 'FileName' in node or directory:
+      return [node]
+    return node.get_children(expand=expand)
   
-  def path_to_node(self, user, path):
-    current_node = self.get_root_node(user)
+  def _path_parts(self, user, path):
     parts = []
     if user == self._smugmug.get_auth_user() and (len(path) == 0 or path[0] != os.sep):
       parts.extend(list(filter(bool, self._cwd.split(os.sep))))
     parts.extend(list(filter(bool, path.split(os.sep))))
+    return parts
+
+  def path_to_node(self, user, path):
+    if self._cwd_generation != self._smugmug.tree_generation:
+      # Nodes were deleted, renamed or moved since, possibly the cached ones,
+      # by this or another command (e.g. a background job).
+      self._cwd_nodes = None
+    if (self._cwd_nodes and not path.startswith(os.sep) and
+        user == self._smugmug.get_auth_user()):
+      # Relative paths are resolved from the cached current directory.
+      return self._match_nodes(list(self._cwd_nodes),
+                               list(filter(bool, path.split(os.sep))))
+
+    current_node = self.get_root_node(user)
+    parts = self._path_parts(user, path)
     nodes = [current_node]
+
+    # Folders and albums are looked up by URL name, the parts that have none
+    # (e.g. a file name, '..') are walked from the resolved prefix.
+    prefix_length = 0
+    while (prefix_length < len(parts) and
+           smugmug_lib.url_name(parts[prefix_length]) is not None):
+      prefix_length += 1
+    # Resolving one level only costs one listing either way.
+    if (prefix_length > 1 and
+        self._smugmug.config.get('url_path_lookup', True)):
+      resolved = self._smugmug.lookup_path(current_node, user,
+                                           parts[:prefix_length])
+      if resolved:
+        nodes, parts = resolved, parts[prefix_length:]
+
     return self._match_nodes(nodes, parts)
 
+  def resolve_paths(self, user, paths):
+    """Resolves many paths at once, sharing the lookup of common prefixes.
+
+    The requested paths are arranged in a prefix trie which is resolved level
+    by level. Each distinct folder is listed only once, and the folders of a
+    same level are listed in parallel. Unlike `path_to_node`, the
+    `!urlpathlookup` fast path isn't used for several paths: listings shared
+    by many paths are cheaper than two requests per path.
+
+    Args:
+      user: str, the user owning the paths.
+      paths: list of str, the paths to resolve.
+
+    Returns:
+      A dict mapping each path to the (matched_nodes, unmatched_dirs) tuple that
+      `path_to_node` would have returned for it.
+    """
+    results = {}
+    trie_paths = {}
+    single_path = len(set(paths)) == 1
+    for path in paths:
+      parts = self._path_parts(user, path)
+      if single_path or '.' in parts or '..' in parts:
+        results[path] = self.path_to_node(user, path)
+      else:
+        trie_paths[path] = parts
+    if not trie_paths:
+      return results
+
+    root = self.get_root_node(user)
+    resolved = {(): root}
+    errors = []
+
+    def resolve_children(prefix, names):
+      try:
+        parent = resolved[prefix]
+        for name in names:
+          resolved[prefix + (name,)] = (
+            parent.get_child(name) if 'Type' in parent else None)
+      except Exception as e:
+        errors.append(e)
+
+    num_threads = self._smugmug.config.get('folder_threads', 4)
+    with thread_pool.ThreadPool(num_threads) as pool:
+      for depth in range(max(len(p) for p in trie_paths.values())):
+        children_by_prefix = collections.defaultdict(set)
+        for parts in trie_paths.values():
+          prefix = tuple(parts[:depth])
+          if len(parts) > depth and resolved.get(prefix) is not None:
+            children_by_prefix[prefix].add(parts[depth])
+        if not children_by_prefix:
+          break
+        # Iterate in sorted order to make unit tests deterministic.
+        for prefix, names in sorted(children_by_prefix.items()):
+          pool.add(resolve_children, prefix, sorted(names))
+        pool.wait()
+        if errors:
+          raise errors[0]
+
+    for path, parts in trie_paths.items():
+      matched_nodes = [root]
+      for i in range(len(parts)):
+        node = resolved.get(tuple(parts[:i + 1]))
+        if node is None:
+          break
+        matched_nodes.append(node)
+      results[path] = (matched_nodes, parts[len(matched_nodes) - 1:])
+    return results
+
+  def _has_deleted_ancestor(self, node, deleted):
+    while node is not None:
+      if node in deleted:
+        return True
+      node = node.parent
+    return False
+
   def _match_nodes(self, matched_nodes, dirs):
     unmatched_dirs = collections.deque(dirs)
     for dir in dirs:
@@ -225,32 +451,207 @@ class SmugMugFS(object):
         abbrev = 'U'
       print(f'{abbrev} {printname}')
 
-  def process_children(self, node, recurse, details, bare, fullpath, print_header, processfn):
-    if print_header:
-      print(f'\n{node.path}:')
-    children = node.get_children()
-    for child in children:
-      processfn(child, details, bare, fullpath)
-
-    if recurse:
-      for child in children:
-        if 'Type' in child:
-          self.process_children(child, recurse, details, bare, fullpath, True, processfn)
-    
-  def ls(self, user, path, directory, re_match, recurse, details, bare):
+  def iter_children(self, node, recurse):
+    """Yields Listings of the children of `node` and, if `recurse`, of all of
+    its descendants, in depth-first order."""
+    if not recurse:
+      yield results.Listing(node, node.get_children())
+      return
+
+    # Subfolders are listed in parallel, but yielded in depth-first order.
+    num_threads = self._smugmug.config.get('folder_threads', 4)
+    with tree_crawler.TreeCrawler(num_threads) as crawler:
+      for parent, children in crawler.crawl([node]):
+        if self._aborting:
+          return
+        yield results.Listing(parent, children)
+
+  def iter_ls(self, user, path, directory=False, re_match=False,
+              recurse=False, search=None):
+    """Yields the Listings shown by `ls`, as they are found.
+
+    Nodes matched by `path` come first, in Listings without a directory, then
+    the contents of the matched folders and albums (unless `directory`).
+    """
     user = user or self._smugmug.get_auth_user()
-    nodelist = self.glob(user, path, directory, re_match)
-    #nodelist = self.resolve_multinodes(user, path, directory, re_match)
-    multiple = len(nodelist) > 1
+    if search:
+      for node in self.search(user, path, search):
+        yield results.Listing(None, [node])
+      return
 
-    for node in nodelist:
+    matches = self.iter_glob(user, path, re_match)
+    first_matches = list(itertools.islice(matches, 2))
+    multiple = len(first_matches) > 1
+
+    # Yield the matches as they stream in.
+    nodelist = []
+    for node in itertools.chain(first_matches, matches):
+      nodelist.append(node)
       if multiple or 'Type' not in node or directory:
-        self.printnode(node, details, bare, True)
+        yield results.Listing(None, [node])
 
     if not directory:
       for node in nodelist:
         if 'Type' in node:
-          self.process_children(node, recurse, details, bare, False, multiple, self.printnode)
+          for listing in self.iter_children(node, recurse):
+            yield listing
+
+  def ls(self, user, path, directory, re_match, recurse, details, bare,
+         search=None):
+    first = True
+    for listing in self.iter_ls(user, path, directory, re_match, recurse,
+                                search):
+      if listing.directory is None:
+        for node in listing.nodes:
+          self.printnode(node, details, bare, True)
+      else:
+        # The contents of a single matched folder come without a header.
+        if not first:
+          print(f'\n{listing.directory.path}:')
+        for node in listing.nodes:
+          self.printnode(node, details, bare, False)
+      first = False
+
+  def du(self, user, paths, group_by, max_depth):
+    user = user or self._smugmug.get_auth_user()
+    table = disk_usage.UsageTable()
+    by_folder = (group_by == 'folder')
+    # Whether rows are keyed by node paths, as opposed to by file attributes.
+    by_path = group_by in ('folder', 'album')
+
+    def group_row(node, album_row):
+      if group_by == 'year':
+        return table.row(node.json.get('Date', '')[:4] or 'unknown')
+      if group_by == 'format':
+        return table.row(node.json.get('Format', '').upper() or 'unknown')
+      return album_row
+
+    def add_files(files, album_row):
+      album_groups = set()
+      for node in files:
+        row = group_row(node, album_row)
+        table.add_file(row, node.json.get('ArchivedSize') or 0,
+                       bool(node.json.get('IsVideo')))
+        album_groups.add(row)
+      return album_groups
+
+    roots = []
+    for path in paths:
+      for node in self.iter_glob(user, path):
+        if 'Type' in node:
+          roots.append(node)
+        else:
+          add_files([node], table.row(node.path) if by_path else None)
+
+    # Rows of the folders waiting to be crawled, by node.
+    folder_rows = {}
+    num_threads = self._smugmug.config.get('folder_threads', 4)
+    with tree_crawler.TreeCrawler(num_threads) as crawler:
+      for node, children in crawler.crawl(roots):
+        if self._aborting:
+          return
+        row = folder_rows.pop(node, None)
+        if row is None and by_path and (by_folder or node['Type'] == 'Album'):
+          row = table.row(node.path)
+        if by_folder:
+          for child in children:
+            if 'Type' in child:
+              folder_rows[child] = table.row(child.path, row)
+
+        files = [child for child in children if 'FileName' in child]
+        for album_row in add_files(files, row):
+          table.add_album(album_row)
+        if node['Type'] == 'Album' and not files and row is not None:
+          table.add_album(row)
+
+    if by_folder:
+      table.roll_up()
+      rows = list(table.rows())
+    else:
+      rows = sorted(table.rows())
+
+    print('%15s %9s %9s %8s  %s' % ('Size', 'Images', 'Videos', 'Albums',
+                                    group_by.title()))
+    totals = [0, 0, 0, 0]
+    for key, depth, size, images, videos, albums in rows:
+      if depth == 0:
+        totals = [t + v for t, v in zip(totals, (size, images, videos, albums))]
+      if max_depth is None or depth <= max_depth:
+        print(f'{size:>15,} {images:>9,} {videos:>9,} {albums:>8,}  {key}')
+    if len(rows) > 1 and (not by_folder or len(roots) > 1):
+      size, images, videos, albums = totals
+      print(f'{size:>15,} {images:>9,} {videos:>9,} {albums:>8,}  total')
+
+  def search(self, user, path, text):
+    """Yields the images under `path` matching `text`, using server search."""
+    matched_nodes, unmatched_dirs = self.path_to_node(user, path)
+    if unmatched_dirs:
+      print('"%s" not found in "%s".' % (
+        unmatched_dirs[0], matched_nodes[-1].path))
+      return
+
+    node = matched_nodes[-1]
+    if 'Type' not in node:
+      print(f'{node.path} is not a Folder or Album')
+      return
+    if node.json.get('IsRoot'):
+      scope = '/api/v2/user/%s' % user
+    elif node['Type'] == 'Album':
+      scope = node.uri('Album')
+    else:
+      scope = node.uri('FolderByID')
+
+    for image in self._smugmug.search_images(matched_nodes[0], scope, text):
+      yield image
+
+  def iter_find(self, user, paths, text=None, **predicates):
+    """Yields the nodes under `paths` matching all `predicates`.
+
+    See `node_filter.NodeFilter` for the supported predicates. Raises
+    node_filter.Error if they are invalid.
+    """
+    user = user or self._smugmug.get_auth_user()
+    matcher = node_filter.NodeFilter(**predicates)
+
+    if text:
+      # Let SmugMug find candidates instead of crawling the whole tree.
+      for path in paths:
+        for node in self.search(user, path, text):
+          if self._aborting:
+            return
+          if matcher.matches(node):
+            yield node
+      return
+
+    roots = []
+    for path in paths:
+      for node in self.iter_glob(user, path):
+        if matcher.matches(node):
+          yield node
+        if 'Type' in node and matcher.should_descend(node, 0):
+          roots.append(node)
+
+    # Matches are yielded as the crawl progresses, in depth-first order.
+    num_threads = self._smugmug.config.get('folder_threads', 4)
+    with tree_crawler.TreeCrawler(
+        num_threads, should_descend=matcher.should_descend) as crawler:
+      for _, children in crawler.crawl(roots):
+        if self._aborting:
+          return
+        for child in children:
+          if matcher.matches(child):
+            yield child
+
+  def find(self, user, paths, details, text=None, **predicates):
+    try:
+      for node in self.iter_find(user, paths, text, **predicates):
+        if details:
+          print(json.dumps(node.json, sort_keys=True, indent=2,
+                           separators=(',', ': ')))
+        else:
+          print(node.path)
+    except node_filter.Error as e:
+      print(e)
 
   def cd(self, path):
     user = self._smugmug.get_auth_user()
@@ -268,15 +669,59 @@ class SmugMugFS(object):
       return
     
     self._cwd = newcd
+    self._cwd_nodes = matched_nodes
+    self._cwd_generation = self._smugmug.tree_generation
     print(self._cwd)
 
+  def prefetch_cwd(self):
+    """Start listing the current directory in the background."""
+    if self._cwd_nodes:
+      thread = threading.Thread(target=self._prefetch,
+                                args=(self._cwd_nodes[-1],))
+      thread.daemon = True
+      thread.start()
+
+  def _prefetch(self, node):
+    try:
+      node.get_child_names()
+    except Exception:
+      pass  # The error will be reported if the listing is actually needed.
+
+  def complete_path(self, path):
+    """Returns the remote paths starting with `path`, from cached listings.
+
+    Folders and albums are suffixed with a path separator.
+    """
+    user = self._smugmug.get_auth_user()
+    dirname, _, prefix = path.rpartition(os.sep)
+    if path.startswith(os.sep) and not dirname:
+      dirname = os.sep
+    matched_nodes, unmatched_dirs = self.path_to_node(user, dirname)
+    if unmatched_dirs or 'Type' not in matched_nodes[-1]:
+      return []
+
+    node = matched_nodes[-1]
+    completions = []
+    base = path[:len(path) - len(prefix)]
+    for name in node.get_child_names():
+      if name.startswith(prefix):
+        suffix = os.sep if 'Type' in node.get_children_named(name)[0] else ''
+        completions.append(base + name + suffix)
+    return completions
+
   def pwd(self):
     print(self._cwd)
 
   def make_node(self, user, paths, create_parents, node_type, privacy):
     user = user or self._smugmug.get_auth_user()
+    resolved = self.resolve_paths(user, paths)
+    created_nodes = False
     for path in paths:
-      matched_nodes, unmatched_dirs = self.path_to_node(user, path)
+      matched_nodes, unmatched_dirs = resolved[path]
+      if unmatched_dirs and created_nodes:
+        # Earlier paths may have created some of this path's parents.
+        matched_nodes, unmatched_dirs = self._match_nodes(list(matched_nodes),
+                                                          unmatched_dirs)
       if len(unmatched_dirs) > 1 and not create_parents:
         print('"%s" not found in "%s".' % (
           unmatched_dirs[0], matched_nodes[-1].path))
@@ -288,16 +733,24 @@ class SmugMugFS(object):
 
       self._match_or_create_nodes(
         matched_nodes, unmatched_dirs, node_type, privacy)
+      created_nodes = True
 
   def _ask(self, question):
+    if jobs.current():
+      print(question + 'no (background jobs cannot prompt, use --force)')
+      return False
     answer = input(question)
     return answer.lower() in ['y', 'yes']
 
   def rmdir(self, user, remove_parents, recurse, force, dirs):
     user = user or self._smugmug.get_auth_user()
+    resolved = self.resolve_paths(user, dirs)
+    deleted = set()
     for dir in dirs:
-      matched_nodes, unmatched_dirs = self.path_to_node(user, dir)
-      if unmatched_dirs:
+      matched_nodes, unmatched_dirs = resolved[dir]
+      matched_nodes = list(matched_nodes)
+      if unmatched_dirs or self._has_deleted_ancestor(matched_nodes[-1],
+                                                      deleted):
         print('Folder or album "%s" not found.' % dir)
         continue
 
@@ -319,6 +772,7 @@ class SmugMugFS(object):
           continue;
       print('Removing "%s".' % current_dir)
       node.delete()
+      deleted.add(node)
 
       if remove_parents:
         while matched_nodes:
@@ -327,22 +781,51 @@ class SmugMugFS(object):
             break
           print(f'Removing "{node.path}".')
           node.delete()
+          deleted.add(node)
 
       node.parent.reset_cache()
       
-  def rm(self, user, force, recursive, paths):
+  def iter_rm(self, user, paths, recursive, confirm=None):
+    """Removes the nodes matching `paths`, yielding a Removal for each.
+
+    Args:
+      user: str, the account to remove nodes from.
+      paths: list of str, the paths to remove, possibly with wildcards.
+      recursive: bool, whether non-empty folders and albums can be removed.
+      confirm: function taking a node and returning whether to remove it. All
+          matching nodes are removed by default.
+    """
     user = user or self._smugmug.get_auth_user()
+    resolved = self.resolve_paths(user, paths)
+    deleted = set()
     for path in paths:
-      nodelist = self.resolve_multinodes(user, path, True)
+      nodelist = self.resolve_multinodes(user, path, True,
+                                         resolved=resolved[path])
       for node in nodelist:
-        nodetype = node['Type'] if 'Type' in node else 'File'
+        if self._has_deleted_ancestor(node, deleted):
+          continue
 
         if recursive or 'Type' not in node or len(node.get_children({'count': 1})) == 0:
-          if force or self._ask('Remove %s node "%s"? ' % (nodetype, node.path)):
-            print('Removing "%s".' % node.path)
-            node.delete()
+          if confirm and not confirm(node):
+            yield results.Removal(node.path, node, results.DECLINED)
+            continue
+          node.delete()
+          deleted.add(node)
+          yield results.Removal(node.path, node, results.REMOVED)
         else:
-          print('%s "%s" is not empty.' % (nodetype, node.path))
+          yield results.Removal(node.path, node, results.NOT_EMPTY)
+
+  def rm(self, user, force, recursive, paths):
+    def confirm(node):
+      nodetype = node['Type'] if 'Type' in node else 'File'
+      return self._ask('Remove %s node "%s"? ' % (nodetype, node.path))
+
+    for removal in self.iter_rm(user, paths, recursive,
+                                None if force else confirm):
+      if removal.status == results.REMOVED:
+        print('Removing "%s".' % removal.path)
+      elif removal.status == results.NOT_EMPTY:
+        print('%s "%s" is not empty.' % (removal.node['Type'], removal.path))
 
   def upload(self, user, filenames, album):
     user = user or self._smugmug.get_auth_user()
@@ -375,36 +858,75 @@ class SmugMugFS(object):
 
     node.reset_cache()
 
-  def download(self, user, force, paths):
+  def download(self, user, force, paths, archive=None, threads=4):
     user = user or self._smugmug.get_auth_user()
 
+    if archive:
+      resolved = self.resolve_paths(user, paths)
+      with self._open_archive(archive, threads) as writer:
+        files = []
+        for path in paths:
+          for node in self.resolve_multinodes(user, path, True,
+                                              expand=DOWNLOAD_EXPANSIONS,
+                                              resolved=resolved[path]):
+            if 'FileName' not in node:
+              print(f'{node.name} is not a downloadable file.')
+              continue
+            files.append(node)
+        self._download_to_archive(writer, files, threads)
+      return
+
+    for transfer in self.iter_download(user, paths, force):
+      if transfer.status == results.NOT_A_FILE:
+        print(f'{transfer.node.name} is not a downloadable file.')
+      elif transfer.status == results.ALREADY_EXISTS:
+        print(f'{transfer.path} already exists.')
+      else:
+        print(f'Downloading {transfer.path} ({transfer.size:,}) from '
+              f'{transfer.url}')
+
+  def iter_download(self, user, paths, force=False):
+    """Downloads the files matching `paths` to the current directory.
+
+    Yields:
+      A Transfer for each matched node, once downloaded or skipped.
+    """
+    user = user or self._smugmug.get_auth_user()
+    resolved = self.resolve_paths(user, paths)
     for path in paths:
-      nodelist = self.resolve_multinodes(user, path, True)
+      nodelist = self.resolve_multinodes(user, path, True,
+                                         expand=DOWNLOAD_EXPANSIONS,
+                                         resolved=resolved[path])
       for dlnode in nodelist:
 
         if 'FileName' not in dlnode:
-          print(f'{dlnode.name} is not a downloadable file.')
+          yield results.Transfer(dlnode, None, None, None, results.NOT_A_FILE)
           continue
 
         filename = dlnode['FileName']
 
         if os.path.exists(filename) and not force:
-          print(f'{filename} already exists.')
+          yield results.Transfer(dlnode, None, filename, None,
+                                 results.ALREADY_EXISTS)
           continue
       
-        video = dlnode.json['IsVideo']
-        locator = 'LargestVideo' if video else 'ImageDownload'
-        downloaduri = dlnode.json['Uris'][locator]['Uri']
-        result = self._smugmug.get_json(downloaduri)
-        downloadurl = result['Response'][locator]['Url']
-        size = result['Response']['LargestVideo']['Size'] if video else dlnode.json['ArchivedSize']
-        
-        print(f'Downloading {filename} ({size:,}) from {downloadurl}')
+        downloadurl, size = dlnode.get_download_info()
         self._smugmug.download(downloadurl, filename)
+        yield results.Transfer(dlnode, downloadurl, filename, size,
+                               results.DOWNLOADED)
 
-  def newdn(self, user, force, recurse, paths):
+  def newdn(self, user, force, recurse, paths, archive=None, threads=4):
     user = user or self._smugmug.get_auth_user()
 
+    if archive:
+      with self._open_archive(archive, threads) as writer:
+        files = []
+        for path in paths:
+          for node in self.resolve_multinodes(user, path, True):
+            self._collect_files(node, recurse, files)
+        self._download_to_archive(writer, files, threads)
+      return
+
     albums = []
     files = []
 
@@ -431,6 +953,68 @@ class SmugMugFS(object):
     for album in sorted(albums):
       print(f'  {album.path}')
 
+  def _collect_files(self, node, recurse, files):
+    if 'FileName' in node:
+      files.append(node)
+    elif node['Type'] == 'Album':
+      files.extend(node.get_children(expand=DOWNLOAD_EXPANSIONS))
+    elif node['Type'] == 'Folder' and recurse:
+      for child in node.get_children():
+        self._collect_files(child, recurse, files)
+
+  @contextlib.contextmanager
+  def _open_archive(self, archive, threads):
+    with archive_writer.OrderedArchiveWriter(
+        archive, max_pending=2 * threads) as writer:
+      if archive == '-':
+        # Status messages must not get mixed with the archive on stdout. Only
+        # this command's output is redirected, not other jobs'.
+        previous = jobs.push_stdout(sys.stderr)
+        try:
+          yield writer
+        finally:
+          jobs.restore_stdout(previous)
+      else:
+        yield writer
+
+  def _download_to_archive(self, writer, files, threads):
+    self._smugmug.transport.set_pool_size(transport_lib.DOWNLOAD, threads)
+    with thread_safe_print.ThreadSafePrint(), \
+         thread_pool.ThreadPool(threads, 'download') as pool:
+      for node in files:
+        if self._aborting:
+          break
+        pool.add(self._archive_file, writer, writer.reserve(), node)
+
+  def _archive_file(self, writer, index, node):
+    name = node.path.lstrip(os.sep).replace(os.sep, '/')
+    data = None
+    try:
+      if self._aborting:
+        return
+      url, size = node.get_download_info()
+      data = writer.new_buffer()
+      self._smugmug.download_to(url, data)
+      print(f'Archived {name} ({size or 0:,})')
+    except Exception:
+      if data is not None:
+        data.close()
+        data = None
+      raise
+    finally:
+      writer.add(index, name, self._remote_mtime(node), data)
+
+  def _remote_mtime(self, node):
+    value = node.json.get('LastUpdated') or node.json.get('Date')
+    if not value:
+      return 0
+    timestamp = datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    offset = 0
+    if len(value) > 19 and value[19] in '+-':
+      offset = int(value[20:22]) * 3600 + int(value[23:25]) * 60
+      offset = offset if value[19] == '+' else -offset
+    return calendar.timegm(timestamp.timetuple()) - offset
+
   def _get_common_path(self, matched_nodes, local_dirs):
     new_matched_nodes = []
     unmatched_dirs = list(local_dirs)
@@ -474,10 +1058,22 @@ class SmugMugFS(object):
     else:
       target = target[0]
 
+    self._sync(user, sources, target, force, privacy, folder_threads,
+               file_threads, upload_threads)
+
+  def _sync(self, user, sources, target, force, privacy, folder_threads,
+            file_threads, upload_threads):
+    """Syncs the local `sources` to the `target` folder or album path."""
     # Approximate worse case: each folder and file thread works on a different
     # folder, and all folders are 5 level deep.
     self._smugmug.garbage_collector.set_max_children_cache(
       folder_threads + file_threads + 5)
+    # Size the connection pools for the threads, so none of them has to open
+    # a new connection for each request.
+    transport = self._smugmug.transport
+    transport.set_pool_size(transport_lib.METADATA,
+                            folder_threads + file_threads)
+    transport.set_pool_size(transport_lib.UPLOAD, upload_threads)
 
     # Make sure that the source paths exist.
     globbed = [(source, glob.glob(source)) for source in sources]
@@ -527,9 +1123,9 @@ class SmugMugFS(object):
 
     with task_manager.TaskManager() as manager, \
          thread_safe_print.ThreadSafePrint(), \
-         thread_pool.ThreadPool(upload_threads) as upload_pool, \
-         thread_pool.ThreadPool(file_threads) as file_pool, \
-         thread_pool.ThreadPool(folder_threads) as folder_pool:
+         thread_pool.ThreadPool(upload_threads, 'upload') as upload_pool, \
+         thread_pool.ThreadPool(file_threads, 'file') as file_pool, \
+         thread_pool.ThreadPool(folder_threads, 'folder') as folder_pool:
       for source, walk_steps in sorted(
           [(d, os.walk(d)) for d in dir_sources] +
           [(p + os.sep, [(p, [], f)])
@@ -597,7 +1193,9 @@ class SmugMugFS(object):
         matched = self._match_or_create_nodes(
           matched, unmatched, 'Album', privacy)
       else:
-        print('Found matching remote album "%s".' % os.path.join(*target_dirs))
+        self._sync_action(results.SyncAction(
+          results.FOUND_ALBUM, subdir, os.path.join(*target_dirs),
+          matched[-1], None))
 
       # Iterate in sorted order to make unit tests deterministic.
       for f in sorted(media_files):
@@ -616,6 +1214,8 @@ class SmugMugFS(object):
       file_name = file_path.split(os.sep)[-1].strip()
       with open(file_path, 'rb') as f:
         file_content = f.read()
+      metrics.SYNC_FILES.inc(action='scanned')
+      metrics.SYNC_BYTES.inc(len(file_content), direction='read')
       file_root, file_extension = os.path.splitext(file_name)
       if file_extension.lower() == '.heic':
         # SmugMug converts HEIC files to JPEG and renames them in the process
@@ -634,10 +1234,7 @@ class SmugMugFS(object):
             '%Y-%m-%dT%H:%M:%S')
 
           try:
-            parser = guessParser(StringInputStream(file_content))
-            metadata = extractMetadata(parser)
-            file_time = max(metadata.getValues('last_modification') +
-                            metadata.getValues('creation_date'))
+            file_time = _get_media_time(file_content)
           except Exception as err:
             print('Failed extracting metadata for file "%s".' % file_path)
             file_time = datetime.datetime.fromtimestamp(os.path.getmtime(file_path))
@@ -654,10 +1251,14 @@ class SmugMugFS(object):
         else:
           remote_md5 = remote_file['ArchivedMD5']
           file_md5 = hashlib.md5(file_content).hexdigest()
+          metrics.SYNC_FILES.inc(action='hashed')
           same_file = (remote_md5 == file_md5)
 
         if same_file:
-          return  # File already exists on Smugmug
+          # File already exists on Smugmug
+          self._sync_action(results.SyncAction(
+            results.UNCHANGED, file_path, remote_file.path, node, None))
+          return
 
       if self._aborting:
         return
@@ -673,8 +1274,8 @@ class SmugMugFS(object):
     if self._aborting:
       return
     if remote_file:
-      print('File "%s" exists, but has changed. '
-            'Deleting old version.' % file_path)
+      self._sync_action(results.SyncAction(
+        results.CHANGED, file_path, remote_file.path, node, None))
       remote_file.delete()
       task = '+ Re-uploading "%s"' % file_path
     else:
@@ -690,10 +1291,76 @@ class SmugMugFS(object):
       node.upload('Album', file_name, file_content,
                   progress_fn=get_progress_fn(task))
 
-    if remote_file:
-      print('Re-uploaded "%s".' % file_path)
-    else:
-      print('Uploaded "%s".' % file_path)
+    self._sync_action(results.SyncAction(
+      results.REUPLOADED if remote_file else results.UPLOADED, file_path,
+      os.path.join(node.path, file_name), node, len(file_content)))
+
+  def _sync_action(self, action):
+    """Counts `action` in the metrics, and reports it to _on_sync_action."""
+    if action.action == results.UNCHANGED:
+      metrics.SYNC_FILES.inc(action='skipped')
+    elif action.action in (results.UPLOADED, results.REUPLOADED):
+      metrics.SYNC_FILES.inc(action=('uploaded'
+                                     if action.action == results.UPLOADED
+                                     else 'reuploaded'))
+      metrics.SYNC_BYTES.inc(action.size, direction='sent')
+      metrics.UPLOAD_SIZE.observe(action.size)
+    self._on_sync_action(action)
+
+  def _print_sync_action(self, action):
+    if action.action == results.FOUND_ALBUM:
+      print('Found matching remote album "%s".' % action.remote_path)
+    elif action.action == results.CHANGED:
+      print('File "%s" exists, but has changed. '
+            'Deleting old version.' % action.local_path)
+    elif action.action == results.REUPLOADED:
+      print('Re-uploaded "%s".' % action.local_path)
+    elif action.action == results.UPLOADED:
+      print('Uploaded "%s".' % action.local_path)
+
+  def iter_sync(self, user, sources, target, privacy='public',
+                folder_threads=None, file_threads=None, upload_threads=None):
+    """Syncs local `sources` to the `target` folder or album.
+
+    Sync runs in the background, on a fork of this SmugMugFS, without asking
+    for confirmation. Closing the iterator early aborts it. Messages other than
+    the actions taken, such as errors in the arguments, are still printed.
+
+    Yields:
+      The SyncActions taken, as they happen.
+    """
+    config = self._smugmug.config
+    fs = self.fork()
+    actions = queue.Queue()
+    fs._on_sync_action = actions.put
+    done = object()
+    error = []
+
+    def run():
+      try:
+        fs._sync(user, list(sources), target, True, privacy,
+                 folder_threads or config.get('folder_threads', 4),
+                 file_threads or config.get('file_threads', 16),
+                 upload_threads or config.get('upload_threads', 3))
+      except Exception as e:
+        error.append(e)
+      finally:
+        actions.put(done)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+      while True:
+        action = actions.get()
+        if action is done:
+          break
+        yield action
+    finally:
+      fs.abort()
+      thread.join()
+    if error:
+      raise error[0]
 
   def _is_media(self, path):
     extension = os.path.splitext(path)[1][1:].lower().strip()
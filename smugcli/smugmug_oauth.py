@@ -1,15 +1,13 @@
 # SumgMug OAuth client
+#
+# Signing requests only needs requests_oauthlib. The login flow dependencies
+# (bottle, rauth, webbrowser) are slow to import and only imported by `login`.
 
-import bottle
-import rauth
-import requests
 import requests_oauthlib
 import socket
 import subprocess
 import threading
 from six.moves import urllib
-import webbrowser
-from wsgiref.simple_server import make_server
 
 OAUTH_ORIGIN = 'https://secure.smugmug.com'
 REQUEST_TOKEN_URL = OAUTH_ORIGIN + '/services/oauth/1.0a/getRequestToken'
@@ -20,7 +18,14 @@ API_ORIGIN = 'https://api.smugmug.com'
 
 class SmugMugOAuth(object):
   def __init__(self, api_key):
-    self._service = self._create_service(api_key)
+    self._api_key = api_key
+    self._rauth_service = None
+
+  @property
+  def _service(self):
+    if not self._rauth_service:
+      self._rauth_service = self._create_service(self._api_key)
+    return self._rauth_service
 
   def _get_free_port(self):
     s = socket.socket()
@@ -30,6 +35,10 @@ class SmugMugOAuth(object):
     return port
 
   def request_access_token(self):
+    import bottle
+    import webbrowser
+    from wsgiref.simple_server import make_server
+
     port = self._get_free_port()
     state = {'running': True, 'port': port}
     app = bottle.Bottle()
@@ -77,12 +86,13 @@ class SmugMugOAuth(object):
 
   def get_oauth(self, access_token):
     return requests_oauthlib.OAuth1(
-        self._service.consumer_key,
-        self._service.consumer_secret,
+        self._api_key[0],
+        self._api_key[1],
         resource_owner_key=access_token[0],
         resource_owner_secret=access_token[1])
 
   def _create_service(self, key):
+    import rauth
     return rauth.OAuth1Service(
       name='smugcli',
       consumer_key=key[0],
@@ -100,11 +110,13 @@ class SmugMugOAuth(object):
 
     auth_url = self._service.get_authorize_url(state['request_token'])
     auth_url = self._add_auth_params(auth_url, access='Full', permissions='Modify')
+    import bottle
     bottle.redirect(auth_url)
 
   def _callback(self, state):
     """This route is where we receive the callback after the user accepts or
       rejects the authorization request."""
+    import bottle
     (state['access_token'],
      state['access_token_secret']) = self._service.get_access_token(
        state['request_token'], state['request_token_secret'],
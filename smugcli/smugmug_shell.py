@@ -1,6 +1,9 @@
 # Interactive shell for running smugcli commands
 
+from . import jobs
+
 import cmd
+import datetime
 import os
 import pathlib
 import shlex
@@ -12,11 +15,23 @@ class SmugMugShell(cmd.Cmd):
   intro = 'Welcome to the SmugMug shell.   Type help or ? to list commands.\n'
   baseprompt = '(smugmug) '
   _cmd_list_re = re.compile(r'.*\{([a-z,]+)\}', re.DOTALL)
+  _excluded_commands = ('daemon', 'shell')
 
   def __init__(self, fs):
     cmd.Cmd.__init__(self)
     self._fs = fs
     self.user = fs.smugmug.get_auth_user()
+    self._last_cwd = None
+    self._stdout_router = None
+
+    # Keep the listings of the browsed folders across commands, for a while.
+    config = fs.smugmug.config
+    fs.smugmug.set_tree_cache_ttl(config.get('shell_cache_ttl', 300))
+    fs.smugmug.garbage_collector.set_max_children_cache(
+      config.get('shell_cache_nodes', 256))
+
+    # Commands ending with '&' run in the background, sharing the session.
+    self._jobs = jobs.JobManager(config.get('shell_max_jobs', 2))
 
   def do_exit(self, arg):
     'Exit the shell'
@@ -68,25 +83,103 @@ class SmugMugShell(cmd.Cmd):
     self.prompt = f'({self.user}) {self._fs.cwd}: '
   
   def preloop(self):
+    # Route the output of background jobs away from the terminal.
+    self._stdout_router = jobs.StdoutRouter(sys.stdout)
+    sys.stdout = self._stdout_router
     self.setprompt()
 
+  def postloop(self):
+    sys.stdout = self._stdout_router.stdout
+
+  def do_jobs(self, arg):
+    'List background jobs and the progress of their running tasks'
+    for job in self._jobs.jobs():
+      self._print_job(job)
+      for line in job.progress():
+        print('    ' + line)
+
+  def do_fg(self, arg):
+    'Show the output of a background job (latest by default) until it ends'
+    job = self._get_job(arg)
+    if not job:
+      return
+    print(job.command)
+    index = 0
+    while True:
+      finished = job.finished
+      lines, index = job.read_output(index)
+      for line in lines:
+        print(line)
+      if finished:
+        self._jobs.remove(job)
+        break
+      job.wait(1)
+
+  def do_kill(self, arg):
+    'Abort a background job (latest by default)'
+    job = self._get_job(arg)
+    if job:
+      self._jobs.kill(job)
+
+  def _get_job(self, arg):
+    arg = arg.strip().lstrip('%')
+    try:
+      job = self._jobs.get(int(arg) if arg else None)
+    except ValueError:
+      job = None
+    if not job:
+      print('No such job: %s' % (arg or 'current'))
+    return job
+
+  def _print_job(self, job):
+    print('[%d] %-8s %s  %s' % (
+      job.id, job.state, datetime.timedelta(seconds=int(job.elapsed())),
+      job.command))
+
   def emptyline(self):
     return
   
   def postcmd(self, stop, line):
+    for job in self._jobs.reap():
+      self._print_job(job)
     self.setprompt()
+    if self._fs.cwd != self._last_cwd:
+      self._last_cwd = self._fs.cwd
+      self._fs.prefetch_cwd()
     return stop
+
+  def completedefault(self, text, line, begidx, endidx):
+    # `text` is only the part of the argument after the last completer
+    # delimiter, complete the whole argument and return the matching suffix.
+    path = line[:endidx].split(' ')[-1]
+    try:
+      completions = self._fs.complete_path(path)
+    except Exception:
+      return []
+    return [c[len(path) - len(text):] for c in completions]
   
   @classmethod
   def set_parser(cls, parser):
     usage = parser.format_usage()
-    commands = SmugMugShell._cmd_list_re.match(usage).group(1).split(',')
+    commands = [
+      command
+      for command in SmugMugShell._cmd_list_re.match(usage).group(1).split(',')
+      if command not in SmugMugShell._excluded_commands]
 
     def do_handler(command):
       def handler(self, args):
+        background = args.rstrip().endswith('&')
+        if background:
+          args = args.rstrip()[:-1]
         try:
           parsed = parser.parse_args([command] + shlex.split(args))
-          parsed.func(parsed)
+          if background:
+            job = self._jobs.start(
+              ' '.join([command, args.strip()]),
+              lambda fs: parsed.func(fs, parsed), self._fs.fork())
+            print('[%d] %s' % (job.id, job.command))
+            return
+          parsed.func(self._fs, parsed)
         except SystemExit:
           pass
         except:
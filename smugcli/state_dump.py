@@ -0,0 +1,169 @@
+# Dump of what every worker thread is doing, written on SIGUSR1 to find out
+# why a run appears hung, without interrupting it.
+
+from . import task_manager
+from . import thread_pool
+from . import tracing
+
+import os
+import signal
+import sys
+import threading
+import time
+
+# Longest argument value shown in a task description.
+MAX_ARGUMENT_LENGTH = 80
+
+
+def _format_argument(arg):
+  if isinstance(arg, str):
+    text = repr(arg)
+    if len(text) > MAX_ARGUMENT_LENGTH:
+      text = text[:MAX_ARGUMENT_LENGTH - 4] + '...' + text[-1]
+    return text
+  if isinstance(arg, (int, float, bool)) or arg is None:
+    return repr(arg)
+  return '<%s>' % type(arg).__name__
+
+
+def _format_task(func, args):
+  return '%s(%s)' % (getattr(func, '__name__', repr(func)),
+                     ', '.join(_format_argument(arg) for arg in args))
+
+
+def _format_span(span, now):
+  details = []
+  if span.status is not None:
+    details.append('status %s' % span.status)
+  if span.bytes_out:
+    details.append('%d bytes sent' % span.bytes_out)
+  if span.bytes_in:
+    details.append('%d bytes received' % span.bytes_in)
+  if span.retries:
+    details.append('%d retries' % span.retries)
+  return '%s %s for %.1fs%s' % (
+    span.method, span.endpoint, now - span.start,
+    ' (%s)' % ', '.join(details) if details else '')
+
+
+def get_lines(now=None):
+  """Returns the lines describing the state of the running threads.
+
+  This takes locks which the running threads may hold (queue mutexes, the
+  threading module's, the task managers'), so it must not be called from a
+  signal handler: see `install`.
+  """
+  now = time.time() if now is None else now
+  in_flight = tracing.in_flight()
+  threads = {thread.ident: thread for thread in threading.enumerate()}
+  lines = ['smugcli state at %s:' % time.strftime('%Y-%m-%d %H:%M:%S',
+                                                  time.localtime(now))]
+
+  for pool in thread_pool.running_pools():
+    workers = pool.workers
+    lines.append('Thread pool "%s": %d workers, %d queued tasks' % (
+      pool.name or 'unnamed', len(workers), pool.queue_depth()))
+    for worker in workers:
+      task, start = worker.task, worker.task_start
+      if task is None:
+        lines.append('  %s: idle' % worker.name)
+        continue
+      lines.append('  %s: %s for %.1fs' % (worker.name, _format_task(*task),
+                                           now - start))
+      span = in_flight.pop(worker.ident, None)
+      if span:
+        lines.append('    %s' % _format_span(span, now))
+
+  if in_flight:
+    lines.append('Other requests in flight:')
+    for thread_id, span in sorted(in_flight.items()):
+      thread = threads.get(thread_id)
+      lines.append('  %s: %s' % (thread.name if thread else thread_id,
+                                 _format_span(span, now)))
+
+  tasks = [task for manager in task_manager.active_managers()
+           for task in manager.get_tasks()]
+  if tasks:
+    lines.append('Tasks in progress:')
+    for text, thread, start in tasks:
+      owner = ''
+      if thread:
+        owner = ' (%s, %.1fs)' % (thread.name, now - start)
+      lines.append('  %s%s' % (text, owner))
+  return lines
+
+
+def dump(stream):
+  """Writes the state of the running threads to `stream`."""
+  stream.write('\n'.join(get_lines()) + '\n')
+  stream.flush()
+
+
+class _Dumper(object):
+  """Thread writing a dump each time it is woken up through a pipe.
+
+  Signal handlers run on the main thread, between two bytecodes: dumping
+  from the handler would deadlock if the main thread holds one of the locks
+  the dump needs, and so would waking up a thread with a lock based Event.
+  The handler only writes a byte to a pipe, which takes no lock.
+  """
+
+  def __init__(self):
+    self.path = None
+    self._read_fd, self._write_fd = os.pipe()
+    os.set_blocking(self._write_fd, False)
+    thread = threading.Thread(target=self._run, name='state_dump')
+    thread.daemon = True
+    thread.start()
+
+  def request(self):
+    try:
+      os.write(self._write_fd, b'.')
+    except BlockingIOError:
+      pass  # Plenty of dumps are pending already.
+
+  def _run(self):
+    while True:
+      # Requests arriving while dumping are served by a single dump.
+      os.read(self._read_fd, 512)
+      path = self.path
+      # Whatever goes wrong, keep serving the next requests.
+      try:
+        text = '\n'.join(get_lines()) + '\n'
+        if path:
+          with open(path, 'a') as f:
+            f.write(text)
+        else:
+          sys.stderr.write(text)
+          sys.stderr.flush()
+      except Exception as e:
+        sys.stderr.write('Could not dump the state to "%s": %s: %s\n' % (
+          path or 'stderr', type(e).__name__, e))
+
+
+_dumper = None
+
+
+def install(path=None):
+  """Dumps the state of the running threads on SIGUSR1.
+
+  The dumps are written by a dedicated thread, the signal handler only wakes
+  it up.
+
+  Args:
+    path: str, optional file to which the dumps are appended, stderr being
+        used otherwise.
+  """
+  global _dumper
+  if not hasattr(signal, 'SIGUSR1'):
+    # Not available on Windows.
+    return
+  if _dumper is None:
+    _dumper = _Dumper()
+  _dumper.path = path
+  dumper = _dumper
+
+  def signal_handler(signum, frame):
+    dumper.request()
+
+  signal.signal(signal.SIGUSR1, signal_handler)
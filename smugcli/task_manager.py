@@ -1,22 +1,38 @@
+from . import jobs
 from . import terminal_size
 
 import collections
 import os
-import sys
 import time
 import threading
+import weakref
 
 if os.name == 'nt':
   import colorama
   colorama.init()
 
 
+# The task managers currently in use, for state dumps.
+_active_managers = weakref.WeakSet()
+
+
+def active_managers():
+  """Returns the task managers currently in use."""
+  while True:
+    try:
+      return list(_active_managers)
+    except RuntimeError:
+      # Changed while copied, try again.
+      pass
+
+
 class TaskGuard(object):
   def __init__(self, task_manager, category, task, status=''):
     self._task_manager = task_manager
     self._category = category
     self._task = task
     self._task_manager.update_progress(category, task, status)
+    self._task_manager.task_started(category, task)
 
   def __enter__(self):
     return self
@@ -29,21 +45,35 @@ class TaskManager(object):
 
   def __init__(self):
     self._tasks_in_progress = collections.defaultdict(dict)
+    # {(category, task): (thread, start time)} of the started tasks.
+    self._task_owners = {}
     self._mutex = threading.RLock()
     self._last_update_time = 0
 
   def __enter__(self):
-    self._original_stdout = sys.stdout
-    sys.stdout = self
+    # Background jobs don't draw their status on the terminal, it is shown on
+    # demand by the shell instead.
+    self._job = jobs.current()
+    if self._job:
+      self._job.task_manager = self
+    self._original_stdout = jobs.push_stdout(self)
+    _active_managers.add(self)
     return self
 
   def __exit__(self, type, value, traceback):
+    _active_managers.discard(self)
     with self._mutex:
-      sys.stdout = self._original_stdout
-      self._original_stdout.write('\033[J')
+      jobs.restore_stdout(self._original_stdout)
+      if self._job:
+        self._job.task_manager = None
+      else:
+        self._original_stdout.write('\033[J')
 
   def write(self, string):
     with self._mutex:
+      if self._job:
+        self._original_stdout.write(string)
+        return
       self._original_stdout.write('\033[J' + string + self.get_status_string())
       self._original_stdout.flush()
       self._last_update_time = time.time()
@@ -57,8 +87,15 @@ class TaskManager(object):
       if time.time() > self._last_update_time + 0.05:
         self.print_status()
 
+  def task_started(self, category, task):
+    """Records that the current thread started working on `task`."""
+    with self._mutex:
+      self._task_owners[(category, task)] = (threading.current_thread(),
+                                             time.time())
+
   def task_completed(self, category, task):
     with self._mutex:
+      self._task_owners.pop((category, task), None)
       del self._tasks_in_progress[category][task]
       if not self._tasks_in_progress[category]:
         del self._tasks_in_progress[category]
@@ -76,8 +113,22 @@ class TaskManager(object):
         os.linesep)
       return text + '\033[%dA\r' % (len(text.split(os.linesep))-1)
 
+  def get_status_lines(self):
+    with self._mutex:
+      return ['%s%s' % (t, s)
+              for _, tasks in sorted(self._tasks_in_progress.items())
+              for t, s in sorted(tasks.items())]
+
+  def get_tasks(self):
+    """Returns [(task and status, thread or None, start time or None)]."""
+    with self._mutex:
+      return [('%s%s' % (t, s),) + self._task_owners.get((c, t), (None, None))
+              for c, tasks in sorted(self._tasks_in_progress.items())
+              for t, s in sorted(tasks.items())]
+
   def print_status(self):
-    self.write('')
+    if not self._job:
+      self.write('')
 
   def _clip_long_line(self, string, max_length):
     if len(string) > max_length:
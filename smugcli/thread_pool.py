@@ -1,7 +1,12 @@
+from . import jobs
+from . import metrics
+
+import functools
 import six
 from six.moves import queue
 import threading
 import time
+import weakref
 #import traceback
 
 
@@ -12,19 +17,30 @@ class Worker(threading.Thread):
     super(Worker, self).__init__()
     self._task_queue = task_queue
     self._thread_pool = thread_pool
+    # Work on behalf of the job which created the pool, if any.
+    self._job = jobs.current()
+    # The (func, args) being run, and since when, for state dumps.
+    self.task = None
+    self.task_start = None
 
   def run(self):
+    jobs.set_current(self._job)
     while True:
       try:
         func, args, kwargs = self._task_queue.get(timeout=1)
         try:
           if func:
+            self.task_start = time.time()
+            self.task = (func, args)
             func(*args, **kwargs)
         except Exception as e:
           print(six.text_type(e))
           # traceback.print_exc()
         finally:
+          self.task = None
           self._task_queue.task_done()
+          if func:
+            self._thread_pool._task_done()
       except queue.Empty as e:
         pass
 
@@ -32,22 +48,71 @@ class Worker(threading.Thread):
         return
 
 
+# The thread pools currently running, for state dumps and metrics.
+_running_pools = weakref.WeakSet()
+_running_pools_mutex = threading.Lock()
+
+
+def running_pools():
+  """Returns the thread pools currently running."""
+  while True:
+    try:
+      return list(_running_pools)
+    except RuntimeError:
+      # Changed while copied, try again.
+      pass
+
+
+def _queue_depth(name):
+  """Returns the tasks waiting in all the running pools named `name`."""
+  return sum(pool.queue_depth() for pool in running_pools()
+             if pool.name == name)
+
+
 class ThreadPool:
-  """Pool of threads consuming tasks from a queue"""
-  def __init__(self, num_threads):
+  """Pool of threads consuming tasks from a queue.
+
+  Args:
+    num_threads: int, the number of worker threads.
+    name: str, optional name under which the pool's queue depth is exported
+        in the metrics, while the pool is running. The depths of pools
+        running concurrently under the same name are added up.
+  """
+  def __init__(self, num_threads, name=None):
     self._tasks = queue.Queue(num_threads)
     self._threads = []
     self._aborting = False
+    self._name = name
+    # Number of tasks added and not done yet, see `wait`.
+    self._unfinished_tasks = 0
+    self._all_tasks_done = threading.Condition()
     for _ in range(num_threads):
       t = Worker(self, self._tasks)
       t.daemon = True
       t.start()
       self._threads.append(t)
+    with _running_pools_mutex:
+      _running_pools.add(self)
+      if name:
+        metrics.THREAD_POOL_QUEUE_DEPTH.set_function(
+          functools.partial(_queue_depth, name), pool=name)
 
   @property
   def aborting(self):
     return self._aborting
 
+  @property
+  def name(self):
+    return self._name
+
+  @property
+  def workers(self):
+    return list(self._threads)
+
+  def queue_depth(self):
+    """Returns the number of tasks waiting for a worker."""
+    return self._tasks.qsize()
+
   def add(self, func, *args, **kwargs):
     """Add a task thread pool.
 
@@ -56,8 +121,27 @@ class ThreadPool:
       args: argument list for `func`.
       kwargs: keyword arguments for `func`.
     """
+    with self._all_tasks_done:
+      self._unfinished_tasks += 1
     self._tasks.put((func, args, kwargs))
 
+  def _task_done(self):
+    with self._all_tasks_done:
+      self._unfinished_tasks -= 1
+      if not self._unfinished_tasks:
+        self._all_tasks_done.notify_all()
+
+  def wait(self):
+    """Wait for all the tasks added so far to be executed.
+
+    Unlike `join`, the worker threads are kept alive so that more tasks can be
+    added afterward.
+    """
+    # Wait with a timeout to allow for ctrl-C interrupts.
+    with self._all_tasks_done:
+      while self._unfinished_tasks:
+        self._all_tasks_done.wait(1)
+
   def join(self):
     """Wait for all the tasks to be executed in the thread pool."""
 
@@ -72,6 +156,12 @@ class ThreadPool:
       while t.is_alive():
         t.join(1)
 
+    with _running_pools_mutex:
+      _running_pools.discard(self)
+      if self._name and not any(pool.name == self._name
+                                for pool in running_pools()):
+        metrics.THREAD_POOL_QUEUE_DEPTH.remove(pool=self._name)
+
   def _stop_workers(self, signum=None, frame=None):
     self._aborting = True
 
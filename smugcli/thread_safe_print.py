@@ -2,9 +2,10 @@
 # atomically. This ensures that two lines won't be printed entangled with
 # each other.
 
+from . import jobs
+
 import os
 import six
-import sys
 import threading
 
 
@@ -14,13 +15,12 @@ thread_local = threading.local()
 class ThreadSafePrint(object):
 
   def __enter__(self):
-    self._original_stdout = sys.stdout
     self._mutex = threading.Lock()
-    sys.stdout = self
+    self._original_stdout = jobs.push_stdout(self)
     return self
 
   def __exit__(self, type, value, traceback):
-    sys.stdout = self._original_stdout
+    jobs.restore_stdout(self._original_stdout)
 
   def write(self, string):
     if not hasattr(thread_local, 'stdout'):
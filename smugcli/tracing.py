@@ -0,0 +1,269 @@
+# Tracing of the requests sent to SmugMug: one span per API call, handed to
+# pluggable exporters.
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# The span of the call made by the current thread, see Tracer.span.
+_local = threading.local()
+
+# The spans of the calls in flight, by thread id, for state dumps.
+_in_flight = {}
+
+
+def endpoint_template(path):
+  """Returns `path` with its resource id replaced, for grouping calls.
+
+  For instance "/api/v2/node/abc!children?start=1" becomes
+  "/api/v2/node/{id}!children", and "/api/v2/folder/user/nick/A!albums"
+  "/api/v2/folder/{id}!albums".
+  """
+  parts = path.split('?')[0].split('/')
+  # /api/v2/<type>/<id...>[!<method>]
+  if len(parts) <= 4:
+    return '/'.join(parts)
+  method = parts[-1].partition('!')[2]
+  return '/'.join(parts[:4] + ['{id}' + ('!' + method if method else '')])
+
+
+class Span(object):
+  """Timings and sizes of one API call, possibly retried.
+
+  Durations are in seconds: `queue_wait` is the time spent waiting for a
+  pooled connection, `connect` the DNS resolution and TCP connection and `tls`
+  the TLS handshake of new connections, `ttfb` the time until the response
+  headers were received and `total` the duration of the whole call, including
+  reading the response and retries.
+
+  While exported, `request` and `response` are the last request sent and its
+  response, if any. They are detached once exported, so that retaining spans
+  doesn't retain request and response bodies.
+  """
+
+  FIELDS = ('start', 'method', 'endpoint', 'status', 'bytes_out', 'bytes_in',
+            'queue_wait', 'connect', 'tls', 'ttfb', 'total', 'retries',
+            'error')
+
+  def __init__(self, method, endpoint):
+    self.start = time.time()
+    self.method = method
+    self.endpoint = endpoint
+    self.status = None
+    self.bytes_out = 0
+    self.bytes_in = 0
+    self.queue_wait = 0.0
+    self.connect = 0.0
+    self.tls = 0.0
+    self.ttfb = None
+    self.total = None
+    self.retries = 0
+    self.error = None
+    self.request = None
+    self.response = None
+    self._mutex = threading.Lock()
+
+  def add(self, field, value):
+    """Adds `value` to a numeric field, e.g. from several threads."""
+    with self._mutex:
+      setattr(self, field, getattr(self, field) + value)
+
+  def set_response(self, request, response, read_body=True):
+    """Records the `request` sent and its `response`.
+
+    Args:
+      request: requests.PreparedRequest, the request sent.
+      response: requests.Response, its response.
+      read_body: bool, whether the response body has been read, its size
+          then being counted. Streamed bodies are counted by the caller.
+    """
+    self.request = request
+    self.response = response
+    self.status = response.status_code
+    body = request.body
+    self.bytes_out = len(body) if body is not None else 0
+    self.ttfb = response.elapsed.total_seconds()
+    if read_body:
+      self.bytes_in = len(response.content or b'')
+
+  def to_dict(self):
+    return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def current():
+  """Returns the span of the call made by the current thread, or None."""
+  return getattr(_local, 'span', None)
+
+
+def in_flight():
+  """Returns {thread id: span} of the calls in flight."""
+  return dict(_in_flight)
+
+
+def record(field, value):
+  """Adds `value` to `field` of the current span, if any."""
+  span = current()
+  if span:
+    span.add(field, value)
+
+
+def bind(func):
+  """Returns `func` wrapped to record to the current thread's span."""
+  span = current()
+  def bound(*args, **kwargs):
+    previous = current()
+    _local.span = span
+    try:
+      return func(*args, **kwargs)
+    finally:
+      _local.span = previous
+  return bound
+
+
+class Tracer(object):
+  """Creates the spans of API calls and hands them to exporters.
+
+  An exporter is any object with an `export(span)` method, called from the
+  thread which made the call once it is complete.
+  """
+
+  def __init__(self):
+    self._exporters = []
+
+  def add_exporter(self, exporter):
+    self._exporters.append(exporter)
+
+  def remove_exporter(self, exporter):
+    self._exporters.remove(exporter)
+
+  @contextlib.contextmanager
+  def exporting(self, exporter):
+    """Exports spans to `exporter` within the context."""
+    self.add_exporter(exporter)
+    try:
+      yield exporter
+    finally:
+      self.remove_exporter(exporter)
+
+  @contextlib.contextmanager
+  def span(self, method, endpoint):
+    """Traces the call made by the current thread in the context."""
+    span = Span(method, endpoint)
+    previous = current()
+    _local.span = span
+    thread_id = threading.get_ident()
+    _in_flight[thread_id] = span
+    try:
+      yield span
+    except Exception as e:
+      span.error = type(e).__name__
+      raise
+    finally:
+      _local.span = previous
+      if previous:
+        _in_flight[thread_id] = previous
+      else:
+        del _in_flight[thread_id]
+      span.total = time.time() - span.start
+      for exporter in list(self._exporters):
+        exporter.export(span)
+      span.request = None
+      span.response = None
+
+
+class RingBufferExporter(object):
+  """Keeps the last `capacity` spans in memory."""
+
+  def __init__(self, capacity=1000):
+    self._spans = collections.deque(maxlen=capacity)
+    self._mutex = threading.Lock()
+
+  def export(self, span):
+    with self._mutex:
+      self._spans.append(span)
+
+  def spans(self):
+    with self._mutex:
+      return list(self._spans)
+
+
+class JsonlExporter(object):
+  """Appends spans to the file `path`, one JSON object per line."""
+
+  def __init__(self, path):
+    self._file = open(path, 'a')
+    self._mutex = threading.Lock()
+
+  def export(self, span):
+    line = json.dumps(span.to_dict(), sort_keys=True)
+    with self._mutex:
+      self._file.write(line + '\n')
+      self._file.flush()
+
+  def close(self):
+    with self._mutex:
+      self._file.close()
+
+
+class SummaryExporter(object):
+  """Aggregates spans per method and endpoint, for printing a summary table."""
+
+  COLUMNS = ('calls', 'errors', 'retries', 'bytes_out', 'bytes_in',
+             'queue_wait', 'connect', 'tls', 'ttfb', 'total')
+
+  def __init__(self):
+    self._rows = collections.defaultdict(collections.Counter)
+    self._mutex = threading.Lock()
+
+  def export(self, span):
+    with self._mutex:
+      row = self._rows[(span.method, span.endpoint)]
+      row['calls'] += 1
+      row['errors'] += 1 if span.error or (span.status or 0) >= 400 else 0
+      for column in self.COLUMNS[2:]:
+        row[column] += getattr(span, column) or 0
+
+  def rows(self):
+    """Returns [(method, endpoint, {column: total})], slowest first."""
+    with self._mutex:
+      rows = [(method, endpoint, {c: row[c] for c in self.COLUMNS})
+              for (method, endpoint), row in self._rows.items()]
+    return sorted(rows, key=lambda row: -row[2]['total'])
+
+  def table(self):
+    """Returns the summary as lines of text.
+
+    Besides counts and sizes, it shows the total time spent waiting for
+    connections, setting up connections (connect and TLS), the average time to
+    first byte and the average and total duration of the calls.
+    """
+    header = '%-6s %-36s %6s %6s %7s %11s %11s %8s %8s %8s %8s %10s'
+    row_format = ('%-6s %-36s %6d %6d %7d %11d %11d %8.2f %8.2f %8.3f %8.3f '
+                  '%10.2f')
+    lines = [header % ('Method', 'Endpoint', 'Calls', 'Errors', 'Retries',
+                       'Sent', 'Received', 'Wait', 'Setup', 'TTFB', 'Avg',
+                       'Total (s)')]
+    for method, endpoint, row in self.rows():
+      lines.append(row_format % (
+        method, endpoint, row['calls'], row['errors'], row['retries'],
+        row['bytes_out'], row['bytes_in'], row['queue_wait'],
+        row['connect'] + row['tls'], row['ttfb'] / row['calls'],
+        row['total'] / row['calls'], row['total']))
+    return lines
+
+
+class RequestLog(object):
+  """Appends the (request, response) of each call to the list `log`.
+
+  Unlike other exporters, it retains whole requests and responses, bodies
+  included. It is meant for recording the API calls of short tests.
+  """
+
+  def __init__(self, log):
+    self._log = log
+
+  def export(self, span):
+    if span.request is not None and span.response is not None:
+      self._log.append((span.request, span.response))
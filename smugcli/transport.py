@@ -0,0 +1,552 @@
+# HTTP transport used by the SmugMug client: one connection pool per kind of
+# traffic, sized from the configured thread counts, with usage counters,
+# timeouts and a watchdog aborting stalled transfers.
+
+from . import tracing
+
+import collections
+import concurrent.futures
+import contextlib
+import socket
+import threading
+import time
+
+import requests
+from requests import adapters
+from urllib3 import connectionpool
+
+# Kinds of traffic, each using its own pool of connections.
+METADATA = 'metadata'
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+LANES = (METADATA, UPLOAD, DOWNLOAD)
+
+# Headroom of the metadata pool: connections beyond the worker threads' needs,
+# kept for the listings made by other threads (e.g. the main thread, or the
+# shell). This is not a priority: requests are served in no particular order,
+# the headroom only makes it unlikely that connections run out.
+HEADROOM_CONNECTIONS = 2
+
+COUNTERS = ('requests', 'hits', 'misses', 'reconnects', 'discarded')
+HEDGE_COUNTERS = ('hedgeable', 'hedged', 'hedge_wins', 'hedge_denied')
+
+# Hedging of metadata GETs, enabled with the `hedge_requests` config value:
+# the fraction of extra requests hedges may add (`hedge_budget` config value),
+# how many latencies are kept to estimate the p95 and how many are needed
+# before starting to hedge.
+DEFAULT_HEDGE_BUDGET = 0.05
+HEDGE_LATENCY_WINDOW = 1000
+HEDGE_MIN_SAMPLES = 20
+
+# Default (connect, read) timeouts of each lane, in seconds. The upload read
+# timeout is long as SmugMug only replies once it has processed the file.
+# Override with the `<lane>_connect_timeout` and `<lane>_read_timeout` config
+# values.
+DEFAULT_TIMEOUTS = {
+  METADATA: (10, 60),
+  UPLOAD: (10, 300),
+  DOWNLOAD: (10, 60),
+}
+
+# How long, in seconds, an upload or download may go without transferring any
+# byte before the watchdog aborts it, and how many times it is then retried.
+DEFAULT_STALL_TIMEOUT = 60
+DEFAULT_TRANSFER_RETRIES = 3
+
+# Delay before the first retry of a transfer, doubled for each following one.
+RETRY_DELAY = 1
+
+# The transfer watched on the current thread, see Watchdog.watch, and whether
+# it is prewarming connections, see Transport.prewarm.
+_local = threading.local()
+
+
+class Error(Exception):
+  """Base class for all exception of this module."""
+
+
+class StalledTransferError(Error):
+  """Error raised when the watchdog aborted a transfer making no progress."""
+
+
+# Errors after which a transfer is worth retrying.
+RETRYABLE_ERRORS = (StalledTransferError,
+                    requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+
+class PoolStats(object):
+  """Thread-safe usage counters of a connection pool.
+
+  `hits` counts requests sent on a pooled connection, `misses` the ones for
+  which a new connection had to be created, `reconnects` pooled connections
+  which had to connect again (e.g. after the server closed them) and
+  `discarded` connections closed because the pool was full.
+  """
+
+  def __init__(self):
+    self._counts = collections.Counter()
+    self._mutex = threading.Lock()
+
+  def count(self, counter, value=1):
+    with self._mutex:
+      self._counts[counter] += value
+
+  def get(self):
+    with self._mutex:
+      counts = {counter: self._counts[counter] for counter in COUNTERS}
+    counts['hits'] = counts['requests'] - counts['misses']
+    return counts
+
+
+def _counting_pool_class(base, stats):
+  """Returns a subclass of the urllib3 pool `base` updating `stats`."""
+
+  class CountingPool(base):
+    def _get_conn(self, timeout=None):
+      if getattr(_local, 'prewarming', False):
+        # Connections opened ahead of time serve no request, don't count them.
+        return super(CountingPool, self)._get_conn(timeout)
+      stats.count('requests')
+      start = time.time()
+      conn = super(CountingPool, self)._get_conn(timeout)
+      tracing.record('queue_wait', time.time() - start)
+      transfer = getattr(_local, 'transfer', None)
+      if transfer:
+        # Let the watchdog abort the transfer by shutting its socket down.
+        transfer.connection = conn
+      return conn
+
+    def _new_conn(self):
+      if not getattr(_local, 'prewarming', False):
+        stats.count('misses')
+      conn = super(CountingPool, self)._new_conn()
+      connect = conn.connect
+      open_socket = conn._new_conn
+      connected = []
+      socket_times = []
+      def timed_open_socket():
+        # Resolves the host and opens the TCP connection.
+        start = time.time()
+        try:
+          return open_socket()
+        finally:
+          socket_times.append(time.time() - start)
+      def counting_connect(*args, **kwargs):
+        if connected:
+          stats.count('reconnects')
+        connected.append(True)
+        del socket_times[:]
+        start = time.time()
+        try:
+          return connect(*args, **kwargs)
+        finally:
+          socket_time = sum(socket_times)
+          tracing.record('connect', socket_time)
+          tracing.record('tls', time.time() - start - socket_time)
+      conn._new_conn = timed_open_socket
+      conn.connect = counting_connect
+      return conn
+
+    def _put_conn(self, conn):
+      if self.pool is not None and self.pool.full():
+        stats.count('discarded')
+      super(CountingPool, self)._put_conn(conn)
+
+  return CountingPool
+
+
+class _CountingAdapter(adapters.HTTPAdapter):
+  def __init__(self, stats, pool_size):
+    self._stats = stats
+    super(_CountingAdapter, self).__init__(pool_connections=4,
+                                           pool_maxsize=pool_size)
+
+  def init_poolmanager(self, *args, **kwargs):
+    super(_CountingAdapter, self).init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {
+      'http': _counting_pool_class(connectionpool.HTTPConnectionPool,
+                                   self._stats),
+      'https': _counting_pool_class(connectionpool.HTTPSConnectionPool,
+                                    self._stats),
+    }
+
+
+class TransferWatch(object):
+  """Progress of an upload or download, as seen by the watchdog."""
+
+  def __init__(self):
+    self.connection = None
+    self.bytes = 0
+    self.stalled = False
+    self._watching = True
+    self._last_progress = time.time()
+
+  def progress(self, num_bytes):
+    """Records that `num_bytes` more bytes have been transferred."""
+    self.bytes += num_bytes
+    self._last_progress = time.time()
+
+  def pause(self):
+    """Stops watching, e.g. while waiting for the server to process data."""
+    self._watching = False
+
+  def is_stalled(self, now, stall_timeout):
+    return self._watching and now - self._last_progress > stall_timeout
+
+  def abort(self):
+    """Aborts the transfer, making its pending socket operations fail."""
+    self.stalled = True
+    self._watching = False
+    sock = getattr(self.connection, 'sock', None)
+    if sock:
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+
+
+class Watchdog(object):
+  """Aborts the watched transfers making no progress for `stall_timeout`.
+
+  Timeouts only bound single socket operations, while a transfer trickling a
+  few bytes at a time, or stuck on a half-open connection, can hold a worker
+  thread for much longer. The watchdog thread shuts the socket of such
+  transfers down, the transfer then failing with StalledTransferError.
+  """
+
+  def __init__(self, stall_timeout):
+    self._stall_timeout = stall_timeout
+    self._transfers = set()
+    self._mutex = threading.Lock()
+    self._stopped = None
+    self.aborted = 0
+
+  @contextlib.contextmanager
+  def watch(self):
+    """Watches the transfer made by the current thread in the context."""
+    transfer = TransferWatch()
+    with self._mutex:
+      self._transfers.add(transfer)
+      if self._stopped is None:
+        self._stopped = threading.Event()
+        threading.Thread(target=self._run, args=(self._stopped,),
+                         daemon=True).start()
+    previous = getattr(_local, 'transfer', None)
+    _local.transfer = transfer
+    try:
+      yield transfer
+    except requests.RequestException as e:
+      if transfer.stalled:
+        raise StalledTransferError(
+          'Transfer stalled for more than %ds.' % self._stall_timeout) from e
+      raise
+    finally:
+      _local.transfer = previous
+      with self._mutex:
+        self._transfers.discard(transfer)
+
+  def _run(self, stopped):
+    while not stopped.wait(min(1, self._stall_timeout / 4)):
+      now = time.time()
+      with self._mutex:
+        stalled = [transfer for transfer in self._transfers
+                   if transfer.is_stalled(now, self._stall_timeout)]
+        self.aborted += len(stalled)
+      for transfer in stalled:
+        transfer.abort()
+
+  def stop(self):
+    with self._mutex:
+      if self._stopped:
+        self._stopped.set()
+        self._stopped = None
+
+
+class Hedger(object):
+  """Sends a duplicate of idempotent requests which are slow to answer.
+
+  A request still unanswered after the p95 of the recently observed
+  latencies is sent again, on another connection, and the first successful
+  answer is used: an error status (e.g. a 401 or a 503) only wins if the other
+  request fails too. At most `budget` hedges are sent per hedgeable request.
+  """
+
+  def __init__(self, budget):
+    self._budget = budget
+    self._latencies = collections.deque(maxlen=HEDGE_LATENCY_WINDOW)
+    self._counts = collections.Counter()
+    self._mutex = threading.Lock()
+    self._executor = None
+
+  def p95(self):
+    """Returns the p95 of the observed latencies, or None if too few."""
+    with self._mutex:
+      if len(self._latencies) < HEDGE_MIN_SAMPLES:
+        return None
+      latencies = sorted(self._latencies)
+    return latencies[int(len(latencies) * 0.95)]
+
+  def stats(self):
+    with self._mutex:
+      return {counter: self._counts[counter] for counter in HEDGE_COUNTERS}
+
+  def _timed(self, send, request):
+    start = time.time()
+    response = send(request)
+    return response, time.time() - start
+
+  def _take_budget(self):
+    with self._mutex:
+      if self._counts['hedged'] + 1 > self._budget * self._counts['hedgeable']:
+        self._counts['hedge_denied'] += 1
+        return False
+      self._counts['hedged'] += 1
+      return True
+
+  def send(self, send, request, prepare_hedge, max_workers):
+    """Sends `request` with `send`, hedging it if it is slow to answer.
+
+    Args:
+      send: callable, sending a prepared request and returning the response.
+      request: requests.PreparedRequest, the request to send.
+      prepare_hedge: callable, returning the request to send as the hedge.
+          Signed requests must be signed again, as servers reject replayed
+          nonces.
+      max_workers: int, the number of requests which may be in flight.
+    """
+    with self._mutex:
+      self._counts['hedgeable'] += 1
+      if self._executor is None:
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+      executor = self._executor
+    delay = self.p95()
+    timed = tracing.bind(self._timed)
+    primary = executor.submit(timed, send, request)
+    pending = [primary]
+    if delay is not None:
+      done, _ = concurrent.futures.wait(pending, delay)
+      if not done and self._take_budget():
+        pending.append(executor.submit(timed, send, prepare_hedge()))
+    error = None
+    failed_response = None
+    while pending:
+      done, _ = concurrent.futures.wait(
+        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      # Prefer the primary when both answered.
+      future = primary if primary in done else done.pop()
+      pending.remove(future)
+      try:
+        response, latency = future.result()
+      except requests.RequestException as e:
+        # Wait for the other request, if any.
+        error = error or e
+        continue
+      if response.status_code >= 400 and pending:
+        # Wait for the other request, which may succeed.
+        failed_response = response
+        continue
+      if failed_response is not None:
+        failed_response.close()
+      for loser in pending:
+        loser.add_done_callback(_close_response)
+      with self._mutex:
+        self._latencies.append(latency)
+        if future is not primary:
+          self._counts['hedge_wins'] += 1
+      return response
+    if failed_response is not None:
+      return failed_response
+    raise error
+
+  def close(self):
+    with self._mutex:
+      executor, self._executor = self._executor, None
+    if executor:
+      executor.shutdown(wait=False)
+
+
+def _close_response(future):
+  if not future.exception():
+    future.result()[0].close()
+
+
+class Transport(object):
+  """Sends requests on separate, independently sized, connection pools.
+
+  Metadata API calls, uploads and downloads each have their own session so
+  that long transfers never hold the connections listings need, and each pool
+  is sized for the threads using it, so that connections are reused instead of
+  being discarded and re-established. The metadata pool gets
+  HEADROOM_CONNECTIONS extra connections, but no scheduling priority.
+
+  Args:
+    config: dict, the smugcli config, providing the thread counts.
+  """
+
+  def __init__(self, config):
+    self._sessions = {}
+    # Sessions replaced by larger ones, which may still be in use.
+    self._retired_sessions = []
+    self._sizes = {}
+    self._stats = {lane: PoolStats() for lane in LANES}
+    self._mutex = threading.Lock()
+    self._timeouts = {
+      lane: (config.get('%s_connect_timeout' % lane, connect_timeout),
+             config.get('%s_read_timeout' % lane, read_timeout))
+      for lane, (connect_timeout, read_timeout) in DEFAULT_TIMEOUTS.items()}
+    self._watchdog = Watchdog(
+      config.get('stall_timeout', DEFAULT_STALL_TIMEOUT))
+    self._transfer_retries = config.get('transfer_retries',
+                                        DEFAULT_TRANSFER_RETRIES)
+    self._hedger = None
+    if config.get('hedge_requests', False):
+      self._hedger = Hedger(config.get('hedge_budget', DEFAULT_HEDGE_BUDGET))
+    self.set_pool_size(METADATA, config.get('folder_threads', 4) +
+                       config.get('file_threads', 16))
+    self.set_pool_size(UPLOAD, config.get('upload_threads', 3))
+    self.set_pool_size(DOWNLOAD, config.get('download_threads', 4))
+
+  def set_pool_size(self, lane, num_threads):
+    """Sizes the pool of `lane` for at least `num_threads` concurrent requests.
+
+    Pools only grow: commands running concurrently (background jobs, the
+    daemon) share the transport, and may still be using the current pool.
+    The session it replaces is therefore only closed along with the transport.
+    """
+    size = num_threads + (HEADROOM_CONNECTIONS if lane == METADATA else 0)
+    with self._mutex:
+      if self._sizes.get(lane, 0) >= size:
+        return
+      session = requests.Session()
+      adapter = _CountingAdapter(self._stats[lane], size)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      previous = self._sessions.get(lane)
+      if previous:
+        self._retired_sessions.append(previous)
+      self._sessions[lane] = session
+      self._sizes[lane] = size
+
+  def prewarm(self, lane, url, count):
+    """Opens `count` pooled connections to the host of `url` in background.
+
+    Warming is best effort: connections which fail to open are simply left
+    for the first requests to open.
+
+    Returns:
+      The warming thread.
+    """
+    thread = threading.Thread(target=self._prewarm, args=(lane, url, count),
+                              daemon=True)
+    thread.start()
+    return thread
+
+  def _prewarm(self, lane, url, count):
+    with self._mutex:
+      session = self._sessions[lane]
+      count = min(count, self._sizes[lane])
+    adapter = session.get_adapter(url)
+    request = requests.Request('GET', url).prepare()
+    try:
+      if hasattr(adapter, 'get_connection_with_tls_context'):
+        pool = adapter.get_connection_with_tls_context(request, verify=True)
+      else:
+        pool = adapter.get_connection(url)
+        adapter.cert_verify(pool, url, True, None)
+    except Exception:
+      return
+    # Take all the connections out of the pool before connecting them, so that
+    # distinct ones are warmed, and connect them concurrently.
+    _local.prewarming = True
+    try:
+      conns = [pool._get_conn() for _ in range(count)]
+    finally:
+      _local.prewarming = False
+    def connect(conn):
+      conn.timeout = self._timeouts[lane][0]
+      try:
+        conn.connect()
+      except Exception:
+        conn.close()
+    threads = [threading.Thread(target=connect, args=(conn,), daemon=True)
+               for conn in conns]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    for conn in conns:
+      pool._put_conn(conn)
+
+  def pool_size(self, lane):
+    return self._sizes[lane]
+
+  def timeout(self, lane):
+    """Returns the (connect, read) timeouts of `lane`'s requests."""
+    return self._timeouts[lane]
+
+  def send(self, lane, request, hedge=None, **kwargs):
+    """Sends a prepared request using the connections of `lane`.
+
+    Args:
+      lane: str, the kind of traffic, one of LANES.
+      request: requests.PreparedRequest, the request to send.
+      hedge: optional callable, given for idempotent requests which may be
+          hedged if hedging is enabled, returning a newly prepared copy of
+          `request`, e.g. `requests.Request.prepare`.
+      **kwargs: forwarded to requests.Session.send.
+    """
+    kwargs.setdefault('timeout', self._timeouts[lane])
+    session = self._sessions[lane]
+    if hedge and self._hedger:
+      # Both the request and its hedge may be in flight for each thread.
+      return self._hedger.send(lambda r: session.send(r, **kwargs), request,
+                               hedge, 2 * self._sizes[lane])
+    return session.send(request, **kwargs)
+
+  def transfer(self, attempt, can_retry=None):
+    """Runs an upload or download, retrying it if it stalls or times out.
+
+    Args:
+      attempt: callable, taking the TransferWatch to report progress to and
+          returning the result of the transfer.
+      can_retry: optional callable, taking the TransferWatch of a failed
+          attempt and returning whether retrying it is safe.
+
+    Returns:
+      The result of the first successful attempt.
+    """
+    for retry in range(self._transfer_retries + 1):
+      try:
+        with self._watchdog.watch() as watch:
+          return attempt(watch)
+      except RETRYABLE_ERRORS as e:
+        if (retry == self._transfer_retries or
+            (can_retry and not can_retry(watch))):
+          raise
+        print('%s Retrying (%d/%d).' % (e, retry + 1, self._transfer_retries))
+        tracing.record('retries', 1)
+        time.sleep(RETRY_DELAY * 2 ** retry)
+
+  def stats(self):
+    """Returns the usage counters of each lane's pool, see PoolStats.
+
+    When hedging is enabled, the metadata lane also counts the hedgeable
+    requests, the hedges sent, the ones answering first and the ones denied
+    by the hedge budget.
+    """
+    stats = {lane: self._stats[lane].get() for lane in LANES}
+    if self._hedger:
+      stats[METADATA].update(self._hedger.stats())
+    return stats
+
+  def close(self):
+    self._watchdog.stop()
+    if self._hedger:
+      self._hedger.close()
+    with self._mutex:
+      sessions = list(self._sessions.values()) + self._retired_sessions
+      self._retired_sessions = []
+    for session in sessions:
+      session.close()
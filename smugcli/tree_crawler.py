@@ -0,0 +1,153 @@
+# Parallel crawler listing a SmugMug node tree, yielding listings in a
+# deterministic depth-first order.
+
+from . import jobs
+
+import heapq
+import threading
+
+_QUEUED = 'queued'
+_FETCHING = 'fetching'
+_DONE = 'done'
+
+
+class _Entry(object):
+  def __init__(self, key, node):
+    self.key = key
+    self.node = node
+    self.state = _QUEUED
+    self.children = None
+    self.child_entries = []
+    self.error = None
+
+  def __lt__(self, other):
+    return self.key < other.key
+
+
+class TreeCrawler(object):
+  """Lists a tree of nodes using multiple threads, in depth-first order.
+
+  Listings are fetched by a pool of worker threads, nearest-first in the
+  depth-first order, while `crawl` yields them strictly in that order as soon
+  as the next one is available. At most `max_pending` listings are fetched
+  ahead of the consumer, bounding memory usage on very large trees.
+
+  If the consumer reaches a listing no worker has started yet, it fetches it
+  itself, so the crawl always makes progress.
+
+  Args:
+    num_threads: int, number of listings fetched in parallel.
+    max_pending: int, maximum number of listings fetched ahead of the consumer.
+        Defaults to 4 times `num_threads`.
+    should_descend: function taking a node and its depth below the crawled
+        root, and returning whether its children must be crawled. By default,
+        all folders and albums are crawled.
+  """
+
+  def __init__(self, num_threads, max_pending=None, should_descend=None):
+    self._max_pending = max_pending or 4 * num_threads
+    self._should_descend = should_descend or (lambda node, depth: True)
+    self._cond = threading.Condition()
+    self._heap = []
+    self._pending = 0
+    self._stopping = False
+    self._threads = []
+    for _ in range(num_threads):
+      thread = threading.Thread(target=jobs.bind(self._worker))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def crawl(self, roots):
+    """Yields (node, children) for each node of the trees rooted at `roots`.
+
+    Nodes are yielded in depth-first pre-order. `children` is the list of the
+    node's children, fetched once.
+    """
+    with self._cond:
+      entries = [self._submit((i,), root) for i, root in enumerate(roots)]
+
+    stack = list(reversed(entries))
+    while stack:
+      entry = stack.pop()
+      self._wait_for(entry)
+      if entry.error is not None:
+        raise entry.error
+      yield entry.node, entry.children
+      stack.extend(reversed(entry.child_entries))
+      # Drop references so that consumed listings can be freed.
+      entry.children = None
+      entry.child_entries = None
+
+  def close(self):
+    with self._cond:
+      self._stopping = True
+      self._cond.notify_all()
+    for thread in self._threads:
+      thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
+
+  def _submit(self, key, node):
+    # Must be called with self._cond held.
+    entry = _Entry(key, node)
+    heapq.heappush(self._heap, entry)
+    self._cond.notify()
+    return entry
+
+  def _fetch(self, entry):
+    try:
+      children = list(entry.node.get_children())
+      error = None
+    except Exception as e:
+      children = []
+      error = e
+
+    with self._cond:
+      entry.child_entries = [
+        self._submit(entry.key + (i,), child)
+        for i, child in enumerate(children)
+        if 'Type' in child and self._should_descend(child, len(entry.key))]
+      entry.children = children
+      entry.error = error
+      entry.state = _DONE
+      self._cond.notify_all()
+
+  def _wait_for(self, entry):
+    with self._cond:
+      if entry.state == _QUEUED:
+        # Nobody started this listing yet, fetch it right away.
+        entry.state = _FETCHING
+        fetch_here = True
+      else:
+        fetch_here = False
+        while entry.state != _DONE:
+          self._cond.wait(1)
+        self._pending -= 1
+        self._cond.notify_all()
+
+    if fetch_here:
+      self._fetch(entry)
+
+  def _worker(self):
+    while True:
+      with self._cond:
+        entry = None
+        while not self._stopping:
+          if self._pending < self._max_pending:
+            while self._heap and self._heap[0].state != _QUEUED:
+              heapq.heappop(self._heap)
+            if self._heap:
+              entry = heapq.heappop(self._heap)
+              break
+          self._cond.wait(1)
+        if entry is None:
+          return
+        entry.state = _FETCHING
+        self._pending += 1
+
+      self._fetch(entry)
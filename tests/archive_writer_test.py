@@ -0,0 +1,68 @@
+from smugcli import archive_writer
+
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+import zipfile
+
+
+class TestOrderedArchiveWriter(unittest.TestCase):
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _add(self, writer, index, name, content):
+    data = writer.new_buffer()
+    data.write(content)
+    writer.add(index, name, 1546344000, data)
+
+  def test_entries_are_written_in_reservation_order(self):
+    path = os.path.join(self._dir, 'out.tar')
+    with archive_writer.OrderedArchiveWriter(path, max_pending=3) as writer:
+      indexes = [writer.reserve() for _ in range(3)]
+      self._add(writer, indexes[2], 'c.jpg', b'ccc')
+      self._add(writer, indexes[0], 'a.jpg', b'a')
+      writer.add(indexes[1], 'b.jpg', 0, None)  # Skipped entry.
+
+    with tarfile.open(path) as tar:
+      members = tar.getmembers()
+      self.assertEqual([m.name for m in members], ['a.jpg', 'c.jpg'])
+      self.assertEqual(members[0].mtime, 1546344000)
+      self.assertEqual(tar.extractfile(members[1]).read(), b'ccc')
+
+  def test_zip_format(self):
+    path = os.path.join(self._dir, 'out.zip')
+    with archive_writer.OrderedArchiveWriter(path, max_pending=1) as writer:
+      self._add(writer, writer.reserve(), 'folder/a.jpg', b'abc')
+
+    with zipfile.ZipFile(path) as archive:
+      self.assertEqual(archive.namelist(), ['folder/a.jpg'])
+      self.assertEqual(archive.read('folder/a.jpg'), b'abc')
+
+  def test_reserve_blocks_when_too_many_entries_are_pending(self):
+    path = os.path.join(self._dir, 'out.tar')
+    with archive_writer.OrderedArchiveWriter(path, max_pending=1) as writer:
+      first = writer.reserve()
+      reserved = threading.Event()
+
+      def reserve_second():
+        writer.reserve()
+        reserved.set()
+
+      thread = threading.Thread(target=reserve_second)
+      thread.start()
+      self.assertFalse(reserved.wait(0.1))
+      self._add(writer, first, 'a.jpg', b'a')
+      self.assertTrue(reserved.wait(5))
+      thread.join()
+      writer.add(1, 'b.jpg', 0, None)
+
+
+if __name__ == '__main__':
+  unittest.main()
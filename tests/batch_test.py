@@ -0,0 +1,133 @@
+from smugcli import batch
+from smugcli import jobs
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+
+class FakeFS(object):
+  def __init__(self, log):
+    self.aborting = False
+    self._log = log
+
+  def abort(self):
+    self.aborting = True
+
+  def fork(self):
+    return FakeFS(self._log)
+
+
+def make_parser(log, events):
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers()
+
+  echo_parser = subparsers.add_parser('echo')
+  echo_parser.add_argument('words', nargs='*')
+  echo_parser.set_defaults(func=lambda fs, a: print(' '.join(a.words)))
+
+  spam_parser = subparsers.add_parser('spam')
+  spam_parser.add_argument('count', type=int)
+  spam_parser.set_defaults(
+    func=lambda fs, a: [print('line %d' % i) for i in range(a.count)])
+
+  def sync(fs, a):
+    # Like the real sync parser, `source` greedily takes the target too.
+    name = ' '.join(a.source)
+    log.append('start ' + name)
+    # Let the test control when syncs complete.
+    events[a.source[0]].wait(5)
+    log.append('end ' + name)
+    print('synced ' + name)
+  sync_parser = subparsers.add_parser('sync')
+  sync_parser.add_argument('source', nargs='*')
+  sync_parser.add_argument('target', nargs='?', default=[os.sep])
+  sync_parser.add_argument('-f', '--force', action='store_true')
+  sync_parser.set_defaults(func=sync)
+  return parser
+
+
+class TestBatch(unittest.TestCase):
+
+  def setUp(self):
+    self._log = []
+    self._events = {name: threading.Event() for name in ('a', 'b', 'c')}
+    self._parser = make_parser(self._log, self._events)
+    self._stdout = sys.stdout
+    sys.stdout = self._output = io.StringIO()
+
+  def tearDown(self):
+    sys.stdout = self._stdout
+
+  def _run(self, content):
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+      f.write(content)
+    try:
+      batch.run(FakeFS(self._log), f.name, self._parser, 4)
+    finally:
+      os.remove(f.name)
+    return self._output.getvalue()
+
+  def testParse(self):
+    groups = batch.parse([
+      '# Comment',
+      'echo "hello world"',
+      '',
+      'a -> /Album',
+      'wait',
+      'b → /Folder/Album'], self._parser)
+    self.assertEqual([[e.argv for e in group] for group in groups], [
+      [['echo', 'hello world'], ['sync', '-f', 'a', '/Album']],
+      [['sync', '-f', 'b', '/Folder/Album']]])
+    self.assertEqual(groups[0][1].target, '/Album')
+
+  def testParseErrors(self):
+    with self.assertRaisesRegex(batch.InvalidBatchError, 'batch:2: .*bogus'):
+      batch.parse(['echo', 'bogus'], self._parser)
+    with self.assertRaisesRegex(batch.InvalidBatchError,
+                                'batch:1: "shell" can\'t run in a batch'):
+      batch.parse(['shell'], self._parser)
+
+  def testOutputInFileOrder(self):
+    # The second sync completes first, but is printed second.
+    self._events['b'].set()
+    threading.Timer(0.1, self._events['a'].set).start()
+    output = self._run('a -> /A\nb -> /B\necho done\n')
+    self.assertEqual(output.splitlines(), [
+      '[1] sync -f a /A',
+      'synced a /A',
+      '[2] sync -f b /B',
+      'synced b /B',
+      '[3] echo done',
+      'done',
+      'Batch complete: 3 commands, 0 failed.'])
+    self.assertLess(self._log.index('end b /B'), self._log.index('end a /A'))
+
+  def testLongOutputOfJobRunningAheadIsKept(self):
+    # The spam command completes while the sync is still printed.
+    count = jobs.DEFAULT_MAX_OUTPUT_LINES + 500
+    threading.Timer(0.2, self._events['a'].set).start()
+    output = self._run('a -> /A\nspam %d\n' % count).splitlines()
+    self.assertEqual(output[:3], ['[1] sync -f a /A', 'synced a /A',
+                                  '[2] spam %d' % count])
+    self.assertEqual(output[3:-1], ['line %d' % i for i in range(count)])
+
+  def testOverlappingTargetsAndBarriers(self):
+    for event in self._events.values():
+      event.set()
+    self._run('a -> /Folder\nb -> /Folder/Album\nwait\nc -> /Other\n')
+    self.assertEqual(self._log, [
+      'start a /Folder', 'end a /Folder',
+      'start b /Folder/Album', 'end b /Folder/Album',
+      'start c /Other', 'end c /Other'])
+
+  def testInvalidFile(self):
+    output = self._run('echo ok\nbogus\n').splitlines()
+    self.assertEqual(len(output), 1)
+    self.assertIn(':2: ', output[0])
+    # Nothing ran, not even the valid command.
+    self.assertNotIn('ok', output)
@@ -0,0 +1,116 @@
+from smugcli import daemon
+from smugcli import smugcli
+
+import io
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+
+class FakeFS(object):
+  def __init__(self):
+    self.aborting = False
+    self.forks = []
+
+  def abort(self):
+    self.aborting = True
+
+  def fork(self):
+    fs = FakeFS()
+    self.forks.append(fs)
+    return fs
+
+
+@unittest.skipUnless(hasattr(daemon.socket, 'AF_UNIX'), 'Needs Unix sockets')
+class TestDaemon(unittest.TestCase):
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._path = os.path.join(self._dir, 'smugcli.sock')
+    self._fs = FakeFS()
+    self._commands = []
+    self._thread = threading.Thread(
+      target=daemon.serve, args=(self._fs, self._path, self._dispatch))
+    self._thread.start()
+    # Wait for the daemon to listen.
+    while True:
+      connection = daemon._connect(self._path)
+      if connection:
+        connection.close()
+        break
+      self._thread.join(0.01)
+
+  def tearDown(self):
+    if self._thread.is_alive():
+      daemon.stop(self._path)
+    self._thread.join()
+    shutil.rmtree(self._dir)
+
+  def _dispatch(self, fs, args):
+    self._commands.append((fs, args, os.getcwd()))
+    if args[0] == 'ask':
+      print('Sure? ', end='')
+      print('answer: ' + input())
+    elif args[0] == 'fail':
+      sys.exit(3)
+    else:
+      print(' '.join(args))
+      sys.stderr.write('warning\n')
+
+  def _forward(self, args, stdin=''):
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = daemon.forward(args, args[0], self._path, io.StringIO(stdin),
+                            stdout, stderr)
+    return status, stdout.getvalue(), stderr.getvalue()
+
+  def testForward(self):
+    self.assertEqual(self._forward(['ls', '-l', '/']),
+                     (0, 'ls -l /\n', 'warning\n'))
+    self.assertEqual(self._forward(['pwd']), (0, 'pwd\n', 'warning\n'))
+    # Each command runs with a fork of the daemon's fs, in the client's cwd.
+    self.assertEqual([c[0] for c in self._commands], self._fs.forks)
+    self.assertEqual(self._commands[0][2], os.getcwd())
+
+  def testSocketIsPrivate(self):
+    self.assertEqual(stat.S_IMODE(os.stat(self._path).st_mode), 0o600)
+
+  def testInput(self):
+    self.assertEqual(self._forward(['ask'], stdin='yes\n'),
+                     (0, 'Sure? answer: yes\n', ''))
+
+  def testExitStatus(self):
+    self.assertEqual(self._forward(['fail']), (3, '', ''))
+
+  def testLocalCommandsAreNotForwarded(self):
+    self.assertIsNone(daemon.forward(['shell'], 'shell', self._path))
+    self.assertIsNone(daemon.forward(['-V', 'login'], 'login', self._path))
+    self.assertEqual(self._commands, [])
+
+  def testStop(self):
+    daemon.stop(self._path)
+    self._thread.join()
+    self.assertFalse(os.path.exists(self._path))
+    self.assertIsNone(daemon.forward(['ls'], 'ls', self._path))
+
+  def testAbort(self):
+    self._fs.abort()
+    self._thread.join()
+    self.assertFalse(os.path.exists(self._path))
+
+
+class TestCommandName(unittest.TestCase):
+
+  def testOptionValuesAreSkipped(self):
+    self.assertEqual(smugcli.command_name(['ls', '-l', '/']), 'ls')
+    self.assertEqual(smugcli.command_name(['-V', 'login']), 'login')
+    self.assertEqual(smugcli.command_name(['--trace', 't.jsonl', 'login']),
+                     'login')
+    self.assertEqual(smugcli.command_name(
+      ['--profile', '--profile_output', 'out', '--metrics_textfile=m.prom',
+       'shell']), 'shell')
+    self.assertIsNone(smugcli.command_name(['--trace_summary']))
@@ -0,0 +1,36 @@
+from smugcli import disk_usage
+
+import unittest
+
+
+class TestUsageTable(unittest.TestCase):
+
+  def test_roll_up_accumulates_subtrees(self):
+    table = disk_usage.UsageTable()
+    root = table.row('/')
+    folder = table.row('/Folder', root)
+    album = table.row('/Folder/Album', folder)
+    other = table.row('/Other', root)
+    table.add_file(album, 100, False)
+    table.add_file(album, 1000, True)
+    table.add_album(album)
+    table.add_file(other, 10, False)
+    table.add_album(other)
+    table.roll_up()
+
+    self.assertEqual(list(table.rows()), [
+      ('/', 0, 1110, 2, 1, 2),
+      ('/Folder', 1, 1100, 1, 1, 1),
+      ('/Folder/Album', 2, 1100, 1, 1, 1),
+      ('/Other', 1, 10, 1, 0, 1)])
+
+  def test_rows_are_shared_by_key(self):
+    table = disk_usage.UsageTable()
+    table.add_file(table.row('2019'), 5, False)
+    table.add_file(table.row('2019'), 7, False)
+    self.assertEqual(len(table), 1)
+    self.assertEqual(list(table.rows()), [('2019', 0, 12, 2, 0, 0)])
+
+
+if __name__ == '__main__':
+  unittest.main()
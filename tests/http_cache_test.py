@@ -0,0 +1,149 @@
+from smugcli import http_cache
+from smugcli import smugmug
+
+import os
+import responses
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+
+class TestHttpCache(unittest.TestCase):
+
+  def setUp(self):
+    self._directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._directory)
+
+  def test_get_put(self):
+    cache = http_cache.HttpCache(self._directory)
+    self.assertIsNone(cache.get('a'))
+    cache.put('a', '"etag"', 'Mon, 01 Jan 2024 00:00:00 GMT', '{"x": 1}')
+    entry = cache.get('a')
+    self.assertEqual(entry.body, '{"x": 1}')
+    self.assertEqual(entry.conditional_headers(), {
+      'If-None-Match': '"etag"',
+      'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+    # Persisted across instances.
+    self.assertEqual(http_cache.HttpCache(self._directory).get('a'), entry)
+
+  def test_replies_without_validators_are_not_cached(self):
+    cache = http_cache.HttpCache(self._directory)
+    cache.put('a', None, None, '{}')
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(os.listdir(self._directory), [])
+
+  def test_least_recently_used_entries_are_evicted(self):
+    cache = http_cache.HttpCache(self._directory)
+    cache.put('a', 'e', None, 'x' * 100)
+    entry_size = cache.size()
+    # Room for two entries, even once evicted down to the low water mark.
+    cache = http_cache.HttpCache(self._directory,
+                                 max_bytes=int(2.5 * entry_size))
+    cache.put('b', 'e', None, 'x' * 100)
+    cache.get('a')
+    cache.put('c', 'e', None, 'x' * 100)
+    self.assertIsNotNone(cache.get('a'))
+    self.assertIsNone(cache.get('b'))
+    self.assertIsNotNone(cache.get('c'))
+    self.assertEqual(cache.size(), 2 * entry_size)
+    self.assertEqual(len(os.listdir(self._directory)), 2)
+
+  def test_full_cache_is_not_scanned_on_every_write(self):
+    cache = http_cache.HttpCache(self._directory)
+    cache.put('a', 'e', None, 'x' * 100)
+    entry_size = cache.size()
+    cache = http_cache.HttpCache(self._directory, max_bytes=50 * entry_size)
+    scan = cache._scan
+    scans = []
+    def counting_scan():
+      scans.append(1)
+      return scan()
+    cache._scan = counting_scan
+    for i in range(400):
+      cache.put(str(i), 'e', None, 'x' * 100)
+    self.assertLessEqual(cache.size(), 50 * entry_size)
+    # Eviction frees 10% of the cache, which is then filled without a scan.
+    self.assertLess(len(scans), 400 / 4)
+
+  def test_temporary_file_removed_on_failure(self):
+    cache = http_cache.HttpCache(self._directory)
+    with mock.patch.object(http_cache.os, 'replace', side_effect=OSError):
+      with self.assertRaises(OSError):
+        cache.put('a', 'e', None, '{}')
+    self.assertEqual(os.listdir(self._directory), [])
+
+  def test_caches_are_shared_across_processes(self):
+    cache1 = http_cache.HttpCache(self._directory)
+    cache1.put('a', 'e', None, 'x' * 100)
+    entry_size = cache1.size()
+    cache1 = http_cache.HttpCache(self._directory, max_bytes=2 * entry_size)
+    cache2 = http_cache.HttpCache(self._directory, max_bytes=2 * entry_size)
+    self.assertIsNone(cache1.get('b'))
+    cache2.put('b', 'e', None, 'x' * 100)
+    # Entries written by another process are seen...
+    self.assertIsNotNone(cache1.get('b'))
+    # ...and the bound applies to the cache as a whole.
+    cache1.put('c', 'e', None, 'x' * 100)
+    cache2.put('d', 'e', None, 'x' * 100)
+    self.assertEqual(cache1.size(), 2 * entry_size)
+    self.assertIsNone(cache2.get('a'))
+    self.assertIsNotNone(cache2.get('d'))
+
+  def test_clear(self):
+    cache = http_cache.HttpCache(self._directory)
+    cache.put('a', 'e', None, '{}')
+    cache.clear()
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(cache.size(), 0)
+
+
+class TestSmugMugHttpCache(unittest.TestCase):
+
+  def setUp(self):
+    self._directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._directory)
+    self._smugmug = smugmug.FakeSmugMug(
+      http_cache=http_cache.HttpCache(self._directory))
+
+  @responses.activate
+  def test_revalidates_cached_replies(self):
+    url = smugmug.API_ROOT + '/api/v2/user/nick'
+    responses.add(responses.GET, url, json={'Response': {'User': 1}},
+                  headers={'ETag': '"v1"'})
+    responses.add(responses.GET, url, status=304)
+    self.assertEqual(self._smugmug.get_json('/api/v2/user/nick'),
+                     {'Response': {'User': 1}})
+    self.assertEqual(self._smugmug.get_json('/api/v2/user/nick'),
+                     {'Response': {'User': 1}})
+    self.assertNotIn('If-None-Match', responses.calls[0].request.headers)
+    self.assertEqual(responses.calls[1].request.headers['If-None-Match'],
+                     '"v1"')
+
+  @responses.activate
+  def test_access_token_is_not_stored(self):
+    self._smugmug.config['access_token'] = ['secret-token', 'secret']
+    url = smugmug.API_ROOT + '/api/v2/user/nick'
+    responses.add(responses.GET, url, json={'Response': {'User': 1}},
+                  headers={'ETag': '"v1"'})
+    self._smugmug.get_json('/api/v2/user/nick')
+    names = os.listdir(self._directory)
+    self.assertEqual(len(names), 1)
+    with open(os.path.join(self._directory, names[0])) as f:
+      self.assertNotIn('secret-token', f.read())
+
+  @responses.activate
+  def test_changed_replies_are_updated(self):
+    url = smugmug.API_ROOT + '/api/v2/user/nick'
+    responses.add(responses.GET, url, json={'Response': {'User': 1}},
+                  headers={'ETag': '"v1"'})
+    responses.add(responses.GET, url, json={'Response': {'User': 2}},
+                  headers={'ETag': '"v2"'})
+    responses.add(responses.GET, url, status=304)
+    self._smugmug.get_json('/api/v2/user/nick')
+    self.assertEqual(self._smugmug.get_json('/api/v2/user/nick'),
+                     {'Response': {'User': 2}})
+    self.assertEqual(self._smugmug.get_json('/api/v2/user/nick'),
+                     {'Response': {'User': 2}})
+    self.assertEqual(responses.calls[2].request.headers['If-None-Match'],
+                     '"v2"')
@@ -0,0 +1,129 @@
+from smugcli import jobs
+from smugcli import task_manager
+from smugcli import thread_pool
+from smugcli import thread_safe_print
+
+import io
+import sys
+import threading
+import unittest
+
+
+class FakeFS(object):
+  def __init__(self):
+    self.aborted = threading.Event()
+
+  def abort(self):
+    self.aborted.set()
+
+
+class TestJob(unittest.TestCase):
+
+  def testOutputLines(self):
+    job = jobs.Job(1, 'cmd', FakeFS(), max_lines=3)
+    job.write('a\nb')
+    self.assertEqual(job.read_output(0), (['a'], 1))
+    job.write('c\nd\ne\n')
+    # Only the last 3 lines are kept.
+    self.assertEqual(job.read_output(1), (['bc', 'd', 'e'], 4))
+    self.assertEqual(job.read_output(0), (['bc', 'd', 'e'], 4))
+    self.assertEqual(job.read_output(3), (['e'], 4))
+    self.assertEqual(job.read_output(4), ([], 4))
+
+  def testPartialLineFlushedWhenFinished(self):
+    job = jobs.Job(1, 'cmd', FakeFS(), max_lines=10)
+    job.write('no newline')
+    job._set_state('done')
+    self.assertEqual(job.read_output(0), (['no newline'], 1))
+
+
+class TestStdoutRouter(unittest.TestCase):
+
+  def setUp(self):
+    self._stdout = sys.stdout
+    self._terminal = io.StringIO()
+    sys.stdout = jobs.StdoutRouter(self._terminal)
+
+  def tearDown(self):
+    sys.stdout = self._stdout
+
+  def testJobOutputIsCaptured(self):
+    job = jobs.Job(1, 'cmd', FakeFS(), max_lines=10)
+
+    def run():
+      jobs.set_current(job)
+      print('from job')
+      with thread_pool.ThreadPool(2) as pool:
+        pool.add(print, 'from worker')
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    print('from shell')
+
+    self.assertEqual(job.read_output(0)[0], ['from job', 'from worker'])
+    self.assertEqual(self._terminal.getvalue(), 'from shell\n')
+
+  def testTaskManagerOnlyTakesOverItsJob(self):
+    job = jobs.Job(1, 'cmd', FakeFS(), max_lines=10)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def run():
+      jobs.set_current(job)
+      with task_manager.TaskManager() as manager, \
+           thread_safe_print.ThreadSafePrint():
+        manager.update_progress('Uploading', 'a.jpg', ': 50%')
+        print('job line')
+        started.set()
+        finish.wait()
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.wait()
+    self.assertEqual(job.progress(), ['a.jpg: 50%'])
+    print('shell line')
+    finish.set()
+    thread.join()
+
+    self.assertEqual(job.progress(), [])
+    self.assertEqual(job.read_output(0)[0], ['job line'])
+    # No status drawing escape codes reach the terminal.
+    self.assertEqual(self._terminal.getvalue(), 'shell line\n')
+
+
+class TestJobManager(unittest.TestCase):
+
+  def testRunAndReap(self):
+    manager = jobs.JobManager(max_running=1)
+    job = manager.start('cmd', lambda fs: print('done'), FakeFS())
+    while not job.finished:
+      job.wait(1)
+    self.assertEqual(job.state, 'done')
+    self.assertEqual(manager.reap(), [job])
+    self.assertEqual(manager.reap(), [])
+    self.assertEqual(manager.get(), job)
+    manager.remove(job)
+    self.assertIsNone(manager.get())
+
+  def testKill(self):
+    manager = jobs.JobManager(max_running=1)
+    running = manager.start('first', lambda fs: fs.aborted.wait(), FakeFS())
+    queued = manager.start('second', lambda fs: None, FakeFS())
+    self.assertEqual(manager.get(), queued)
+    self.assertEqual(manager.get(1), running)
+
+    manager.kill(queued)
+    manager.kill(running)
+    for job in (running, queued):
+      while not job.finished:
+        job.wait(1)
+      self.assertEqual(job.state, 'killed')
+
+  def testFailure(self):
+    manager = jobs.JobManager(max_running=2)
+    def fail(fs):
+      raise ValueError('oops')
+    job = manager.start('cmd', fail, FakeFS())
+    while not job.finished:
+      job.wait(1)
+    self.assertEqual(job.state, 'failed')
+    self.assertIn('ValueError: oops', job.read_output(0)[0])
@@ -0,0 +1,120 @@
+from smugcli import metrics
+from smugcli import thread_pool
+from smugcli import tracing
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class TestRegistry(unittest.TestCase):
+
+  def setUp(self):
+    self._registry = metrics.Registry()
+
+  def test_render(self):
+    files = self._registry.counter('files_total', 'Files.', ['action'])
+    files.inc(action='uploaded')
+    files.inc(2, action='skipped')
+    depth = self._registry.gauge('queue_depth', 'Depth.', ['pool'])
+    depth.set_function(lambda: 3, pool='a "b"')
+    sizes = self._registry.histogram('size_bytes', 'Sizes.', buckets=[10, 100])
+    sizes.observe(5)
+    sizes.observe(50)
+    sizes.observe(500)
+    self.assertEqual(self._registry.render(), '\n'.join([
+      '# HELP files_total Files.',
+      '# TYPE files_total counter',
+      'files_total{action="skipped"} 2',
+      'files_total{action="uploaded"} 1',
+      '# HELP queue_depth Depth.',
+      '# TYPE queue_depth gauge',
+      'queue_depth{pool="a \\"b\\""} 3',
+      '# HELP size_bytes Sizes.',
+      '# TYPE size_bytes histogram',
+      'size_bytes_bucket{le="10"} 1',
+      'size_bytes_bucket{le="100"} 2',
+      'size_bytes_bucket{le="+Inf"} 3',
+      'size_bytes_sum 555',
+      'size_bytes_count 3',
+      '']))
+
+  def test_summary(self):
+    self._registry.counter('files_total', 'Files.', ['action']).inc(
+      action='uploaded')
+    self._registry.histogram('size_bytes', 'Sizes.', buckets=[10]).observe(5)
+    self.assertEqual(self._registry.summary(), {
+      'files_total': {'type': 'counter', 'help': 'Files.', 'values': [
+        {'labels': {'action': 'uploaded'}, 'value': 1}]},
+      'size_bytes': {'type': 'histogram', 'help': 'Sizes.', 'values': [
+        {'labels': {}, 'count': 1, 'sum': 5,
+         'buckets': {'10': 1, '+Inf': 1}}]}})
+
+  def test_labels_are_checked(self):
+    counter = self._registry.counter('files_total', 'Files.', ['action'])
+    with self.assertRaises(ValueError):
+      counter.inc(status='ok')
+    with self.assertRaises(ValueError):
+      self._registry.gauge('files_total', 'Files.')
+
+
+class TestMetrics(unittest.TestCase):
+
+  def test_thread_pool_queue_depth(self):
+    with thread_pool.ThreadPool(1, 'test'):
+      self.assertIn('smugcli_thread_pool_queue_depth{pool="test"} 0',
+                    metrics.REGISTRY.render())
+    self.assertNotIn('pool="test"', metrics.REGISTRY.render())
+
+  def test_thread_pools_with_the_same_name(self):
+    release = threading.Event()
+    self.addCleanup(release.set)
+    with thread_pool.ThreadPool(1, 'shared') as pool1:
+      with thread_pool.ThreadPool(1, 'shared') as pool2:
+        # Keep each worker busy, with one more task waiting in each queue.
+        for pool in (pool1, pool2):
+          pool.add(release.wait)
+          pool.add(lambda: None)
+        deadline = time.time() + 5
+        while (any(pool.queue_depth() != 1 for pool in (pool1, pool2)) and
+               time.time() < deadline):
+          time.sleep(0.01)
+        self.assertIn('smugcli_thread_pool_queue_depth{pool="shared"} 2',
+                      metrics.REGISTRY.render())
+        release.set()
+      # Still exported while the other pool runs.
+      self.assertIn('pool="shared"', metrics.REGISTRY.render())
+    self.assertNotIn('pool="shared"', metrics.REGISTRY.render())
+
+  def test_span_exporter(self):
+    tracer = tracing.Tracer()
+    tracer.add_exporter(metrics.SpanExporter())
+    before = metrics.API_CALLS.get(method='GET', endpoint='/test', status=200)
+    with tracer.span('GET', '/test') as span:
+      span.status = 200
+      span.retries = 2
+    self.assertEqual(
+      metrics.API_CALLS.get(method='GET', endpoint='/test', status=200),
+      before + 1)
+    self.assertGreaterEqual(
+      metrics.API_RETRIES.get(method='GET', endpoint='/test'), 2)
+
+  def test_writer(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    registry = metrics.Registry()
+    registry.counter('files_total', 'Files.').inc()
+    textfile = os.path.join(directory, 'smugcli.prom')
+    json_file = os.path.join(directory, 'smugcli.json')
+    with metrics.MetricsWriter(registry, textfile, json_file, interval=60):
+      pass
+    with open(textfile) as f:
+      self.assertIn('files_total 1\n', f.read())
+    with open(json_file) as f:
+      self.assertEqual(json.load(f)['files_total']['values'][0]['value'], 1)
+    self.assertEqual(sorted(os.listdir(directory)),
+                     ['smugcli.json', 'smugcli.prom'])
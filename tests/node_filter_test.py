@@ -0,0 +1,63 @@
+from smugcli import node_filter
+
+from parameterized import parameterized
+import unittest
+
+
+class FakeNode(object):
+  def __init__(self, json):
+    self.json = json
+    self.name = json.get('FileName') or json['Name']
+
+  def __contains__(self, key):
+    return key in self.json
+
+
+IMAGE = FakeNode({'FileName': 'IMG_0001.jpg', 'IsVideo': False,
+                  'ArchivedSize': 2000, 'ArchivedMD5': 'ABC',
+                  'Date': '2019-06-01T10:00:00+00:00'})
+VIDEO = FakeNode({'FileName': 'MOV_0001.mp4', 'IsVideo': True,
+                  'ArchivedSize': 3 * 1024 ** 3,
+                  'Date': '2018-01-01T10:00:00+00:00'})
+ALBUM = FakeNode({'Name': 'Trip', 'Type': 'Album',
+                  'DateAdded': '2019-01-01T00:00:00+00:00'})
+
+
+class TestNodeFilter(unittest.TestCase):
+
+  @parameterized.expand([
+    ({}, [IMAGE, VIDEO, ALBUM]),
+    ({'name': 'IMG_*'}, [IMAGE]),
+    ({'regex': r'[A-Z]{3}_\d+\.mp4'}, [VIDEO]),
+    ({'type': 'file'}, [IMAGE, VIDEO]),
+    ({'type': 'album'}, [ALBUM]),
+    ({'size': '+2G'}, [VIDEO]),
+    ({'size': '-2k'}, [IMAGE]),
+    ({'size': '2000'}, [IMAGE]),
+    ({'md5': 'abc'}, [IMAGE]),
+    ({'newer': '2019'}, [IMAGE, ALBUM]),
+    ({'older': '2019-01'}, [VIDEO]),
+    ({'type': 'video', 'older': '2020'}, [VIDEO]),
+  ])
+  def test_matches(self, predicates, expected):
+    matcher = node_filter.NodeFilter(**predicates)
+    self.assertEqual([n for n in (IMAGE, VIDEO, ALBUM) if matcher.matches(n)],
+                     expected)
+
+  def test_should_descend(self):
+    self.assertFalse(node_filter.NodeFilter(type='album').should_descend(
+      ALBUM, 1))
+    self.assertTrue(node_filter.NodeFilter(type='image').should_descend(
+      ALBUM, 1))
+    self.assertFalse(node_filter.NodeFilter(max_depth=1).should_descend(
+      ALBUM, 1))
+
+  def test_invalid_predicates(self):
+    self.assertRaises(node_filter.InvalidPredicateError,
+                      node_filter.NodeFilter, size='2X')
+    self.assertRaises(node_filter.InvalidPredicateError,
+                      node_filter.NodeFilter, newer='June')
+
+
+if __name__ == '__main__':
+  unittest.main()
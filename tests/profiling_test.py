@@ -0,0 +1,88 @@
+from smugcli import profiling
+
+from parameterized import parameterized
+import cProfile
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+
+def busy_worker(duration):
+  end = time.time() + duration
+  while time.time() < end:
+    sum(i * i for i in range(1000))
+
+
+class TestProfiler(unittest.TestCase):
+
+  def setUp(self):
+    self._directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._directory)
+
+  @parameterized.expand(profiling.MODES)
+  def test_worker_threads_are_profiled(self, mode):
+    profiler = profiling.Profiler(mode, interval=0.001)
+    profiler.start()
+    thread = threading.Thread(target=busy_worker, args=(0.2,))
+    thread.start()
+    thread.join()
+    profiler.stop()
+    pstats_path, collapsed_path = profiler.write(
+      os.path.join(self._directory, 'profile'))
+
+    functions = [name for _, _, name in pstats.Stats(pstats_path).stats]
+    self.assertIn('busy_worker', functions)
+    with open(collapsed_path) as f:
+      lines = f.read().splitlines()
+    worker_lines = [line for line in lines if 'busy_worker' in line]
+    self.assertTrue(worker_lines)
+    stack, count = worker_lines[0].rsplit(' ', 1)
+    self.assertGreater(int(count), 0)
+    self.assertIn('(profiling_test.py:', stack)
+
+  def test_running_threads_are_left_out(self):
+    owners = {}
+    foreign_disables = []
+    enable = cProfile.Profile.enable
+    disable = cProfile.Profile.disable
+    def enable_and_record(profile, *args, **kwargs):
+      owners[profile] = threading.current_thread()
+      return enable(profile, *args, **kwargs)
+    def record_and_disable(profile):
+      owner = owners.get(profile)
+      if owner is not threading.current_thread() and owner.is_alive():
+        foreign_disables.append(owner.name)
+      return disable(profile)
+
+    stop = threading.Event()
+    self.addCleanup(stop.set)
+    with mock.patch.object(cProfile.Profile, 'enable', enable_and_record), \
+         mock.patch.object(cProfile.Profile, 'disable', record_and_disable):
+      profiler = profiling.Profiler(profiling.DETERMINISTIC)
+      profiler.start()
+      thread = threading.Thread(target=stop.wait, name='running', daemon=True)
+      thread.start()
+      profiler.stop()
+      pstats_path, _ = profiler.write(
+        os.path.join(self._directory, 'profile'))
+
+    self.assertTrue(pstats.Stats(pstats_path).stats)
+    self.assertEqual(foreign_disables, [])
+
+  def test_sampled_stats(self):
+    sampler = profiling.Sampler(interval=0.5)
+    root = ('a.py', 1, 'root')
+    leaf = ('a.py', 10, 'leaf')
+    sampler._stacks[(root, leaf)] = 3
+    sampler._stacks[(root,)] = 1
+    stats = sampler.stats()
+    self.assertEqual(stats[root][:4], (4, 4, 0.5, 2.0))
+    self.assertEqual(stats[leaf][:4], (3, 3, 1.5, 1.5))
+    self.assertEqual(stats[leaf][4], {root: (3, 3, 0.0, 1.5)})
+    self.assertEqual(sampler.collapsed_lines(), [
+      'root (a.py:1) 1', 'root (a.py:1);leaf (a.py:10) 3'])
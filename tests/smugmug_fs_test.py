@@ -1,3 +1,5 @@
+from smugcli import jobs
+from smugcli import results
 from smugcli import smugmug
 from smugcli import smugmug_fs
 
@@ -9,7 +11,9 @@ from parameterized import parameterized
 import responses
 from six.moves import StringIO
 import sys
+import threading
 import unittest
+from unittest import mock
 
 
 API_ROOT = 'https://api.smugmug.com'
@@ -111,6 +115,334 @@ class TestSmugMugFS(unittest.TestCase):
     self.assertEqual(matched_nodes[1]['Name'], 'Photography')
     self.assertEqual(unmatched_dirs, ['invalid2'])
 
+  def _load_testdata(self, name):
+    testdir = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(testdir, 'testdata', name)) as f:
+      return json.load(f)
+
+  @responses.activate
+  def test_path_to_node_with_url_path_lookup(self):
+    root_json = self._load_testdata('root_node.json')['Response']['Node']
+    folder_json = [
+      n for n in self._load_testdata('root_children.json')['Response']['Node']
+      if n['Name'] == 'Photography'][0]
+    album_json = [
+      n for n in self._load_testdata('folder_children.json')['Response']['Node']
+      if n['Name'] == 'San Francisco by helicopter 2014'][0]
+    responses.add(
+      responses.GET, API_ROOT + '/api/v2/user/cmac!urlpathlookup',
+      json={'Response': {
+              'Locator': 'Album',
+              'Album': {'Uris': {'Node': {'Uri': album_json['Uri']}}}},
+            'Expansions': {album_json['Uri']: {'Node': album_json}}})
+    responses.add(
+      responses.GET,
+      API_ROOT + album_json['Uris']['ParentNodes']['Uri'],
+      json={'Response': {'Locator': 'Node',
+                         'Node': [folder_json, root_json]}})
+
+    matched_nodes, unmatched_dirs = self._fs.path_to_node(
+      'cmac', '/Photography/San Francisco by helicopter 2014')
+    self.assertEqual([n.name for n in matched_nodes[1:]],
+                     ['Photography', 'San Francisco by helicopter 2014'])
+    self.assertEqual(matched_nodes[2].path,
+                     '/Photography/San Francisco by helicopter 2014')
+    self.assertEqual(unmatched_dirs, [])
+    lookup = [c.request for c in responses.calls
+              if 'urlpathlookup' in c.request.url][0]
+    self.assertIn('urlpath=%2FPhotography%2FSan-Francisco-by-helicopter-2014',
+                  lookup.url)
+    self.assertFalse([c for c in responses.calls
+                      if '!children' in c.request.url])
+
+  @responses.activate
+  def test_url_path_lookup_resolves_the_prefix_of_a_file_path(self):
+    self._add_children_mocks()
+    root_json = self._load_testdata('root_node.json')['Response']['Node']
+    folder_json = [
+      n for n in self._load_testdata('root_children.json')['Response']['Node']
+      if n['Name'] == 'Photography'][0]
+    album_json = [
+      n for n in self._load_testdata('folder_children.json')['Response']['Node']
+      if n['Name'] == 'San Francisco by helicopter 2014'][0]
+    responses.add(
+      responses.GET, API_ROOT + '/api/v2/user/cmac!urlpathlookup',
+      json={'Response': {
+              'Locator': 'Album',
+              'Album': {'Uris': {'Node': {'Uri': album_json['Uri']}}}},
+            'Expansions': {album_json['Uri']: {'Node': album_json}}})
+    responses.add(
+      responses.GET,
+      API_ROOT + album_json['Uris']['ParentNodes']['Uri'],
+      json={'Response': {'Locator': 'Node',
+                         'Node': [folder_json, root_json]}})
+
+    matched_nodes, unmatched_dirs = self._fs.path_to_node(
+      'cmac', '/Photography/San Francisco by helicopter 2014/DSC_5752.jpg')
+    self.assertEqual([n.name for n in matched_nodes[1:]],
+                     ['Photography', 'San Francisco by helicopter 2014',
+                      'DSC_5752.jpg'])
+    self.assertEqual(unmatched_dirs, [])
+    lookup = [c.request for c in responses.calls
+              if 'urlpathlookup' in c.request.url][0]
+    self.assertIn('urlpath=%2FPhotography%2FSan-Francisco-by-helicopter-2014',
+                  lookup.url)
+    # Only the album's images were listed.
+    self.assertFalse([c for c in responses.calls
+                      if '!children' in c.request.url])
+
+    matched_nodes, unmatched_dirs = self._fs.path_to_node(
+      'cmac', '/Photography/San Francisco by helicopter 2014/Missing.jpg')
+    self.assertEqual(matched_nodes[-1].name, 'San Francisco by helicopter 2014')
+    self.assertEqual(unmatched_dirs, ['Missing.jpg'])
+
+  @responses.activate
+  def test_url_path_lookup_falls_back_on_name_mismatch(self):
+    self._add_children_mocks()
+    folder_json = [
+      n for n in self._load_testdata('root_children.json')['Response']['Node']
+      if n['Name'] == 'Photography'][0]
+    album_json = [
+      n for n in self._load_testdata('folder_children.json')['Response']['Node']
+      if n['Name'] == 'San Francisco by helicopter 2014'][0]
+    # The URL name matches, but not the name, e.g. another album's URL name.
+    other_json = dict(album_json, Name='San Francisco By Helicopter 2014')
+    responses.add(
+      responses.GET, API_ROOT + '/api/v2/user/cmac!urlpathlookup',
+      json={'Response': {
+              'Locator': 'Album',
+              'Album': {'Uris': {'Node': {'Uri': album_json['Uri']}}}},
+            'Expansions': {album_json['Uri']: {'Node': other_json}}})
+    responses.add(
+      responses.GET,
+      API_ROOT + album_json['Uris']['ParentNodes']['Uri'],
+      json={'Response': {'Locator': 'Node', 'Node': [folder_json]}})
+
+    matched_nodes, unmatched_dirs = self._fs.path_to_node(
+      'cmac', '/Photography/San Francisco by helicopter 2014')
+    self.assertEqual(matched_nodes[2].json, album_json)
+    self.assertEqual(unmatched_dirs, [])
+    # The path was walked instead.
+    self.assertTrue([c for c in responses.calls
+                     if '!children' in c.request.url])
+
+  @responses.activate
+  def test_url_path_lookup_not_used_on_error_or_unpredictable_url_name(self):
+    responses.add(
+      responses.GET, API_ROOT + '/api/v2/user/cmac!urlpathlookup',
+      status=404)
+    root_node = self._fs.get_root_node('cmac')
+    self.assertIsNone(self._fs.smugmug.lookup_path(
+      root_node, 'cmac', ['Photography', 'Missing']))
+    self.assertIsNone(self._fs.smugmug.lookup_path(
+      root_node, 'cmac', ['Photography', 'Ambiguous: name!']))
+
+  def _add_children_mocks(self):
+    for uri, data in (
+        ('/api/v2/node/zx4Fx!children', 'root_children'),
+        ('/api/v2/node/n83bK!children', 'folder_children')):
+      for start, suffix in (('1', ''), ('11', '_page2')):
+        responses.add(
+          responses.GET, API_ROOT + uri,
+          json=self._load_testdata(data + suffix + '.json'),
+          match=[responses.matchers.query_param_matcher(
+            {'start': start}, strict_match=False)])
+    responses.add(responses.GET, API_ROOT + '/api/v2/album/DDnhRD',
+                  json=self._load_testdata('album.json'))
+    for start, suffix in (('1', ''), ('11', '_page2')):
+      responses.add(
+        responses.GET, API_ROOT + '/api/v2/album/DDnhRD!images',
+        json=self._load_testdata('album_images' + suffix + '.json'),
+        match=[responses.matchers.query_param_matcher(
+          {'start': start}, strict_match=False)])
+
+  @responses.activate
+  def test_resolve_paths_lists_each_folder_once(self):
+    self._add_children_mocks()
+
+    paths = ['/Photography/San Francisco by helicopter 2014',
+             '/Photography/Jackson Hole',
+             '/Photography/Missing/Child',
+             '/Missing']
+    resolved = self._fs.resolve_paths('cmac', paths)
+
+    matched, unmatched = resolved[paths[0]]
+    self.assertEqual(matched[-1].name, 'San Francisco by helicopter 2014')
+    self.assertEqual(unmatched, [])
+    self.assertEqual(resolved[paths[1]][0][-1].name, 'Jackson Hole')
+    matched, unmatched = resolved[paths[2]]
+    self.assertEqual(matched[-1].name, 'Photography')
+    self.assertEqual(unmatched, ['Missing', 'Child'])
+    self.assertEqual(resolved[paths[3]][1], ['Missing'])
+
+    listings = [c.request.url for c in responses.calls
+                if '!children' in c.request.url]
+    self.assertEqual(len(listings), len(set(listings)))
+    self.assertEqual(len(listings), 4)
+
+  @responses.activate
+  def test_iter_glob(self):
+    self._add_children_mocks()
+    self.assertEqual(
+      [n.name for n in self._fs.iter_glob('cmac', '/Photo*/San*')],
+      ['San Francisco by helicopter 2014', 'San Francisco skyline'])
+    self.assertEqual(
+      [n.name for n in self._fs.iter_glob('cmac', '/Photography/Jackson Hole')],
+      ['Jackson Hole'])
+    self.assertEqual(
+      [n.name for n in self._fs.iter_glob('cmac', '/Photography/J.*',
+                                          re_match=True)],
+      ['Jackson Hole'])
+    self.assertEqual(list(self._fs.iter_glob('cmac', '/Missing/*')), [])
+
+  @responses.activate
+  def test_du(self):
+    self._add_children_mocks()
+    self._fs.du('cmac', ['/Photography/San Francisco by helicopter 2014'],
+                'folder', None)
+    lines = self._cmd_output.getvalue().splitlines()
+    self.assertEqual(len(lines), 2)
+    self.assertEqual(lines[1].split()[1:],
+                     ['18', '0', '1', '/Photography/San', 'Francisco', 'by',
+                      'helicopter', '2014'])
+
+  @responses.activate
+  def test_find(self):
+    self._add_children_mocks()
+    self._fs.find('cmac', ['/Photography/San Francisco by*'], False,
+                  name='DSC_59*',
+                  type='image')
+    self.assertEqual(self._cmd_output.getvalue().splitlines(), [
+      '/Photography/San Francisco by helicopter 2014/DSC_5903.jpg',
+      '/Photography/San Francisco by helicopter 2014/DSC_5932.jpg',
+      '/Photography/San Francisco by helicopter 2014/DSC_5947.jpg',
+      '/Photography/San Francisco by helicopter 2014/DSC_5978.jpg'])
+
+  @responses.activate
+  def test_iter_ls(self):
+    self._add_children_mocks()
+    listings = list(self._fs.iter_ls('cmac', '/Photography/San*',
+                                     directory=True))
+    self.assertEqual(
+      [(l.directory, [n.name for n in l.nodes]) for l in listings],
+      [(None, ['San Francisco by helicopter 2014']),
+       (None, ['San Francisco skyline'])])
+
+    listings = list(self._fs.iter_ls('cmac', '/Photography/San Francisco by*'))
+    self.assertEqual(len(listings), 1)
+    self.assertEqual(listings[0].directory.name,
+                     'San Francisco by helicopter 2014')
+    self.assertEqual([n.name for n in listings[0].nodes][:2],
+                     ['DSC_5752.jpg', 'DSC_5903.jpg'])
+
+  @responses.activate
+  def test_iter_rm(self):
+    self._add_children_mocks()
+    asked = []
+    def confirm(node):
+      asked.append(node.path)
+      return False
+    removals = list(self._fs.iter_rm(
+      'cmac', ['/Photography',
+               '/Photography/San Francisco by helicopter 2014/DSC_59*'],
+      False, confirm))
+    self.assertEqual([(r.path, r.status) for r in removals], [
+      ('/Photography', results.NOT_EMPTY),
+      ('/Photography/San Francisco by helicopter 2014/DSC_5903.jpg',
+       results.DECLINED),
+      ('/Photography/San Francisco by helicopter 2014/DSC_5932.jpg',
+       results.DECLINED),
+      ('/Photography/San Francisco by helicopter 2014/DSC_5947.jpg',
+       results.DECLINED),
+      ('/Photography/San Francisco by helicopter 2014/DSC_5978.jpg',
+       results.DECLINED)])
+    self.assertEqual(len(asked), 4)
+    self.assertFalse([c for c in responses.calls
+                      if c.request.method == 'DELETE'])
+
+  @responses.activate
+  def test_search(self):
+    self._test_search(include_root=True)
+
+  @responses.activate
+  def test_search_without_root_in_parents(self):
+    self._test_search(include_root=False)
+
+  def _test_search(self, include_root):
+    images = self._load_testdata('album_images.json')['Response']['AlbumImage']
+    root_json = self._load_testdata('root_node.json')['Response']['Node']
+    folder_json = [
+      n for n in self._load_testdata('root_children.json')['Response']['Node']
+      if n['Name'] == 'Photography'][0]
+    album_json = [
+      n for n in self._load_testdata('folder_children.json')['Response']['Node']
+      if n['Name'] == 'San Francisco by helicopter 2014'][0]
+    responses.add(
+      responses.GET, API_ROOT + '/api/v2/image!search',
+      json={'Response': {
+        'Locator': 'Image',
+        'Uri': '/api/v2/image!search?start=1&count=10',
+        'Image': images[:2],
+        'Pages': {'Count': 2, 'Total': 2}}},
+      match=[responses.matchers.query_param_matcher(
+        {'Scope': '/api/v2/user/cmac', 'Text': 'DSC'}, strict_match=False)])
+    album = self._load_testdata('album.json')
+    album['Expansions'] = {
+      album['Response']['Album']['Uris']['Node']['Uri']: {'Node': album_json}}
+    responses.add(responses.GET, API_ROOT + '/api/v2/album/DDnhRD',
+                  json=album)
+    responses.add(
+      responses.GET,
+      API_ROOT + album_json['Uris']['ParentNodes']['Uri'],
+      json={'Response': {'Locator': 'Node',
+                         'Node': [folder_json] + (
+                           [root_json] if include_root else [])}})
+
+    self._fs.ls('cmac', '/', False, False, False, False, True, search='DSC')
+    self.assertEqual(self._cmd_output.getvalue().splitlines(), [
+      '/Photography/San Francisco by helicopter 2014/DSC_5752.jpg',
+      '/Photography/San Francisco by helicopter 2014/DSC_5903.jpg'])
+    album_requests = [c for c in responses.calls
+                      if c.request.url.startswith(
+                        API_ROOT + '/api/v2/album/DDnhRD')]
+    self.assertEqual(len(album_requests), 1)
+
+  @responses.activate
+  def test_cd_caches_cwd_and_completes_paths(self):
+    self._add_children_mocks()
+    self._fs.cd('/Photography')
+    self._fs.complete_path('')  # Lists /Photography, like prefetch_cwd does.
+    listings = len(responses.calls)
+
+    self.assertEqual(self._fs.complete_path('San F'), [
+      'San Francisco by helicopter 2014/', 'San Francisco skyline/'])
+    self.assertEqual(self._fs.complete_path('/Photo'), ['/Photography/'])
+    matched_nodes, unmatched_dirs = self._fs.path_to_node('cmac',
+                                                          'Jackson Hole')
+    self.assertEqual(matched_nodes[-1].path, '/Photography/Jackson Hole')
+    # Everything was served from the cached listings.
+    self.assertEqual(len(responses.calls), listings)
+
+  @responses.activate
+  def test_cached_cwd_is_invalidated_by_changes(self):
+    self._add_children_mocks()
+    self._fs.smugmug.config['url_path_lookup'] = False
+    self._fs.cd('/Photography')
+    # Removed by another command sharing the session, e.g. a background job.
+    photography = self._fs.fork()._cwd_nodes[-1]
+    responses.add(responses.DELETE, API_ROOT + photography.json['Uri'])
+    photography.delete()
+    matched_nodes, unmatched_dirs = self._fs.path_to_node('cmac',
+                                                          'Jackson Hole')
+    self.assertEqual(len(matched_nodes), 1)
+    self.assertEqual(unmatched_dirs, ['Photography', 'Jackson Hole'])
+
+  def test_url_name(self):
+    self.assertEqual(smugmug.url_name('san Francisco 2014'),
+                     'San-Francisco-2014')
+    self.assertIsNone(smugmug.url_name("Baldy's first"))
+    self.assertIsNone(smugmug.url_name('two  spaces'))
+
   @responses.activate
   def test_get(self):
     self._fs.get('/api/v2/node/zx4Fx')
@@ -170,6 +502,26 @@ class TestSmugMugFS(unittest.TestCase):
       self._cmd_output.getvalue(),
       os.path.normpath(expected_message))
 
+  def test_archive_to_stdout_only_redirects_its_job(self):
+    terminal = StringIO()
+    sys.stdout = jobs.StdoutRouter(terminal)
+    other_job = jobs.Job(2, 'other', None, max_lines=10)
+    stderr = StringIO()
+    with mock.patch.object(smugmug_fs.archive_writer, 'OrderedArchiveWriter'), \
+         mock.patch.object(sys, 'stderr', stderr):
+      with self._fs._open_archive('-', 1):
+        print('Archived a.jpg')
+        def other():
+          jobs.set_current(other_job)
+          print('other output')
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+      print('done')
+    self.assertEqual(stderr.getvalue(), 'Archived a.jpg\n')
+    self.assertEqual(other_job.read_output(0), (['other output'], 1))
+    self.assertEqual(terminal.getvalue(), 'done\n')
+
 
 if __name__ == '__main__':
   unittest.main()
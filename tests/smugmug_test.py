@@ -2,7 +2,9 @@ from smugcli import smugmug
 
 import test_utils
 
+import datetime
 import freezegun
+import threading
 import unittest
 
 class MockNode(object):
@@ -81,3 +83,157 @@ class TestChildCacheGarbageCollector(unittest.TestCase):
     self.assertEqual(nodes[0]._reset_times, 1)
     self.assertEqual(nodes[1]._reset_times, 1)
     self.assertEqual(nodes[2]._reset_times, 0)
+
+
+class TestDownloadUrlCache(unittest.TestCase):
+
+  def test_entries_expire_after_ttl(self):
+    with freezegun.freeze_time('2019-01-01 12:00:00') as frozen_time:
+      cache = smugmug.DownloadUrlCache(default_ttl=60)
+      cache.put('/api/v2/image/a!largestvideo', 'https://v/a.mp4', 10)
+      self.assertEqual(cache.get('/api/v2/image/a!largestvideo'),
+                       ('https://v/a.mp4', 10))
+
+      frozen_time.tick(delta=datetime.timedelta(seconds=61))
+      self.assertIsNone(cache.get('/api/v2/image/a!largestvideo'))
+
+  def test_signed_url_expiry_is_used(self):
+    with freezegun.freeze_time('2019-01-01 12:00:00'):
+      cache = smugmug.DownloadUrlCache(default_ttl=3600)
+      cache.put('uri', 'https://v/a.mp4?Expires=0&Signature=x', 10)
+      self.assertIsNone(cache.get('uri'))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+  def _call_concurrently(self, single_flight, func, num_threads):
+    results = []
+    started = threading.Barrier(num_threads)
+    def call():
+      started.wait()
+      try:
+        results.append(single_flight.do('key', 'node!children', func))
+      except ValueError as e:
+        results.append(e)
+    threads = [threading.Thread(target=call) for _ in range(num_threads)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return results
+
+  def test_concurrent_calls_are_coalesced(self):
+    single_flight = smugmug.SingleFlight()
+    calls = []
+    def func():
+      calls.append(1)
+      # Keep the call in flight until the other threads joined it.
+      for _ in range(100):
+        if single_flight.stats()['node!children']['calls'] == 3:
+          break
+        threading.Event().wait(0.01)
+      return {'Response': {}}
+    results = self._call_concurrently(single_flight, func, 3)
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(results, [{'Response': {}}] * 3)
+    self.assertIs(results[0], results[1])
+    self.assertEqual(single_flight.stats(),
+                     {'node!children': {'calls': 3, 'coalesced': 2}})
+
+  def test_errors_are_shared(self):
+    single_flight = smugmug.SingleFlight()
+    def func():
+      for _ in range(100):
+        if single_flight.stats()['node!children']['calls'] == 2:
+          break
+        threading.Event().wait(0.01)
+      raise ValueError('boom')
+    results = self._call_concurrently(single_flight, func, 2)
+    self.assertEqual([str(r) for r in results], ['boom', 'boom'])
+
+  def test_sequential_calls_are_not_coalesced(self):
+    single_flight = smugmug.SingleFlight()
+    self.assertEqual(single_flight.do('key', 'node', lambda: 1), 1)
+    self.assertEqual(single_flight.do('key', 'node', lambda: 2), 2)
+    self.assertEqual(single_flight.stats(),
+                     {'node': {'calls': 2, 'coalesced': 0}})
+
+  def test_endpoint(self):
+    self.assertEqual(smugmug._endpoint('/api/v2/node/abc!children?start=1'),
+                     'node!children')
+    self.assertEqual(smugmug._endpoint('/api/v2/user/nick'), 'user')
+    self.assertEqual(smugmug._endpoint('/api/v2!authuser'), 'v2!authuser')
+
+
+class TestNodeDownloadInfo(unittest.TestCase):
+
+  def setUp(self):
+    self._smugmug = smugmug.FakeSmugMug()
+
+  def test_image_uses_archived_uri(self):
+    node = smugmug.Node(self._smugmug, {
+      'FileName': 'a.jpg', 'IsVideo': False,
+      'ArchivedUri': 'https://photos/a.jpg', 'ArchivedSize': 42})
+    self.assertEqual(node.get_download_info(), ('https://photos/a.jpg', 42))
+
+  def test_video_uses_listing_expansion(self):
+    uri = '/api/v2/image/v-0!largestvideo'
+    node = smugmug.Node(
+      self._smugmug,
+      {'FileName': 'v.mp4', 'IsVideo': True,
+       'Uris': {'LargestVideo': {'Uri': uri}}},
+      expansions={uri: {'LargestVideo': {'Url': 'https://v/v.mp4',
+                                         'Size': 1234}}})
+    # No request is mocked: the expansion and then the cache must be used.
+    self.assertEqual(node.get_download_info(), ('https://v/v.mp4', 1234))
+    self.assertEqual(self._smugmug.download_url_cache.get(uri),
+                     ('https://v/v.mp4', 1234))
+
+
+class TestParentNodes(unittest.TestCase):
+
+  def test_shared_reply_is_not_modified(self):
+    smugmug_service = smugmug.FakeSmugMug()
+    nodes = [{'Name': 'Album'}, {'Name': 'Folder'}, {'IsRoot': True}]
+    reply = {'Response': {'Node': nodes}}
+    # Coalesced callers all get the same reply object.
+    smugmug_service.get_json = lambda path, **kwargs: reply
+    node_json = {'Uris': {'ParentNodes': {'Uri': '/api/v2/node/a!parents'}}}
+    for _ in range(2):
+      self.assertEqual(smugmug_service.get_parent_nodes_json(node_json),
+                       nodes[::-1])
+    self.assertEqual(reply['Response']['Node'][0], {'Name': 'Album'})
+
+
+class TestNodeChildrenCache(unittest.TestCase):
+
+  def _make_node(self, smugmug_service):
+    node = smugmug.Node(smugmug_service, {'Type': 'Folder', 'Name': 'F'})
+    node.listings = 0
+
+    def get_children():
+      node.listings += 1
+      return [smugmug.Node(smugmug_service, {'Name': 'child'}, node)]
+    node.get_children = get_children
+    return node
+
+  def test_cache_never_expires_by_default(self):
+    with freezegun.freeze_time('2019-01-01 12:00:00') as frozen_time:
+      node = self._make_node(smugmug.FakeSmugMug())
+      self.assertEqual(node.get_child_names(), ['child'])
+      frozen_time.tick(delta=datetime.timedelta(days=1))
+      node.get_child('child')
+      self.assertEqual(node.listings, 1)
+
+  def test_cache_expires_after_ttl(self):
+    with freezegun.freeze_time('2019-01-01 12:00:00') as frozen_time:
+      smugmug_service = smugmug.FakeSmugMug()
+      smugmug_service.set_tree_cache_ttl(60)
+      node = self._make_node(smugmug_service)
+      node.get_child('child')
+      frozen_time.tick(delta=datetime.timedelta(seconds=30))
+      node.get_child('child')
+      self.assertEqual(node.listings, 1)
+      frozen_time.tick(delta=datetime.timedelta(seconds=31))
+      node.get_child('child')
+      self.assertEqual(node.listings, 2)
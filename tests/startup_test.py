@@ -0,0 +1,48 @@
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which must only be imported by the commands that need them.
+LAZY_MODULES = ['bottle', 'hachoir', 'rauth', 'requests_oauthlib', 'webbrowser',
+                'smugcli.smugmug_oauth', 'smugcli.smugmug_shell']
+
+# Budget for importing smugcli, in milliseconds. It is generous, to catch
+# regressions like eagerly importing a heavy dependency without being flaky on
+# slow machines.
+STARTUP_BUDGET_MS = int(os.environ.get('SMUGCLI_STARTUP_BUDGET_MS', 500))
+
+IMPORT_TIME_RE = re.compile(
+  r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$', re.MULTILINE)
+
+
+def _profile_version_command():
+  """Runs `smugcli --version`, returning {module: cumulative import time}."""
+  env = dict(os.environ,
+             SMUGCLI_SOCKET=os.path.join(ROOT_DIR, 'nonexistent.sock'))
+  result = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-m', 'smugcli', '--version'],
+    cwd=ROOT_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    universal_newlines=True, check=True)
+  assert result.stdout.startswith('Version:'), result.stdout
+  return {match.group(4): int(match.group(2))
+          for match in IMPORT_TIME_RE.finditer(result.stderr)}
+
+
+class TestStartup(unittest.TestCase):
+
+  def test_heavy_modules_not_imported(self):
+    modules = _profile_version_command()
+    for module in LAZY_MODULES:
+      imported = [m for m in modules
+                  if m == module or m.startswith(module + '.')]
+      self.assertEqual(imported, [], '%s imported at startup' % module)
+
+  def test_import_time_budget(self):
+    # Keep the best of a few runs, to filter out noise.
+    import_time_ms = min(_profile_version_command()['smugcli.smugcli']
+                         for _ in range(3)) / 1000
+    self.assertLess(import_time_ms, STARTUP_BUDGET_MS)
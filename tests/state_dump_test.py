@@ -0,0 +1,132 @@
+from smugcli import state_dump
+from smugcli import task_manager
+from smugcli import thread_pool
+from smugcli import tracing
+
+import io
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+
+def sync_file(file_path, node, started, release):
+  with tracing.Tracer().span('GET', '/api/v2/album/{id}!images') as span:
+    span.status = 200
+    span.bytes_in = 1234
+    started.set()
+    release.wait()
+
+
+class TestStateDump(unittest.TestCase):
+
+  def setUp(self):
+    self._started = threading.Event()
+    self._release = threading.Event()
+    self.addCleanup(self._release.set)
+
+  def test_workers_tasks_and_requests(self):
+    with task_manager.TaskManager() as manager, \
+         thread_pool.ThreadPool(2, 'file') as pool:
+      with manager.start_task(0, 'Syncing "a.jpg"'):
+        pool.add(sync_file, '/photos/a.jpg', object(), self._started,
+                 self._release)
+        self._started.wait()
+        lines = state_dump.get_lines()
+      self._release.set()
+
+    self.assertIn('Thread pool "file": 2 workers, 0 queued tasks', lines)
+    task_lines = [i for i, line in enumerate(lines)
+                  if "sync_file('/photos/a.jpg', <object>, <Event>, <Event>) "
+                  'for ' in line]
+    self.assertEqual(len(task_lines), 1)
+    self.assertRegex(
+      lines[task_lines[0] + 1],
+      r'^    GET /api/v2/album/\{id\}!images for \d+\.\ds '
+      r'\(status 200, 1234 bytes received\)$')
+    self.assertEqual(len([line for line in lines if line.endswith(': idle')]),
+                     1)
+    self.assertIn('Tasks in progress:', lines)
+    self.assertRegex(lines[-1], r'^  Syncing "a.jpg" \(MainThread, \d+\.\ds\)$')
+
+  def test_finished_pools_are_not_dumped(self):
+    with thread_pool.ThreadPool(1, 'done'):
+      pass
+    self.assertFalse([line for line in state_dump.get_lines()
+                      if '"done"' in line])
+
+  @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'Requires SIGUSR1')
+  def test_signal_appends_to_file(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    path = os.path.join(directory, 'dump.txt')
+    previous = signal.getsignal(signal.SIGUSR1)
+    self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+    state_dump.install(path)
+    for _ in range(2):
+      os.kill(os.getpid(), signal.SIGUSR1)
+      # The dump is written by another thread.
+      deadline = time.time() + 5
+      while self._count_dumps(path) < 1 and time.time() < deadline:
+        time.sleep(0.01)
+      self.assertEqual(self._count_dumps(path), 1)
+      os.remove(path)
+
+  @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'Requires SIGUSR1')
+  def test_signal_handler_takes_no_lock(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    path = os.path.join(directory, 'dump.txt')
+    previous = signal.getsignal(signal.SIGUSR1)
+    self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+    state_dump.install(path)
+    with thread_pool.ThreadPool(1, 'busy') as pool:
+      # Signal while the main thread holds the queue's mutex, which the dump
+      # needs: the handler must return, and the dump be written once released.
+      with pool._tasks.mutex:
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertFalse(os.path.exists(path))
+      deadline = time.time() + 5
+      while self._count_dumps(path) < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    self.assertEqual(self._count_dumps(path), 1)
+
+  @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'Requires SIGUSR1')
+  def test_dumps_continue_after_a_failure(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    path = os.path.join(directory, 'dump.txt')
+    previous = signal.getsignal(signal.SIGUSR1)
+    self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+    state_dump.install(path)
+    stderr = io.StringIO()
+    with mock.patch.object(state_dump, 'get_lines',
+                           side_effect=ValueError('bad task')), \
+         mock.patch.object(sys, 'stderr', stderr):
+      os.kill(os.getpid(), signal.SIGUSR1)
+      deadline = time.time() + 5
+      while not stderr.getvalue() and time.time() < deadline:
+        time.sleep(0.01)
+    self.assertIn('ValueError: bad task', stderr.getvalue())
+    os.kill(os.getpid(), signal.SIGUSR1)
+    deadline = time.time() + 5
+    while self._count_dumps(path) < 1 and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(self._count_dumps(path), 1)
+
+  def _count_dumps(self, path):
+    try:
+      with open(path) as f:
+        return f.read().count('smugcli state at ')
+    except FileNotFoundError:
+      return 0
+
+  def test_dump(self):
+    stream = io.StringIO()
+    state_dump.dump(stream)
+    self.assertTrue(stream.getvalue().startswith('smugcli state at '))
@@ -40,3 +40,14 @@ class TestThreadPool(unittest.TestCase):
       pool.add(will_raise)
 
     mock_io.assert_output_was(u'Unicode: \xe2')
+
+  def testWait(self):
+    results = []
+    with thread_pool.ThreadPool(2) as pool:
+      for i in range(5):
+        pool.add(results.append, i)
+      pool.wait()
+      self.assertEqual(sorted(results), [0, 1, 2, 3, 4])
+      pool.add(results.append, 5)
+      pool.wait()
+      self.assertEqual(len(results), 6)
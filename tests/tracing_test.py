@@ -0,0 +1,154 @@
+from smugcli import smugmug
+from smugcli import tracing
+from smugcli import transport
+
+import http.server
+import json
+import os
+import requests
+import responses
+import shutil
+import tempfile
+import threading
+import unittest
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    body = b'{}'
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class TestTracer(unittest.TestCase):
+
+  def setUp(self):
+    self._tracer = tracing.Tracer()
+    self._buffer = tracing.RingBufferExporter(capacity=2)
+    self._tracer.add_exporter(self._buffer)
+
+  def test_endpoint_template(self):
+    self.assertEqual(
+      tracing.endpoint_template('/api/v2/node/abc!children?start=1'),
+      '/api/v2/node/{id}!children')
+    self.assertEqual(
+      tracing.endpoint_template('/api/v2/folder/user/nick/A/B!albums'),
+      '/api/v2/folder/{id}!albums')
+    self.assertEqual(tracing.endpoint_template('/api/v2/user/nick'),
+                     '/api/v2/user/{id}')
+    self.assertEqual(tracing.endpoint_template('/api/v2!authuser'),
+                     '/api/v2!authuser')
+
+  def test_spans(self):
+    with self._tracer.span('GET', '/a') as span:
+      tracing.record('retries', 1)
+      self.assertIs(tracing.current(), span)
+    self.assertIsNone(tracing.current())
+    with self.assertRaises(ValueError):
+      with self._tracer.span('POST', '/b'):
+        raise ValueError()
+    spans = self._buffer.spans()
+    self.assertEqual([(s.method, s.endpoint, s.retries, s.error)
+                      for s in spans],
+                     [('GET', '/a', 1, None), ('POST', '/b', 0, 'ValueError')])
+    self.assertGreaterEqual(spans[0].total, 0)
+    # Only the last spans are kept.
+    with self._tracer.span('GET', '/c'):
+      pass
+    self.assertEqual([s.endpoint for s in self._buffer.spans()], ['/b', '/c'])
+
+  def test_bind(self):
+    recorded = []
+    with self._tracer.span('GET', '/a') as span:
+      thread = threading.Thread(
+        target=tracing.bind(lambda: recorded.append(tracing.current())))
+      thread.start()
+      thread.join()
+    self.assertEqual(recorded, [span])
+
+  def test_jsonl_exporter(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    path = os.path.join(directory, 'trace.jsonl')
+    exporter = tracing.JsonlExporter(path)
+    with self._tracer.exporting(exporter):
+      with self._tracer.span('GET', '/a'):
+        pass
+    with self._tracer.span('GET', '/not-exported'):
+      pass
+    exporter.close()
+    with open(path) as f:
+      lines = [json.loads(line) for line in f]
+    self.assertEqual([line['endpoint'] for line in lines], ['/a'])
+    self.assertEqual(sorted(lines[0]), sorted(tracing.Span.FIELDS))
+
+  def test_summary_exporter(self):
+    summary = tracing.SummaryExporter()
+    self._tracer.add_exporter(summary)
+    for endpoint in ('/a', '/a', '/b'):
+      with self._tracer.span('GET', endpoint) as span:
+        span.bytes_in = 10
+    rows = summary.rows()
+    self.assertEqual(sorted((m, e, r['calls'], r['bytes_in'])
+                            for m, e, r in rows),
+                     [('GET', '/a', 2, 20), ('GET', '/b', 1, 10)])
+    table = summary.table()
+    self.assertEqual(len(table), 3)
+    self.assertTrue(table[0].startswith('Method'))
+
+
+class TestSmugMugTracing(unittest.TestCase):
+
+  @responses.activate
+  def test_api_calls_are_traced(self):
+    requests_sent = []
+    smugmug_ = smugmug.SmugMug({}, requests_sent)
+    # Skip authentication.
+    smugmug_._oauth = lambda request: request
+    buffer = tracing.RingBufferExporter()
+    smugmug_.tracer.add_exporter(buffer)
+    responses.add(responses.GET, smugmug.API_ROOT + '/api/v2/user/nick',
+                  json={'Response': {}})
+    responses.add(responses.POST, smugmug.API_ROOT + '/api/v2/node/abc!children',
+                  json={'Response': {}}, status=201)
+    smugmug_.get_json('/api/v2/user/nick')
+    smugmug_.post('/api/v2/node/abc!children', json={'Name': 'A'})
+    spans = buffer.spans()
+    self.assertEqual([(s.method, s.endpoint, s.status) for s in spans], [
+      ('GET', '/api/v2/user/{id}', 200),
+      ('POST', '/api/v2/node/{id}!children', 201)])
+    self.assertEqual(spans[0].bytes_in, len(b'{"Response": {}}'))
+    self.assertEqual(spans[1].bytes_out, len(b'{"Name": "A"}'))
+    # Spans don't retain requests and responses, unless asked to.
+    self.assertIsNone(spans[0].request)
+    self.assertEqual([req.method for req, _ in requests_sent],
+                     ['GET', 'POST'])
+
+  def test_connection_timings(self):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+    transport_ = transport.Transport({})
+    self.addCleanup(transport_.close)
+    tracer = tracing.Tracer()
+    buffer = tracing.RingBufferExporter()
+    tracer.add_exporter(buffer)
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    for _ in range(2):
+      with tracer.span('GET', '/') as span:
+        req = requests.Request('GET', url).prepare()
+        span.set_response(req, transport_.send(transport.METADATA, req))
+    first, second = buffer.spans()
+    self.assertGreater(first.connect, 0)
+    # The second request reuses the connection.
+    self.assertEqual(second.connect, 0)
+    self.assertGreater(second.ttfb, 0)
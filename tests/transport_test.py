@@ -0,0 +1,273 @@
+from smugcli import transport
+
+import http.server
+import io
+import requests
+import threading
+import time
+import unittest
+from unittest import mock
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Number of requests to /stall which stall before completing.
+  stalls = 0
+  # Delays, in seconds, before answering the next requests to /slow.
+  delays = []
+  # Statuses of the answers to the next requests to /slow.
+  statuses = []
+
+  def do_GET(self):
+    body = b'ok'
+    status = 200
+    if self.path == '/slow' and _Handler.statuses:
+      status = _Handler.statuses.pop(0)
+    if self.path == '/slow' and _Handler.delays:
+      time.sleep(_Handler.delays.pop(0))
+    if self.path == '/stall' and _Handler.stalls:
+      _Handler.stalls -= 1
+      self.send_response(200)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body[:1])
+      self.wfile.flush()
+      time.sleep(2)
+      return
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(body)))
+    if self.path == '/close':
+      self.send_header('Connection', 'close')
+      self.close_connection = True
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class TestTransport(unittest.TestCase):
+
+  def setUp(self):
+    self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    self._server.daemon_threads = True
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    self._url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+    self._transport = transport.Transport({'folder_threads': 1,
+                                           'file_threads': 2,
+                                           'upload_threads': 5})
+
+  def tearDown(self):
+    self._transport.close()
+    self._server.shutdown()
+    self._server.server_close()
+
+  def _get(self, lane, path='/'):
+    req = requests.Request('GET', self._url + path).prepare()
+    resp = self._transport.send(lane, req)
+    self.assertEqual(resp.text, 'ok')
+
+  def test_pool_sizes(self):
+    self.assertEqual(self._transport.pool_size(transport.METADATA),
+                     3 + transport.HEADROOM_CONNECTIONS)
+    self.assertEqual(self._transport.pool_size(transport.UPLOAD), 5)
+    self.assertEqual(self._transport.pool_size(transport.DOWNLOAD), 4)
+
+  def test_connections_are_reused(self):
+    for _ in range(3):
+      self._get(transport.METADATA)
+    stats = self._transport.stats()
+    self.assertEqual(stats[transport.METADATA], {
+      'requests': 3, 'hits': 2, 'misses': 1, 'reconnects': 0,
+      'discarded': 0})
+    # Each lane has its own connections.
+    self._get(transport.UPLOAD)
+    self.assertEqual(self._transport.stats()[transport.UPLOAD]['misses'], 1)
+
+  def test_reconnects(self):
+    self._get(transport.METADATA, '/close')
+    self._get(transport.METADATA)
+    stats = self._transport.stats()[transport.METADATA]
+    self.assertEqual(stats['misses'], 1)
+    self.assertEqual(stats['reconnects'], 1)
+
+  def test_prewarm(self):
+    self._transport.prewarm(transport.METADATA, self._url, 2).join()
+    stats = self._transport.stats()[transport.METADATA]
+    # Warming serves no request.
+    self.assertEqual(stats['requests'], 0)
+    self.assertEqual(stats['misses'], 0)
+    # Both requests use a warmed connection.
+    barrier = threading.Barrier(2)
+    def get():
+      barrier.wait()
+      self._get(transport.METADATA)
+    threads = [threading.Thread(target=get) for _ in range(2)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    stats = self._transport.stats()[transport.METADATA]
+    self.assertEqual(stats['requests'], 2)
+    self.assertEqual(stats['misses'], 0)
+    self.assertEqual(stats['hits'], 2)
+    self.assertEqual(stats['reconnects'], 0)
+
+  def test_pools_only_grow(self):
+    session = self._transport._sessions[transport.DOWNLOAD]
+    self._transport.set_pool_size(transport.DOWNLOAD, 1)
+    self.assertEqual(self._transport.pool_size(transport.DOWNLOAD), 4)
+    self.assertIs(self._transport._sessions[transport.DOWNLOAD], session)
+    # The replaced session may still be used by another command.
+    with mock.patch.object(session, 'close') as close:
+      self._transport.set_pool_size(transport.DOWNLOAD, 8)
+      self.assertEqual(self._transport.pool_size(transport.DOWNLOAD), 8)
+      self.assertFalse(close.called)
+      self._transport.close()
+      self.assertTrue(close.called)
+
+  def test_discarded(self):
+    self._transport.close()
+    self._transport = transport.Transport({'download_threads': 1})
+    barrier = threading.Barrier(3)
+    def get():
+      barrier.wait()
+      self._get(transport.DOWNLOAD)
+    threads = [threading.Thread(target=get) for _ in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    stats = self._transport.stats()[transport.DOWNLOAD]
+    self.assertEqual(stats['requests'], 3)
+    self.assertEqual(stats['misses'] - stats['discarded'], 1)
+
+
+class TestTimeoutsAndWatchdog(unittest.TestCase):
+
+  def setUp(self):
+    self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    self._server.daemon_threads = True
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    self._url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+    self._transport = transport.Transport({'stall_timeout': 0.2,
+                                           'transfer_retries': 1,
+                                           'download_read_timeout': 5})
+    retry_delay = mock.patch.object(transport, 'RETRY_DELAY', 0)
+    retry_delay.start()
+    self.addCleanup(retry_delay.stop)
+
+  def tearDown(self):
+    _Handler.stalls = 0
+    self._transport.close()
+    self._server.shutdown()
+    self._server.server_close()
+
+  def _download(self, watch):
+    req = requests.Request('GET', self._url + '/stall').prepare()
+    resp = self._transport.send(transport.DOWNLOAD, req, stream=True)
+    data = b''
+    for chunk in resp.iter_content(1):
+      watch.progress(len(chunk))
+      data += chunk
+    return data
+
+  def test_timeouts(self):
+    self.assertEqual(self._transport.timeout(transport.METADATA),
+                     transport.DEFAULT_TIMEOUTS[transport.METADATA])
+    self.assertEqual(self._transport.timeout(transport.DOWNLOAD), (10, 5))
+
+  def test_stalled_transfer_is_retried(self):
+    _Handler.stalls = 1
+    with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+      start = time.time()
+      self.assertEqual(self._transport.transfer(self._download), b'ok')
+    # Aborted long before the server would have completed or timed out.
+    self.assertLess(time.time() - start, 1.5)
+    self.assertIn('Transfer stalled', stdout.getvalue())
+    self.assertIn('Retrying (1/1).', stdout.getvalue())
+
+  def test_retries_exhausted(self):
+    _Handler.stalls = 2
+    with mock.patch('sys.stdout', new_callable=io.StringIO):
+      with self.assertRaises(transport.StalledTransferError):
+        self._transport.transfer(self._download)
+
+  def test_unsafe_retry(self):
+    _Handler.stalls = 1
+    with self.assertRaises(transport.StalledTransferError):
+      self._transport.transfer(self._download, can_retry=lambda watch: False)
+
+
+class TestHedging(unittest.TestCase):
+
+  def setUp(self):
+    self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    self._server.daemon_threads = True
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    self._url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+  def tearDown(self):
+    _Handler.delays = []
+    _Handler.statuses = []
+    self._server.shutdown()
+    self._server.server_close()
+
+  def _transport(self, config):
+    result = transport.Transport(config)
+    self.addCleanup(result.close)
+    # Observe enough fast requests to estimate the p95 latency.
+    for _ in range(transport.HEDGE_MIN_SAMPLES):
+      self._get(result, hedge=True)
+    return result
+
+  def _get(self, transport_, hedge):
+    request = requests.Request('GET', self._url + '/slow')
+    self._prepared = 0
+    def prepare():
+      self._prepared += 1
+      return request.prepare()
+    resp = transport_.send(transport.METADATA, prepare(),
+                           hedge=prepare if hedge else None)
+    self.assertEqual(resp.text, 'ok')
+    return resp
+
+  def test_slow_request_is_hedged(self):
+    transport_ = self._transport({'hedge_requests': True, 'hedge_budget': 0.1})
+    self.assertIsNotNone(transport_._hedger.p95())
+    _Handler.delays = [2]
+    start = time.time()
+    self._get(transport_, hedge=True)
+    self.assertLess(time.time() - start, 1.5)
+    # The hedge was prepared anew, e.g. to be signed with a nonce of its own.
+    self.assertEqual(self._prepared, 2)
+    stats = transport_.stats()[transport.METADATA]
+    self.assertEqual(stats['hedgeable'], transport.HEDGE_MIN_SAMPLES + 1)
+    self.assertEqual(stats['hedged'], 1)
+    self.assertEqual(stats['hedge_wins'], 1)
+    self.assertEqual(stats['hedge_denied'], 0)
+
+  def test_failed_hedge_does_not_win(self):
+    transport_ = self._transport({'hedge_requests': True, 'hedge_budget': 0.1})
+    # The primary is slow but valid, the hedge is quickly rejected.
+    _Handler.statuses = [200, 401]
+    _Handler.delays = [1]
+    resp = self._get(transport_, hedge=True)
+    self.assertEqual(resp.status_code, 200)
+    stats = transport_.stats()[transport.METADATA]
+    self.assertEqual(stats['hedged'], 1)
+    self.assertEqual(stats['hedge_wins'], 0)
+
+  def test_hedge_budget(self):
+    transport_ = self._transport({'hedge_requests': True, 'hedge_budget': 0})
+    _Handler.delays = [0.5]
+    self._get(transport_, hedge=True)
+    stats = transport_.stats()[transport.METADATA]
+    self.assertEqual(stats['hedged'], 0)
+    self.assertEqual(stats['hedge_denied'], 1)
+
+  def test_disabled(self):
+    transport_ = transport.Transport({})
+    self.addCleanup(transport_.close)
+    self._get(transport_, hedge=True)
+    self.assertNotIn('hedged', transport_.stats()[transport.METADATA])
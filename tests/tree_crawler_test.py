@@ -0,0 +1,91 @@
+from smugcli import tree_crawler
+
+import random
+import threading
+import time
+import unittest
+
+
+class FakeNode(object):
+  def __init__(self, name, children=None):
+    self.name = name
+    self._children = children
+    self.listed = 0
+
+  def __contains__(self, key):
+    return key == 'Type' and self._children is not None
+
+  def get_children(self):
+    self.listed += 1
+    # Random delays make listings complete out of order.
+    time.sleep(random.random() * 0.01)
+    return self._children
+
+
+def make_tree(depth, width, prefix='n'):
+  if depth == 0:
+    return FakeNode(prefix)
+  return FakeNode(prefix, [make_tree(depth - 1, width, '%s%d' % (prefix, i))
+                           for i in range(width)])
+
+
+def depth_first(node):
+  if node._children is None:
+    return []
+  result = [node]
+  for child in node._children:
+    result.extend(depth_first(child))
+  return result
+
+
+class TestTreeCrawler(unittest.TestCase):
+
+  def test_yields_listings_in_depth_first_order(self):
+    root = make_tree(4, 3)
+    with tree_crawler.TreeCrawler(8) as crawler:
+      crawled = list(crawler.crawl([root]))
+
+    self.assertEqual([node for node, _ in crawled], depth_first(root))
+    for node, children in crawled:
+      self.assertEqual(children, node._children)
+      self.assertEqual(node.listed, 1)
+
+  def test_should_descend_prunes_subtrees(self):
+    root = make_tree(3, 2)
+    with tree_crawler.TreeCrawler(
+        4, should_descend=lambda n, d: not n.name.endswith('1')) as crawler:
+      names = [node.name for node, _ in crawler.crawl([root])]
+    self.assertEqual(names, ['n', 'n0', 'n00'])
+
+  def test_should_descend_gets_depth(self):
+    root = make_tree(3, 2)
+    with tree_crawler.TreeCrawler(
+        4, should_descend=lambda n, depth: depth < 2) as crawler:
+      names = [node.name for node, _ in crawler.crawl([root])]
+    self.assertEqual(names, ['n', 'n0', 'n1'])
+
+  def test_limits_listings_fetched_ahead(self):
+    root = make_tree(2, 20)
+    with tree_crawler.TreeCrawler(4, max_pending=2) as crawler:
+      crawl = crawler.crawl([root])
+      next(crawl)
+      time.sleep(0.2)
+      listed = sum(child.listed for child in root._children)
+      self.assertLessEqual(listed, 2)
+      self.assertEqual(len(list(crawl)), 20)
+
+  def test_errors_are_raised_in_order(self):
+    class FailingNode(FakeNode):
+      def get_children(self):
+        raise ValueError('listing failed')
+
+    root = FakeNode('root', [FakeNode('a', []), FailingNode('b', [])])
+    with tree_crawler.TreeCrawler(2) as crawler:
+      crawl = crawler.crawl([root])
+      self.assertEqual(next(crawl)[0].name, 'root')
+      self.assertEqual(next(crawl)[0].name, 'a')
+      self.assertRaises(ValueError, next, crawl)
+
+
+if __name__ == '__main__':
+  unittest.main()